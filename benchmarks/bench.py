@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+#
+# benchmarks for all conversion paths
+#
+# usage: bench.py [--scale N] [--repeat N] [--case NAME]... [--stage NAME]...
+#                 [--output FILE] [--compare FILE] [--threshold FRACTION]
+#
+# every (case, stage) pair is run in a separate child process, so that peak
+# memory usage can be measured for each of them; results are printed and
+# optionally saved as JSON to be compared with later runs
+#
+# for stages that produce piqi objects, the footprint of the resulting object
+# graph is measured as well, see piqi_memory.py
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piq
+import piqi
+import piqi_memory
+import piq_transform
+
+import bench_piqi
+
+
+MODULE_NAME = 'bench_piqi'
+
+
+# piq source builders
+
+class Named(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class Name(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def gen_piq(x, accu):
+    if isinstance(x, Named):
+        accu.append('.' + x.name + ' ')
+        if isinstance(x.value, (Named, Name)):
+            accu.append('(')
+            gen_piq(x.value, accu)
+            accu.append(')')
+        else:
+            gen_piq(x.value, accu)
+    elif isinstance(x, Name):
+        accu.append('.' + x.name)
+    elif isinstance(x, list):
+        accu.append('[')
+        for i, item in enumerate(x):
+            if i:
+                accu.append(', ')
+            gen_piq(item, accu)
+        accu.append(']')
+    elif isinstance(x, bool):
+        accu.append('True' if x else 'False')
+    elif isinstance(x, (int, float)):
+        accu.append(repr(x))
+    elif isinstance(x, basestring):
+        accu.append(repr(str(x)))
+    else:
+        assert False
+
+
+def gen_piq_script(x):
+    accu = ['doc = ']
+    gen_piq(x, accu)
+    accu.append('\n')
+    return ''.join(accu)
+
+
+def json_name(x):
+    return x.replace('-', '_')
+
+
+# benchmark cases
+#
+# each case returns (typename, piq representation, json representation) of a
+# document of the given size
+
+def make_wide(scale):
+    piq_items = []
+    json_items = []
+    for n in range(20 * scale):
+        piq_fields = []
+        json_fields = {}
+        for i in range(bench_piqi.WIDE_FIELD_COUNT):
+            name = bench_piqi.wide_field_name(i)
+            value = n + i if i % 2 else 'value' + str(i)
+            piq_fields.append(Named(name, value))
+            json_fields[json_name(name)] = value
+        piq_items.append(Named('item', piq_fields))
+        json_items.append(json_fields)
+    return 'wide-doc', piq_items, {'item': json_items}
+
+
+DEEP_DEPTH = 30
+
+
+def make_deep(scale):
+    def make_node(depth):
+        piq_node = [Named('value', depth), Named('name', 'node' + str(depth))]
+        json_node = {'value': depth, 'name': 'node' + str(depth)}
+        if depth < DEEP_DEPTH:
+            piq_child, json_child = make_node(depth + 1)
+            piq_node.append(Named('child', piq_child))
+            json_node['child'] = json_child
+        return piq_node, json_node
+
+    piq_trees = []
+    json_trees = []
+    for n in range(20 * scale):
+        piq_tree, json_tree = make_node(0)
+        piq_trees.append(Named('tree', piq_tree))
+        json_trees.append(json_tree)
+    return 'deep-doc', piq_trees, {'tree': json_trees}
+
+
+def make_big_enum(scale):
+    piq_items = []
+    json_items = []
+    for n in range(2000 * scale):
+        name = bench_piqi.big_enum_option_name((n * 7919) % bench_piqi.BIG_ENUM_OPTION_COUNT)
+        piq_items.append(Named('e', Name(name)))
+        json_items.append(json_name(name))
+    return 'enum-doc', piq_items, {'e': json_items}
+
+
+def make_nested_variant(scale):
+    piq_items = []
+    json_items = []
+    for n in range(2000 * scale):
+        i = n % bench_piqi.NESTED_VARIANT_OPTION_COUNT
+        if n % 3 == 0:
+            name = bench_piqi.inner_int_option_name(i)
+            piq_items.append(Named('v', Named(name, n)))
+            json_items.append({'inner_int': {name: n}})
+        elif n % 3 == 1:
+            name = bench_piqi.inner_string_option_name(i)
+            piq_items.append(Named('v', Named(name, 's' + str(n))))
+            json_items.append({'inner_string': {name: 's' + str(n)}})
+        else:
+            piq_items.append(Named('v', Named('z', n * 0.5)))
+            json_items.append({'z': n * 0.5})
+    return 'variant-doc', piq_items, {'v': json_items}
+
+
+def make_long_repeated(scale):
+    samples = [n * 0.25 for n in range(5000 * scale)]
+    tags = ['t' + str(n) for n in range(1000 * scale)]
+    piq_items = [Named('sample', x) for x in samples] + [Named('tag', x) for x in tags]
+    return 'series', piq_items, {'sample': samples, 'tag': tags}
+
+
+def make_positional(scale):
+    piq_items = []
+    json_items = []
+    for n in range(1000 * scale):
+        piq_items.append([n, 's' + str(n), n * 0.5, n % 2 == 0])
+        json_items.append({'i': n, 's': 's' + str(n), 'f': n * 0.5, 'b': n % 2 == 0})
+    return 'pos-doc', piq_items, {'p': json_items}
+
+
+CASES = [
+    ('wide', make_wide),
+    ('deep', make_deep),
+    ('big-enum', make_big_enum),
+    ('nested-variant', make_nested_variant),
+    ('long-repeated', make_long_repeated),
+    ('positional', make_positional),
+]
+
+
+# benchmark inputs shared by all stages of a case
+class Input(object):
+    def __init__(self, case_name, make_case, scale, tmpdir):
+        self.typename, piq_doc, self.json_doc = make_case(scale)
+
+        self.json_text = json.dumps(self.json_doc)
+
+        self.script_filename = os.path.join(tmpdir, case_name + '.piq.py')
+        with open(self.script_filename, 'w') as f:
+            f.write(gen_piq_script(piq_doc))
+        self.script_size = os.path.getsize(self.script_filename)
+
+        self._piq_obj = None
+        self._piqi_obj = None
+        self._pb_data = None
+
+    # piq script evaluation result
+    @property
+    def piq_obj(self):
+        if self._piq_obj is None:
+            self._piq_obj = exec_script(self.script_filename)
+        return self._piq_obj
+
+    @property
+    def piqi_obj(self):
+        if self._piqi_obj is None:
+            self._piqi_obj = piqi.parse(self.json_doc, MODULE_NAME, self.typename, format='json')
+        return self._piqi_obj
+
+    @property
+    def pb_data(self):
+        if self._pb_data is None:
+            self._pb_data = piqi.gen(self.piqi_obj, format='pb')
+        return self._pb_data
+
+
+def exec_script(filename):
+    exec_globals = {}
+    piq_transform.exec_file(filename, exec_globals)
+    return exec_globals['doc']
+
+
+# stages
+#
+# each stage returns (setup, run, input size in bytes); setup() is called before
+# every run and its result is passed to run()
+
+def stage_exec_file(x):
+    return (lambda: x.script_filename), exec_script, x.script_size
+
+
+# NOTE: script results are already piq nodes at the top, so parsing them alone
+# measures nothing; expanding splices and names, as piqi.parse(piq) does,
+# rebuilds the whole tree with piq.make_node()
+def stage_piq_parse(x):
+    def run(obj):
+        return piq.parse(obj, expand_splices=True, expand_names=True)
+    return (lambda: x.piq_obj), run, x.script_size
+
+
+def stage_piqi_parse_piq(x):
+    def run(obj):
+        return piqi.parse(obj, MODULE_NAME, x.typename, format='piq')
+    return (lambda: x.piq_obj), run, x.script_size
+
+
+def stage_piqi_parse_json(x):
+    def run(json_doc):
+        return piqi.parse(json_doc, MODULE_NAME, x.typename, format='json')
+    return (lambda: x.json_doc), run, len(x.json_text)
+
+
+def stage_piqi_parse_json_arrays(x):
+    def run(json_doc):
+        return piqi.parse(json_doc, MODULE_NAME, x.typename, format='json', numeric_arrays='array')
+    return (lambda: x.json_doc), run, len(x.json_text)
+
+
+def stage_piqi_convert_piq(x):
+    def run(obj):
+        return piqi.convert(obj, MODULE_NAME, x.typename, format='piq', output_format='json')
+    return (lambda: x.piq_obj), run, x.script_size
+
+
+def stage_piqi_validate_json(x):
+    def run(json_doc):
+        errors = piqi.validate(json_doc, MODULE_NAME, x.typename, format='json')
+        assert errors == []
+    return (lambda: x.json_doc), run, len(x.json_text)
+
+
+def stage_piqi_gen_json(x):
+    def run(obj):
+        return piqi.gen(obj, format='json')
+    return (lambda: x.piqi_obj), run, len(x.json_text)
+
+
+def stage_piqi_parse_pb(x):
+    def run(data):
+        return piqi.parse(data, MODULE_NAME, x.typename, format='pb')
+    return (lambda: x.pb_data), run, len(x.pb_data)
+
+
+def stage_piqi_gen_pb(x):
+    def run(obj):
+        return piqi.gen(obj, format='pb')
+    return (lambda: x.piqi_obj), run, len(x.pb_data)
+
+
+STAGES = [
+    ('piq_transform.exec_file', stage_exec_file),
+    ('piq.parse', stage_piq_parse),
+    ('piqi.parse(piq)', stage_piqi_parse_piq),
+    ('piqi.parse(json)', stage_piqi_parse_json),
+    ('piqi.parse(json, arrays)', stage_piqi_parse_json_arrays),
+    ('piqi.validate(json)', stage_piqi_validate_json),
+    ('piqi.gen(json)', stage_piqi_gen_json),
+    ('piqi.convert(piq)', stage_piqi_convert_piq),
+    ('piqi.parse(pb)', stage_piqi_parse_pb),
+    ('piqi.gen(pb)', stage_piqi_gen_pb),
+]
+
+
+def peak_rss_kb():
+    # NOTE: ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_stage(case_name, make_case, stage_name, make_stage, scale, repeat, tmpdir):
+    x = Input(case_name, make_case, scale, tmpdir)
+    nodes = piqi.count_objects(x.piqi_obj)
+    setup, run, size = make_stage(x)
+
+    # prepare inputs before measuring the peak memory baseline
+    setup()
+    base_rss = peak_rss_kb()
+
+    best = None
+    res = None
+    for _ in range(repeat):
+        arg = setup()
+        del res
+        start_time = time.time()
+        res = run(arg)
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+
+    rss = peak_rss_kb()
+
+    if isinstance(res, piqi.ObjectProxy):
+        memory = piqi_memory.measure(res)
+        object_bytes = memory.total_bytes
+        bytes_per_value = memory.bytes_per_value
+    else:
+        object_bytes = None
+        bytes_per_value = None
+
+    return {
+        'case': case_name,
+        'stage': stage_name,
+        'seconds': best,
+        'nodes': nodes,
+        'bytes': size,
+        'nodes_per_sec': nodes / best if best else 0.0,
+        'mb_per_sec': size / best / (1024 * 1024) if best else 0.0,
+        'peak_rss_kb': rss,
+        'peak_rss_delta_kb': rss - base_rss,
+        'object_bytes': object_bytes,
+        'bytes_per_value': bytes_per_value,
+    }
+
+
+def run_stage_in_child(queue, *args):
+    try:
+        queue.put(run_stage(*args))
+    except Exception as e:
+        queue.put({'case': args[0], 'stage': args[2], 'error': type(e).__name__ + ': ' + str(e)})
+
+
+def run_isolated(*args):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_stage_in_child, args=(queue,) + args)
+    p.start()
+    res = queue.get()
+    p.join()
+    return res
+
+
+def format_result(x):
+    if 'error' in x:
+        return '{:<16} {:<24} error: {}\n'.format(x['case'], x['stage'], x['error'])
+    else:
+        if x.get('bytes_per_value') is not None:
+            memory = ' {:>8.1f} B/value'.format(x['bytes_per_value'])
+        else:
+            memory = ''
+        return '{:<16} {:<24} {:>9.4f}s {:>12.0f} nodes/s {:>8.2f} MB/s {:>10} KB peak ({:+} KB){}\n'.format(
+            x['case'], x['stage'], x['seconds'], x['nodes_per_sec'], x['mb_per_sec'],
+            x['peak_rss_kb'], x['peak_rss_delta_kb'], memory
+        )
+
+
+# metrics compared between runs, lower is better
+COMPARED_METRICS = [
+    ('seconds', '{:.4f}s'),
+    ('bytes_per_value', '{:.1f} B/value'),
+]
+
+
+# return the list of (case, stage, metric, old value, new value) where the new
+# value is worse by more than the threshold
+def compare_results(old, new, threshold):
+    old_index = dict(((x['case'], x['stage']), x) for x in old['results'] if 'error' not in x)
+
+    regressions = []
+    for x in new['results']:
+        if 'error' in x:
+            continue
+        prev = old_index.get((x['case'], x['stage']))
+        if prev is None:
+            continue
+        for metric, _ in COMPARED_METRICS:
+            old_value = prev.get(metric)
+            new_value = x.get(metric)
+            if old_value and new_value is not None and new_value > old_value * (1 + threshold):
+                regressions.append((x['case'], x['stage'], metric, old_value, new_value))
+    return regressions
+
+
+def main():
+    arg_scale = 1
+    arg_repeat = 3
+    arg_cases = []
+    arg_stages = []
+    arg_output = None
+    arg_compare = None
+    arg_threshold = 0.1
+
+    args = sys.argv[1:]
+
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '--scale':
+            i += 1
+            arg_scale = int(args[i])
+        elif a == '--repeat':
+            i += 1
+            arg_repeat = int(args[i])
+        elif a == '--case':
+            i += 1
+            arg_cases.append(args[i])
+        elif a == '--stage':
+            i += 1
+            arg_stages.append(args[i])
+        elif a == '--output':
+            i += 1
+            arg_output = args[i]
+        elif a == '--compare':
+            i += 1
+            arg_compare = args[i]
+        elif a == '--threshold':
+            i += 1
+            arg_threshold = float(args[i])
+        else:
+            sys.exit('unknown argument: ' + a)
+        i += 1
+
+    cases = [x for x in CASES if not arg_cases or x[0] in arg_cases]
+    stages = [x for x in STAGES if not arg_stages or x[0] in arg_stages]
+
+    tmpdir = tempfile.mkdtemp(prefix='piqi-bench-')
+    try:
+        results = []
+        for case_name, make_case in cases:
+            for stage_name, make_stage in stages:
+                x = run_isolated(case_name, make_case, stage_name, make_stage, arg_scale, arg_repeat, tmpdir)
+                sys.stdout.write(format_result(x))
+                sys.stdout.flush()
+                results.append(x)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = {
+        'python': sys.version,
+        'timestamp': time.time(),
+        'scale': arg_scale,
+        'repeat': arg_repeat,
+        'results': results,
+    }
+
+    if arg_output is not None:
+        with open(arg_output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if arg_compare is not None:
+        with open(arg_compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, output, arg_threshold)
+        metric_formats = dict(COMPARED_METRICS)
+        for case_name, stage_name, metric, old_value, new_value in regressions:
+            value_format = metric_formats[metric]
+            sys.stdout.write('regression: {} {}: {} -> {} ({:+.1f}%)\n'.format(
+                case_name, stage_name,
+                value_format.format(old_value), value_format.format(new_value),
+                100.0 * (new_value - old_value) / old_value
+            ))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# synthetic schemas for benchmarks
+#
+# this module has the same interface as modules generated by piqic-python
+
+import piqi
+
+
+def field(name, typename, mode='optional', **kwargs):
+    res = {'name': name, 'type': typename, 'mode': mode}
+    res.update(kwargs)
+    return res
+
+
+# record with many labeled fields
+WIDE_FIELD_COUNT = 100
+
+# number of options in a big enum
+BIG_ENUM_OPTION_COUNT = 500
+
+# number of named options in each of nested variants
+NESTED_VARIANT_OPTION_COUNT = 20
+
+
+def wide_field_name(i):
+    return 'f' + str(i)
+
+
+def big_enum_option_name(i):
+    return 'opt-n' + str(i)
+
+
+def inner_int_option_name(i):
+    return 'a' + str(i)
+
+
+def inner_string_option_name(i):
+    return 'b' + str(i)
+
+
+typedef_index = {
+    'wide': ('record', {
+        'name': 'wide',
+        'field': [
+            field(wide_field_name(i), 'int' if i % 2 else 'string')
+            for i in range(WIDE_FIELD_COUNT)
+        ]
+    }),
+    'wide-doc': ('record', {
+        'name': 'wide-doc',
+        'field': [field('item', 'wide', 'repeated')]
+    }),
+
+    'node': ('record', {
+        'name': 'node',
+        'field': [
+            field('value', 'int', 'required'),
+            field('name', 'string'),
+            field('child', 'node'),
+        ]
+    }),
+    'deep-doc': ('record', {
+        'name': 'deep-doc',
+        'field': [field('tree', 'node', 'repeated')]
+    }),
+
+    'big-enum': ('enum', {
+        'name': 'big-enum',
+        'option': [{'name': big_enum_option_name(i)} for i in range(BIG_ENUM_OPTION_COUNT)]
+    }),
+    'enum-doc': ('record', {
+        'name': 'enum-doc',
+        'field': [field('e', 'big-enum', 'repeated')]
+    }),
+
+    'inner-int': ('variant', {
+        'name': 'inner-int',
+        'option': [
+            {'name': inner_int_option_name(i), 'type': 'int'}
+            for i in range(NESTED_VARIANT_OPTION_COUNT)
+        ]
+    }),
+    'inner-string': ('variant', {
+        'name': 'inner-string',
+        'option': [
+            {'name': inner_string_option_name(i), 'type': 'string'}
+            for i in range(NESTED_VARIANT_OPTION_COUNT)
+        ]
+    }),
+    'outer': ('variant', {
+        'name': 'outer',
+        'option': [
+            {'type': 'inner-int'},
+            {'type': 'inner-string'},
+            {'name': 'z', 'type': 'float'},
+        ]
+    }),
+    'variant-doc': ('record', {
+        'name': 'variant-doc',
+        'field': [field('v', 'outer', 'repeated')]
+    }),
+
+    'series': ('record', {
+        'name': 'series',
+        'field': [
+            field('sample', 'float', 'repeated'),
+            field('tag', 'string', 'repeated'),
+        ]
+    }),
+
+    'pos': ('record', {
+        'name': 'pos',
+        'field': [
+            field('i', 'int', 'required'),
+            field('s', 'string', 'required'),
+            field('f', 'float', 'required'),
+            field('b', 'bool'),
+        ]
+    }),
+    'pos-doc': ('record', {
+        'name': 'pos-doc',
+        'field': [field('p', 'pos', 'repeated', piq_positional=True)]
+    }),
+}
+
+
+# record classes as generated by piqic-python
+#
+# NOTE: 'wide' records are left generic, i.e. they are represented by
+# piqi.Record
+
+class WideDoc(piqi.SlottedRecord):
+    __slots__ = ('item_list',)
+
+    _piqi_type = 'wide-doc'
+    _piqi_typedef = typedef_index['wide-doc'][1]
+
+    def __init__(self, item_list):
+        self.item_list = item_list
+
+
+class Node(piqi.SlottedRecord):
+    __slots__ = ('value', 'name', 'child')
+
+    _piqi_type = 'node'
+    _piqi_typedef = typedef_index['node'][1]
+
+    def __init__(self, value, name, child):
+        self.value = value
+        self.name = name
+        self.child = child
+
+
+class DeepDoc(piqi.SlottedRecord):
+    __slots__ = ('tree_list',)
+
+    _piqi_type = 'deep-doc'
+    _piqi_typedef = typedef_index['deep-doc'][1]
+
+    def __init__(self, tree_list):
+        self.tree_list = tree_list
+
+
+class EnumDoc(piqi.SlottedRecord):
+    __slots__ = ('e_list',)
+
+    _piqi_type = 'enum-doc'
+    _piqi_typedef = typedef_index['enum-doc'][1]
+
+    def __init__(self, e_list):
+        self.e_list = e_list
+
+
+class VariantDoc(piqi.SlottedRecord):
+    __slots__ = ('v_list',)
+
+    _piqi_type = 'variant-doc'
+    _piqi_typedef = typedef_index['variant-doc'][1]
+
+    def __init__(self, v_list):
+        self.v_list = v_list
+
+
+class Series(piqi.SlottedRecord):
+    __slots__ = ('sample_list', 'tag_list')
+
+    _piqi_type = 'series'
+    _piqi_typedef = typedef_index['series'][1]
+
+    def __init__(self, sample_list, tag_list):
+        self.sample_list = sample_list
+        self.tag_list = tag_list
+
+
+class Pos(piqi.SlottedRecord):
+    __slots__ = ('i', 's', 'f', 'b')
+
+    _piqi_type = 'pos'
+    _piqi_typedef = typedef_index['pos'][1]
+
+    def __init__(self, i, s, f, b):
+        self.i = i
+        self.s = s
+        self.f = f
+        self.b = b
+
+
+class PosDoc(piqi.SlottedRecord):
+    __slots__ = ('p_list',)
+
+    _piqi_type = 'pos-doc'
+    _piqi_typedef = typedef_index['pos-doc'][1]
+
+    def __init__(self, p_list):
+        self.p_list = p_list
+
+
+record_classes = {
+    'wide-doc': WideDoc,
+    'node': Node,
+    'deep-doc': DeepDoc,
+    'enum-doc': EnumDoc,
+    'variant-doc': VariantDoc,
+    'series': Series,
+    'pos': Pos,
+    'pos-doc': PosDoc,
+}
+
+
+# variant and enum tags
+interned_tags = piqi.make_module_table(typedef_index, piqi.make_interned_tags)
+
+
+def parse(x, typename, format="piq"):
+    return piqi.parse(x, __name__, typename, format)
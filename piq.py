@@ -1,5 +1,7 @@
 import wrappers
 
+import piqi_profile
+
 
 class ObjectProxy(wrappers.ObjectProxy):
     def __init__(self, wrapped, loc):
@@ -232,7 +234,23 @@ class Splice(object):
         return [Named(self.name, self.loc, x) for x in self.items]
 
 
+# count nodes of piq AST
+def count_nodes(node):
+    if isinstance(node, List):
+        return 1 + sum(count_nodes(x) for x in node.items)
+    elif isinstance(node, Named):
+        return 1 + count_nodes(node.value)
+    elif isinstance(node, Splice):
+        return 1 + sum(count_nodes(x) for x in node.items)
+    else:
+        return 1
+
+
 def parse(x, expand_splices=False, expand_names=False):
+    return piqi_profile.run_stage('piq.parse', count_nodes, do_parse, x, expand_splices, expand_names)
+
+
+def do_parse(x, expand_splices, expand_names):
     node = make_node(x)
 
     if expand_splices:
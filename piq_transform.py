@@ -4,8 +4,17 @@
 #
 # - more restrictive parsing -- allow transform only inside [ ... ] or single ()
 
+import os
 import sys
+import time
 import StringIO
+import collections
+import itertools
+import threading
+import hashlib
+import marshal
+import multiprocessing
+import importlib
 
 import tokenize
 import token as pytoken
@@ -13,13 +22,38 @@ import keyword as pykeyword
 import ast
 
 import piq
+import piqi
+import piqi_profile
 
 
-def is_token(l, i, toknum, tokval=None):
-    if i >= len(l):
+class TokenStream(object):
+    """Token generator with a small look-ahead buffer"""
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+        self.lookahead = collections.deque()
+
+    def peek(self, n=0):
+        while len(self.lookahead) <= n:
+            try:
+                self.lookahead.append(next(self.tokens))
+            except StopIteration:
+                return None
+        return self.lookahead[n]
+
+    def pop(self):
+        if self.lookahead:
+            return self.lookahead.popleft()
+        else:
+            return next(self.tokens)
+
+
+# NOTE: look-ahead helpers take the number of tokens to look past the current
+# position of the stream
+def is_token(s, n, toknum, tokval=None):
+    token = s.peek(n)
+    if token is None:
         return False
 
-    token = l[i]
     if toknum == token[0]:
         if tokval == None:
             return True
@@ -29,43 +63,40 @@ def is_token(l, i, toknum, tokval=None):
         return False
 
 
-def is_token_op(l, i, opname=None):
-    return is_token(l, i, pytoken.OP, tokval=opname)
+def is_token_op(s, n, opname=None):
+    return is_token(s, n, pytoken.OP, tokval=opname)
 
 
-def is_token_op_in(l, i, opnames):
+def is_token_op_in(s, n, opnames):
     for opname in opnames:
-        if is_token_op(l, i, opname):
+        if is_token_op(s, n, opname):
             return True
     return False
 
 
-def is_token_name(l, i):
-    return is_token(l, i, pytoken.NAME)
+def is_token_name(s, n):
+    return is_token(s, n, pytoken.NAME)
 
 
-def peek_token(l, i):
-    if i >= len(l):
-        return None
-    else:
-        return l[i]
+def peek_token(s, n):
+    return s.peek(n)
 
 
-def pop_token(l, i):
-    return (l[i], i + 1)
+def pop_token(s):
+    return s.pop()
 
 
-def is_token_keyword(l, i):
-    token = peek_token(l, i)
+def is_token_keyword(s, n):
+    token = peek_token(s, n)
     return (token is not None and token[0] == pytoken.NAME and pykeyword.iskeyword(token[1]))
 
 
-def is_token_op_value_start(l, i):
-    return is_token_op_in(l, i, ['`', '(', '[', '{', '-', '+', '~'])
+def is_token_op_value_start(s, n):
+    return is_token_op_in(s, n, ['`', '(', '[', '{', '-', '+', '~'])
 
 
-def is_token_value_start(l, i):
-    return (not is_token_op(l, i) or is_token_op_value_start(l, i)) and not is_token_keyword(l, i) and not is_token(l, i, pytoken.ENDMARKER)
+def is_token_value_start(s, n):
+    return (not is_token_op(s, n) or is_token_op_value_start(s, n)) and not is_token_keyword(s, n) and not is_token(s, n, pytoken.ENDMARKER)
 
 
 def make_token(toknum, tokval, tokstart = None, tokend = None):
@@ -77,33 +108,29 @@ def make_token(toknum, tokval, tokstart = None, tokend = None):
         return (toknum, tokval, tokstart, tokend, None)
 
 
-def is_piq_name_start(l, i):
-    return is_token_op(l, i, '.') and is_token_name(l, i + 1)
+def is_piq_name_start(s, n):
+    return is_token_op(s, n, '.') and is_token_name(s, n + 1)
 
 
-def is_piq_name_continue(l, i):
-    return is_token_op(l, i, '-') and is_token_name(l, i + 1)
+def is_piq_name_continue(s, n):
+    return is_token_op(s, n, '-') and is_token_name(s, n + 1)
 
 
 # skip insignificant tokens
-def skip_nl_and_comment_tokens(l, i, accu):
-    if is_token(l, i, tokenize.NL) or is_token(l, i, tokenize.COMMENT):
-        token, i = pop_token(l, i)
-        accu.append(token)
-        return skip_nl_and_comment_tokens(l, i, accu)  # see if we've got more of these
-    else:
-        return i
+def skip_nl_and_comment_tokens(s, accu):
+    while is_token(s, 0, tokenize.NL) or is_token(s, 0, tokenize.COMMENT):
+        accu.append(pop_token(s))
 
 
-def transform_piq_name(filename, l, i, accu, name=None, name_loc=None):
+def transform_piq_name(filename, s, accu, name=None, name_loc=None):
     # '.' in case of name start, '-' in case of another name segment
     #
     # TODO: make sure '-' immediately follow preceeding name segment
-    dot_or_dash_token, i = pop_token(l, i)
+    dot_or_dash_token = pop_token(s)
     dot_loc = dot_or_dash_token[3]
     dot_or_dash = dot_or_dash_token[1]
 
-    name_token, i = pop_token(l, i)
+    name_token = pop_token(s)
     name_token_val = name_token[1]
 
     if name is None:
@@ -140,39 +167,39 @@ def transform_piq_name(filename, l, i, accu, name=None, name_loc=None):
             (pytoken.OP, ')')
         ])
 
-    if is_piq_name_start(l, i):
+    if is_piq_name_start(s, 0):
         # next token is also a name => this name is chained with another Piq
         # name => recurse
-        i = transform_piq_name(filename, l, i, accu, name, name_loc)
-    elif is_piq_name_continue(l, i):
+        transform_piq_name(filename, s, accu, name, name_loc)
+    elif is_piq_name_continue(s, 0):
         # next token is a '-' followed by another name segment => recurse
-        i = transform_piq_name(filename, l, i, accu, name, name_loc)
+        transform_piq_name(filename, s, accu, name, name_loc)
     else:
         # something else
 
         # skip whitespace
         nl_and_comment_accu = []
-        i = skip_nl_and_comment_tokens(l, i, nl_and_comment_accu)
+        skip_nl_and_comment_tokens(s, nl_and_comment_accu)
 
-        if is_token_op_in(l, i, [')', ']', ',']):
+        if is_token_op_in(s, 0, [')', ']', ',']):
             # end of name
             accu_append_keyword('_piq_make_name')
-        elif is_token_value_start(l, i):
+        elif is_token_value_start(s, 0):
             # value juxtaposition
             accu_append_keyword('_piq_make_named')
 
             accu.append((pytoken.OP, '**'))
-        elif is_token_op(l, i, '*') and is_token_value_start(l, i + 1):
+        elif is_token_op(s, 0, '*') and is_token_value_start(s, 1):
             # splice
             accu_append_keyword('_piq_make_splice')
 
             # replace '*' with '**' which has a higher precedence and stronger
             # binding
-            _, i = pop_token(l, i)
+            pop_token(s)
             accu.append((pytoken.OP, '**'))
         else:
             # something else, likely an error
-            error_tok =  peek_token(l, i)
+            error_tok =  peek_token(s, 0)
             error_tok_loc = error_tok[3]
 
             loc = piq.make_loc((error_tok_loc[0], error_tok_loc[1]))
@@ -181,22 +208,28 @@ def transform_piq_name(filename, l, i, accu, name=None, name_loc=None):
         # insert back newlines and comments
         accu.extend(nl_and_comment_accu)
 
-    return i
 
-
-def transform_token_list(filename, l):
+# transform token stream on the fly
+#
+# only a few tokens are buffered at a time, so memory use doesn't depend on
+# the size of the input
+def transform_tokens(filename, tokens):
+    s = TokenStream(tokens)
     accu = []
-    i = 0
 
-    i = skip_nl_and_comment_tokens(l, i, accu)
+    skip_nl_and_comment_tokens(s, accu)
 
     piq_name_allowed = False
     while True:
-        if i >= len(l):
-            return accu
+        for token in accu:
+            yield token
+        del accu[:]
 
-        if piq_name_allowed and is_piq_name_start(l, i):
-            i = transform_piq_name(filename, l, i, accu)
+        if peek_token(s, 0) is None:
+            return
+
+        if piq_name_allowed and is_piq_name_start(s, 0):
+            transform_piq_name(filename, s, accu)
 
             # Piq name can not be immediately followed by another Piq name
             piq_name_allowed = False
@@ -204,17 +237,19 @@ def transform_token_list(filename, l):
             # Piq name is allowed only after these tokens
             #
             # TODO: allow only commas inside lists
-            piq_name_allowed = is_token_op_in(l, i, ['(', '[', ','])
+            piq_name_allowed = is_token_op_in(s, 0, ['(', '[', ','])
 
-            token, i = pop_token(l, i)
-            accu.append(token)
+            accu.append(pop_token(s))
 
-            i = skip_nl_and_comment_tokens(l, i, accu)
+            skip_nl_and_comment_tokens(s, accu)
+
+
+def transform_token_list(filename, l):
+    return list(transform_tokens(filename, l))
 
 
 def tokenize_common(infile):
-    tokens = tokenize.generate_tokens(infile)
-    return list(tokens)
+    return tokenize.generate_tokens(infile)
 
 
 def tokenize_string(s):
@@ -223,17 +258,18 @@ def tokenize_string(s):
 
 def tokenize_file(filename):
     with open(filename, 'rb') as infile:
-        return tokenize_common(infile.readline)
+        for token in tokenize_common(infile.readline):
+            yield token
 
 
 def tokenize_and_transform_string(s, filename='-'):
     tokens = tokenize_string(s)
-    return transform_token_list(filename, tokens)
+    return transform_tokens(filename, tokens)
 
 
 def tokenize_and_transform_file(filename):
     tokens = tokenize_file(filename)
-    return transform_token_list(filename, tokens)
+    return transform_tokens(filename, tokens)
 
 
 class AstExprWrapper(ast.NodeTransformer):
@@ -286,29 +322,47 @@ class AstOverrideOperators(ast.NodeTransformer):
                 keywords=[]
             ))
 
-        def make_lazy_bool_operator_node(name, args):
-            def make_lazy_arg_node(body):
-                args = make_node(ast.arguments(
-                    args=[],
-                    vararg=None,
-                    kwarg=None,
-                    defaults=[]
-                ))
-                return make_node(ast.Lambda(
-                    args=args,
-                    body=body
-                ))
+        def make_and_node(left, right):
+            # a and b -> None is not _piq_operator_and(a) < b
+            #
+            # a chained comparison evaluates its middle operand once and the
+            # right-hand side only when the first comparison holds, i.e. when
+            # operator_and() returns anything but None; the result is then
+            # computed by the returned object's __lt__(b)
+            return make_node(ast.Compare(
+                left=make_node(ast.Name(id='None', ctx=ast.Load())),
+                ops=[ast.IsNot(), ast.Lt()],
+                comparators=[make_operator_node('and', [left]), right]
+            ))
 
-            first_eager_arg_node, rest_args = args[0], args[1:]
-            rest_lazy_arg_nodes = [make_lazy_arg_node(x) for x in rest_args]
+        def make_or_node(left, right):
+            # a or b -> _piq_operator_or(a) or _piq_operator_or_right() < b
+            #
+            # unlike the above, the short-circuit result is the left-hand side
+            # itself, so it goes through Python's own or
+            return make_node(ast.BoolOp(
+                op=ast.Or(),
+                values=[
+                    make_operator_node('or', [left]),
+                    make_node(ast.Compare(
+                        left=make_operator_node('or_right', []),
+                        ops=[ast.Lt()],
+                        comparators=[right]
+                    ))
+                ]
+            ))
 
-            return make_operator_node(name, [first_eager_arg_node] + rest_lazy_arg_nodes)
+        def make_bool_operator_node(make_binary_node, args):
+            accu = args[0]
+            for arg in args[1:]:
+                accu = make_binary_node(accu, arg)
+            return accu
 
         if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
-            return make_lazy_bool_operator_node('and', node.values)
+            return make_bool_operator_node(make_and_node, node.values)
 
         if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or):
-            return make_lazy_bool_operator_node('or', node.values)
+            return make_bool_operator_node(make_or_node, node.values)
 
         elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
             return make_operator_node('not', [node.operand])
@@ -355,10 +409,23 @@ def make_splice(name, loc):
     return AbstractSplice(name, loc)
 
 
+# cache of domain boolean expression checks keyed by object class
+_domain_boolean_classes = {}
+
+
+# NOTE: domain methods are looked up on the class, as Python does for its own
+# special methods, i.e. methods set on instances are not recognized
 def is_domain_boolean_expression(x):
-    return (
-            hasattr(x, '__bool_and__') and hasattr(x, '__bool_or__') and hasattr(x, '__bool_not__')
-    )
+    # NOTE: using x.__class__ rather than type(x) in order to see through
+    # object proxies
+    cls = x.__class__
+    res = _domain_boolean_classes.get(cls)
+    if res is None:
+        res = (
+                hasattr(cls, '__bool_and__') and hasattr(cls, '__bool_or__') and hasattr(cls, '__bool_not__')
+        )
+        _domain_boolean_classes[cls] = res
+    return res
 
 
 def check_is_domain_boolean_expression(x):
@@ -373,54 +440,98 @@ def check_is_not_domain_boolean_expression(x):
     assert not is_domain_boolean_expression(x)
 
 
-def operator_and(accu, *args):
-    def binary_and(accu, arg):
-        if is_domain_boolean_expression(accu):
-            arg = arg()
-            check_is_domain_boolean_expression(arg)
-            res = accu.__bool_and__(arg)
-            check_is_domain_boolean_expression(res)
-        else:
-            # standard boolean and evaluation
-            if not accu:
-                res = False  # short-circuit
-            else:
-                arg = arg()
-                check_is_not_domain_boolean_expression(arg)
-                res = (accu and arg)  # NOTE, XXX: equivalent to just arg
-        return res
+# the right-hand side of a boolean expression, whose left-hand side is a regular
+# boolean value that doesn't short-circuit the expression
+#
+# modified AST calls its __lt__() with the right-hand side operand (see
+# AstOverrideOperators)
+class BoolOperatorRight(object):
+    __slots__ = ()
 
-    for arg in args:
-        accu = binary_and(accu, arg)
-        if accu == False:
-            break  # short-circuit
+    def __lt__(self, right):
+        check_is_not_domain_boolean_expression(right)
+        return right
 
-    return accu
 
+# same as above, but for the left-hand side being a domain boolean expression
+class DomainAndRight(object):
+    __slots__ = ('left',)
 
-def operator_or(accu, *args):
-    def binary_or(accu, arg):
-        if is_domain_boolean_expression(accu):
-            arg = arg()
-            check_is_domain_boolean_expression(arg)
-            res = accu.__bool_or__(arg)
-            check_is_domain_boolean_expression(res)
-        else:
-            # standard boolean or evaluation
-            if accu:
-                res = accu
-            else:
-                arg = arg()
-                check_is_not_domain_boolean_expression(arg)
-                res = (accu or arg)  # NOTE, XXX: equivalent to just arg
+    def __init__(self, left):
+        self.left = left
+
+    def __lt__(self, right):
+        check_is_domain_boolean_expression(right)
+        res = self.left.__bool_and__(right)
+        check_is_domain_boolean_expression(res)
         return res
 
-    for arg in args:
-        accu = binary_or(accu, arg)
-        if accu and not is_domain_boolean_expression(accu):
-            break  # short-circuit
 
-    return accu
+class DomainOrRight(DomainAndRight):
+    __slots__ = ()
+
+    def __lt__(self, right):
+        check_is_domain_boolean_expression(right)
+        res = self.left.__bool_or__(right)
+        check_is_domain_boolean_expression(res)
+        return res
+
+
+_bool_operator_right = BoolOperatorRight()
+
+
+# called from modified AST as
+#
+#       None is not _piq_operator_and(left) < right
+#
+# for regular boolean values, this is the same as (left and right), except that
+# a false left-hand side makes the result False; when left is a domain boolean
+# expression, right is always evaluated and the result is
+# left.__bool_and__(right)
+def operator_and(left):
+    if is_domain_boolean_expression(left):
+        return DomainAndRight(left)
+    elif left:
+        return _bool_operator_right
+    else:
+        return None  # short-circuit, the result is False
+
+
+# domain boolean expression on the left-hand side of the "or" operator, whose
+# right-hand side is about to be evaluated
+#
+# NOTE: it is set by operator_or() and taken by operator_or_right() right away,
+# with nothing evaluated in between, so nested expressions and exceptions can't
+# affect it; it is unset or None otherwise
+_bool_state = threading.local()
+
+
+# called from modified AST as
+#
+#       _piq_operator_or(left) or _piq_operator_or_right() < right
+#
+# for regular boolean values, this is the same as (left or right), and the
+# thread-local state is only read when left is false; when left is a domain
+# boolean expression, right is always evaluated and the result is
+# left.__bool_or__(right)
+#
+# NOTE: there is no way to return the left-hand side from a chained comparison
+# without evaluating the right-hand side, that's why "or" needs the state
+def operator_or(left):
+    if is_domain_boolean_expression(left):
+        _bool_state.or_left = left
+        return False
+    else:
+        return left
+
+
+def operator_or_right():
+    left = getattr(_bool_state, 'or_left', None)
+    if left is None:
+        return _bool_operator_right
+    else:
+        _bool_state.or_left = None
+        return DomainOrRight(left)
 
 
 def operator_not(arg):
@@ -432,8 +543,20 @@ def operator_not(arg):
     return res
 
 
+# cache of "in" operator overrides keyed by object class
+_domain_in_classes = {}
+
+
+def is_domain_in_operand(x):
+    cls = x.__class__
+    res = _domain_in_classes.get(cls)
+    if res is None:
+        res = _domain_in_classes[cls] = hasattr(cls, '__in__')
+    return res
+
+
 def operator_in(left, right):
-    if hasattr(left, '__in__'):
+    if is_domain_in_operand(left):
         res = left.__in__(right)
         check_is_domain_boolean_expression(res)
     else:
@@ -450,10 +573,14 @@ def untokenize(tokens):
     #
     # to make it happy, we are forcing it to switch to Untokenizer.compat() on
     # the first token
-    first_token = tokens[0]
-    tokens[0] = (first_token[0], first_token[1])
+    #
+    # NOTE: tokens can be a generator, in which case they are handed to the
+    # untokenizer one by one without accumulating them first
+    tokens = iter(tokens)
+    first_token = next(tokens)
+    first_token = (first_token[0], first_token[1])
 
-    return tokenize.untokenize(tokens)
+    return tokenize.untokenize(itertools.chain([first_token], tokens))
 
 
 def parse_file(filename):
@@ -480,28 +607,363 @@ def parse_and_transform_file(filename, transform_expressions=True, transform_ope
     return ast
 
 
+def count_ast_nodes(node):
+    return sum(1 for _ in ast.walk(node))
+
+
+# NOTE: exec is a statement in Python 2 and can't be passed around
+def exec_code(code, exec_globals):
+    exec(code, exec_globals)
+
+
+# runtime bindings referenced from the modified AST
+runtime_globals = dict(
+    _piq_wrap_object = wrap_object,
+    _piq_make_name = make_name,
+    _piq_make_named = make_named,
+    _piq_make_splice = make_splice,
+
+    _piq_operator_and = operator_and,
+    _piq_operator_or = operator_or,
+    _piq_operator_or_right = operator_or_right,
+    _piq_operator_not = operator_not,
+    _piq_operator_in = operator_in,
+)
+
+
+# the value of the last top-level expression statement is stored in this
+# global variable; it is removed from the globals once the program has run
+RESULT_NAME = '_piq_result'
+
+
+def capture_result(module_ast):
+    body = module_ast.body
+    if body and isinstance(body[-1], ast.Expr):
+        expr = body[-1]
+        target = ast.copy_location(ast.Name(id=RESULT_NAME, ctx=ast.Store()), expr)
+        body[-1] = ast.copy_location(ast.Assign(targets=[target], value=expr.value), expr)
+    return module_ast
+
+
+# name of the function that streams values out of a running program
+EMIT_NAME = 'emit'
+
+# same as emit(), but for values of top-level expression statements; None
+# values, e.g. results of calls made for their side effects, are not emitted
+EMIT_EXPRESSION_NAME = '_piq_emit_expression'
+
+
+# turn top-level expression statements, except for the module docstring, into
+# _piq_emit_expression() calls
+def transform_emit_expressions(module_ast):
+    def make_emit_node(expr):
+        def make_node(new_node):
+            return ast.copy_location(new_node, expr)
+
+        func = make_node(ast.Name(id=EMIT_EXPRESSION_NAME, ctx=ast.Load()))
+        return make_node(ast.Expr(value=make_node(ast.Call(
+            func=func,
+            args=[expr.value],
+            keywords=[]
+        ))))
+
+    body = module_ast.body
+    if body and isinstance(body[0], ast.Expr) and is_string_literal(body[0].value):
+        docstring = body[:1]
+        body = body[1:]
+    else:
+        docstring = []
+
+    module_ast.body = docstring + [
+        make_emit_node(x) if isinstance(x, ast.Expr) else x
+        for x in body
+    ]
+    return module_ast
+
+
+def is_string_literal(expr):
+    # NOTE: expressions may be wrapped by AstExprWrapper
+    if isinstance(expr, ast.Call) and isinstance(expr.func, ast.Name) and expr.func.id == '_piq_wrap_object':
+        expr = expr.args[0]
+    return isinstance(expr, ast.Str)
+
+
+# compiled piq program that can be executed many times
+#
+# programs compiled with emit_expressions=True can only be run by stream()
+class Program(object):
+    def __init__(self, filename, code, emit_expressions=False):
+        self.filename = filename
+        self.code = code
+        self.emit_expressions = emit_expressions
+
+    def execute(self, user_globals=None):
+        self.check_not_streamed()
+        exec_globals = self.do_execute(user_globals)
+        exec_globals.pop(RESULT_NAME, None)
+        return exec_globals
+
+    def do_execute(self, user_globals=None):
+        if user_globals is not None:
+            assert isinstance(user_globals, dict)
+            exec_globals = user_globals
+        else:
+            exec_globals = {}
+
+        exec_globals.update(runtime_globals)
+
+        piqi_profile.run_stage('exec', None, exec_code, self.code, exec_globals)
+
+        return exec_globals
+
+    # execute the program and return piq AST of its result, which is either
+    # the global variable called result_name or the value of the last
+    # top-level expression statement; None is returned if there is no result
+    def run(self, user_globals=None, result_name=None):
+        self.check_not_streamed()
+        exec_globals = self.do_execute(user_globals)
+
+        if result_name is None:
+            result_name = RESULT_NAME
+
+        try:
+            if result_name not in exec_globals:
+                return None
+            else:
+                return piq.parse(exec_globals[result_name])
+        finally:
+            exec_globals.pop(RESULT_NAME, None)
+
+    # execute the program passing piq AST of every emit()-ed value to the
+    # consumer as soon as it is emitted, i.e. without accumulating them
+    def stream(self, consumer, user_globals=None):
+        def emit(x):
+            consumer(piq.parse(x))
+
+        def emit_expression(x):
+            if piq.unwrap_object(x) is not None:
+                consumer(piq.parse(x))
+
+        if user_globals is not None:
+            assert isinstance(user_globals, dict)
+            exec_globals = user_globals
+        else:
+            exec_globals = {}
+
+        exec_globals[EMIT_NAME] = emit
+        exec_globals[EMIT_EXPRESSION_NAME] = emit_expression
+
+        # NOTE: not leaving emit functions bound to this consumer in the
+        # caller's globals
+        try:
+            self.do_execute(exec_globals)
+        finally:
+            exec_globals.pop(EMIT_NAME, None)
+            exec_globals.pop(EMIT_EXPRESSION_NAME, None)
+            exec_globals.pop(RESULT_NAME, None)
+
+    def check_not_streamed(self):
+        if self.emit_expressions:
+            raise TypeError(self.filename + ': program compiled with emit_expressions=True can only be run by stream()')
+
+
+# when emit_expressions is True, top-level expression statements are emitted
+# the same way as explicit emit() calls when the program is streamed, except
+# for the module docstring and None values (see transform_emit_expressions)
+def compile_file(filename, transform_operators=False, emit_expressions=False):
+    transformed_ast = piqi_profile.run_stage(
+            'piq_transform', count_ast_nodes,
+            parse_and_transform_file, filename, transform_operators=transform_operators)
+
+    if emit_expressions:
+        transformed_ast = transform_emit_expressions(transformed_ast)
+    else:
+        transformed_ast = capture_result(transformed_ast)
+
+    code = piqi_profile.run_stage('compile', None, compile, transformed_ast, filename, 'exec')
+    return Program(filename, code, emit_expressions)
+
+
 def exec_file(filename, user_globals=None, transform_operators=False):
-    transformed_ast = parse_and_transform_file(filename, transform_operators=transform_operators)
+    program = compile_file(filename, transform_operators=transform_operators)
+    program.execute(user_globals)
+
+
+# compiled programs keyed by (path, options), each stored along with the
+# (mtime, size) stamp of the source file it was compiled from
+_program_cache = {}
 
-    if user_globals is not None:
-        assert isinstance(user_globals, dict)
-        exec_globals = user_globals
+
+# version of the AST transformations; programs cached on disk refer to runtime
+# bindings by name, so it changes whenever the modified AST does
+TRANSFORM_VERSION = 2
+
+
+# same as compile_file(), but reuses programs compiled earlier in this process
+# or, if cache_dir is specified, stored on disk by any other process
+def load_program(filename, transform_operators=False, cache_dir=None):
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size)
+    key = (os.path.abspath(filename), transform_operators)
+
+    cached = _program_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    program = None
+    if cache_dir is not None:
+        # NOTE: marshal format depends on Python version
+        cache_key = repr((sys.version, TRANSFORM_VERSION, key))
+        cache_filename = os.path.join(cache_dir, hashlib.sha1(cache_key).hexdigest() + '.piqc')
+
+        code = load_cached_code(cache_filename, stamp)
+        if code is not None:
+            program = Program(filename, code)
+
+    if program is None:
+        program = compile_file(filename, transform_operators=transform_operators)
+
+        if cache_dir is not None:
+            # NOTE: the cache is an optimization, failing to write to it
+            # doesn't fail the program
+            try:
+                store_cached_code(cache_filename, stamp, program.code)
+            except (IOError, OSError) as e:
+                sys.stderr.write('warning: failed to cache compiled ' + filename + ': ' + str(e) + '\n')
+
+    _program_cache[key] = (stamp, program)
+    return program
+
+
+def load_cached_code(cache_filename, stamp):
+    try:
+        with open(cache_filename, 'rb') as f:
+            cached_stamp, code = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    if tuple(cached_stamp) == stamp:
+        return code
     else:
-        exec_globals = {}
+        return None
+
+
+def store_cached_code(cache_filename, stamp, code):
+    # write to a temporary file first, so that concurrent readers never see a
+    # partially written file
+    tmp_filename = cache_filename + '.' + str(os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        marshal.dump((stamp, code), f)
+    os.rename(tmp_filename, cache_filename)
 
-    exec_globals.update(dict(
-        _piq_wrap_object = wrap_object,
-        _piq_make_name = make_name,
-        _piq_make_named = make_named,
-        _piq_make_splice = make_splice,
 
-        _piq_operator_and = operator_and,
-        _piq_operator_or = operator_or,
-        _piq_operator_not = operator_not,
-        _piq_operator_in = operator_in,
-    ))
+def format_error(filename, loc, error):
+    line = str(loc.line) if loc else 'unknown'
+    return filename + ':' + line + ': ' + error
 
-    exec(compile(transformed_ast, filename, 'exec'), exec_globals)
+
+# list script files to be processed in batch mode; directories are searched
+# recursively for files ending with the suffix
+def find_batch_files(paths, suffix='.py'):
+    res = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.endswith(suffix):
+                        res.append(os.path.join(dirpath, name))
+        else:
+            res.append(path)
+    return res
+
+
+# batch worker state, initialized separately in each worker process
+_batch_cache_dir = None
+_batch_transform_operators = True
+
+
+def init_batch_worker(cache_dir, transform_operators):
+    global _batch_cache_dir, _batch_transform_operators
+    _batch_cache_dir = cache_dir
+    _batch_transform_operators = transform_operators
+
+
+# evaluate a single file in batch mode, return (is_ok, output_line)
+def batch_run_file(filename):
+    try:
+        program = load_program(filename, transform_operators=_batch_transform_operators, cache_dir=_batch_cache_dir)
+        res = program.run()
+        return True, filename + ': ' + repr(res)
+    except piq.ParseError as e:
+        return False, format_error(filename, e.loc, e.error)
+    except SyntaxError as e:
+        loc = piq.make_loc((e.lineno, e.offset)) if e.lineno else None
+        return False, format_error(filename, loc, 'syntax error: ' + str(e.msg))
+    except Exception as e:
+        return False, filename + ': ' + type(e).__name__ + ': ' + str(e)
+
+
+# evaluate files in parallel processes, or in this process when jobs is 1
+#
+# each file is evaluated once, so compiled programs are stored on disk only
+# when cache_dir is specified, i.e. to be reused by later batches (see
+# load_program)
+def run_batch(paths, jobs=None, cache_dir=None, suffix='.py', output=sys.stdout, transform_operators=True):
+    filenames = find_batch_files(paths, suffix=suffix)
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    start_time = time.time()
+
+    if jobs == 1:
+        init_batch_worker(cache_dir, transform_operators)
+        pool = None
+        results = itertools.imap(batch_run_file, filenames)
+    else:
+        pool = multiprocessing.Pool(jobs, init_batch_worker, (cache_dir, transform_operators))
+        results = pool.imap(batch_run_file, filenames, chunksize=16)
+
+    try:
+        error_count = 0
+        for is_ok, line in results:
+            if not is_ok:
+                error_count += 1
+            output.write(line + '\n')
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        # NOTE: stops the workers when consuming the results fails, e.g. on
+        # KeyboardInterrupt; does nothing once they have exited
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = time.time() - start_time
+
+    total_bytes = 0
+    for filename in filenames:
+        try:
+            total_bytes += os.path.getsize(filename)
+        except OSError:
+            pass
+
+    file_count = len(filenames)
+    if elapsed > 0:
+        files_per_sec = file_count / elapsed
+        mb_per_sec = total_bytes / elapsed / (1024 * 1024)
+    else:
+        files_per_sec = mb_per_sec = 0.0
+
+    sys.stderr.write(
+        "processed {} files ({} failed, {} bytes) in {:.3f}s: {:.1f} files/s, {:.2f} MB/s\n".format(
+            file_count, error_count, total_bytes, elapsed, files_per_sec, mb_per_sec
+        )
+    )
+
+    return error_count
 
 
 def main():
@@ -515,6 +977,22 @@ def main():
 
     arg_abstract_output = False
 
+    # whether to override operators when evaluating scripts
+    arg_exec_transform_operators = True
+
+    arg_batch = False
+    arg_jobs = None
+    arg_cache_dir = None
+    arg_suffix = '.py'
+
+    arg_profile = False
+    arg_profile_lines = False
+    arg_profile_gc = False
+
+    # piqi type to parse the result of the script as, e.g. for profiling
+    arg_piqi_module = None
+    arg_piqi_type = None
+
 
     args = sys.argv[1:]
 
@@ -545,12 +1023,50 @@ def main():
             arg_transform_operators = True
         elif a in ['-a', '--abstract-output']:
             arg_abstract_output = True
+        elif a == '--no-transform-operators':
+            arg_exec_transform_operators = False
+        elif a in ['-b', '--batch']:
+            arg_batch = True
+        elif a in ['-j', '--jobs']:
+            i += 1
+            arg_jobs = int(args[i])
+        elif a == '--cache-dir':
+            i += 1
+            arg_cache_dir = args[i]
+        elif a == '--profile':
+            arg_profile = True
+        elif a == '--profile-lines':
+            arg_profile_lines = True
+        elif a == '--profile-gc':
+            # NOTE: disables garbage collection in profiled stages, see
+            # piqi_profile
+            arg_profile = True
+            arg_profile_gc = True
+        elif a == '--piqi-module':
+            i += 1
+            arg_piqi_module = args[i]
+        elif a == '--piqi-type':
+            i += 1
+            arg_piqi_type = args[i]
+        elif a == '--suffix':
+            i += 1
+            arg_suffix = args[i]
         elif a.startswith('-'):
             pass
         else:
             break  # positional argument
         i += 1
 
+    if arg_batch:
+        # all remaining arguments are files or directories
+        error_count = run_batch(
+                args[i:],
+                jobs=arg_jobs,
+                cache_dir=arg_cache_dir,
+                suffix=arg_suffix,
+                transform_operators=arg_exec_transform_operators)
+        sys.exit(1 if error_count else 0)
+
     positional_arg = args[i]
     filename = positional_arg
 
@@ -594,11 +1110,43 @@ def main():
         print_ast(transformed_ast)
     else:
         # XXX
+        profiler = piqi_profile.profile(count_gc_objects=arg_profile_gc)
+        location_profiler = piqi_profile.profile_locations(filename)
+
+        def parse_result(res):
+            if arg_piqi_type is not None and res is not None:
+                piqi.parse(res, arg_piqi_module, arg_piqi_type)
+
+        if (arg_piqi_module is None) != (arg_piqi_type is None):
+            sys.exit('--piqi-module and --piqi-type must be specified together')
+        if arg_piqi_module is not None:
+            # NOTE: the module must be importable, e.g. from PYTHONPATH; it is
+            # imported before running, so that importing it isn't profiled
+            importlib.import_module(arg_piqi_module)
         try:
-            exec_file(filename, transform_operators=True)
-        except piq.ParseError as e:
-            sys.stderr.write(filename + ':' + str(loc.line) + ': ' + error)
+            if arg_profile:
+                # NOTE: compile and typing stages are profiled along with
+                # execution
+                with profiler:
+                    program = compile_file(filename, transform_operators=arg_exec_transform_operators)
+                    parse_result(program.run())
+            elif arg_profile_lines:
+                program = compile_file(filename, transform_operators=arg_exec_transform_operators)
+                with location_profiler:
+                    parse_result(program.run())
+            elif arg_piqi_type is not None:
+                program = compile_file(filename, transform_operators=arg_exec_transform_operators)
+                parse_result(program.run())
+            else:
+                exec_file(filename, transform_operators=arg_exec_transform_operators)
+        except (piq.ParseError, piqi.ParseError) as e:
+            sys.stderr.write(format_error(filename, e.loc, e.error) + '\n')
             sys.exit(1)
+        finally:
+            if arg_profile:
+                sys.stderr.write(profiler.format_report())
+            if arg_profile_lines:
+                sys.stderr.write(location_profiler.format_report(limit=20))
 
 
 if __name__ == '__main__':
@@ -1,9 +1,14 @@
 import sys
+import array
+import binascii
+import collections
 import wrappers
 
 import piqi_of_piq
 import piqi_of_json
+import piqi_of_pb
 import piqi_to_json
+import piqi_to_pb
 
 
 # parse state
@@ -42,42 +47,477 @@ def unwrap_object(x):
         return x
 
 
+# fields: [(name, value)] in the order of the record's field specs
 def make_record(fields, piqi_type, loc=None):
-    obj = Record(fields)
+    record_class = get_record_class(piqi_type)
+    if record_class is None:
+        obj = Record(fields)
+    else:
+        obj = record_class(*[value for _, value in fields])
     return ObjectProxy(obj, piqi_type, loc)
 
+# NOTE: numeric arrays (see make_numeric_array) are kept as they are
 def make_list(items, piqi_type, loc=None):
-    obj = List(items)
+    if isinstance(items, list):
+        obj = List(items)
+    else:
+        obj = items
     return ObjectProxy(obj, piqi_type, loc)
 
+# see piqi_of_json.parse_projected()
+def make_lazy_record(typedef, json_obj, rest, numeric_arrays=None, loc=None):
+    obj = LazyRecord(typedef, json_obj, _parse_piqi_module, rest, numeric_arrays)
+    return ObjectProxy(obj, typedef['name'], loc)
+
 def make_variant(tag, value, piqi_type, loc=None):
-    obj = Variant((Tag(tag), value))
+    obj = Variant((intern_tag(tag, piqi_type, Tag), value))
     return ObjectProxy(obj, piqi_type, loc)
 
 def make_enum(tag, piqi_type, loc=None):
-    obj = Enum(tag)
+    obj = intern_tag(tag, piqi_type, Enum)
     return ObjectProxy(obj, piqi_type, loc)
 
 def make_scalar(value, loc=None):
+    if loc is None and _scalar_cache is not None:
+        return _scalar_cache.get(value)
     # XXX: why piqi_type would be None?
     return ObjectProxy(value, None, loc)
 
+
+# proxy shared by all occurrences of a scalar, see ScalarCache; attributes
+# can't be set or deleted after it is created
+class SharedObjectProxy(ObjectProxy):
+    _self_frozen = False
+
+    def __init__(self, wrapped, piqi_type, loc):
+        super(SharedObjectProxy, self).__init__(wrapped, piqi_type, loc)
+        self._self_frozen = True
+
+    def __setattr__(self, name, value):
+        if self._self_frozen:
+            raise AttributeError('shared scalar proxy is read-only')
+        super(SharedObjectProxy, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError('shared scalar proxy is read-only')
+
+
+# shared proxies of scalars without location
+#
+# like other proxies, cached proxies are bound to the piqi module being parsed;
+# a proxy cached while parsing with another module is replaced, i.e. there is
+# a single proxy per value, that of the module used last
+#
+# the cache is split into two generations each holding up to size / 2 proxies:
+# new proxies go to the young generation; when it is full, it becomes the old
+# one and the previous old generation is dropped; proxies found in the old
+# generation are moved back to the young one. This approximates LRU eviction
+# without bookkeeping on cache hits.
+class ScalarCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.young = {}
+        self.old = {}
+
+    def get(self, value):
+        proxy = self.young.get(value)
+        if proxy is None or proxy._self_piqi_module is not _parse_piqi_module:
+            proxy = self.old.get(value)
+            if proxy is None or proxy._self_piqi_module is not _parse_piqi_module:
+                if not is_cacheable_scalar(value):
+                    return ObjectProxy(value, None, None)
+                proxy = SharedObjectProxy(value, None, None)
+
+            if len(self.young) >= self.size // 2:
+                self.old = self.young
+                self.young = {}
+            self.young[value] = proxy
+
+        # NOTE: True == 1 == 1.0, and they all have the same hash
+        if type(proxy.__wrapped__) is not type(value):
+            return ObjectProxy(value, None, None)
+
+        return proxy
+
+
+# longer strings are not cached
+MAX_CACHED_STRING_LENGTH = 64
+
+# ints outside of [-MAX_CACHED_INT, MAX_CACHED_INT] are not cached
+MAX_CACHED_INT = 1024
+
+
+# NOTE: floats and large ints rarely repeat, caching them would only churn the
+# cache
+def is_cacheable_scalar(x):
+    if isinstance(x, basestring):
+        return len(x) <= MAX_CACHED_STRING_LENGTH
+    elif isinstance(x, (int, long)):  # including bool
+        return -MAX_CACHED_INT <= x <= MAX_CACHED_INT
+    else:
+        return False
+
+
+# maximum number of cached scalar proxies
+SCALAR_CACHE_SIZE = 4096
+
+_scalar_cache = ScalarCache(SCALAR_CACHE_SIZE)
+
+
+# set the maximum number of cached scalar proxies; 0 disables caching
+def set_scalar_cache_size(size):
+    global _scalar_cache
+    if size > 0:
+        _scalar_cache = ScalarCache(size)
+    else:
+        _scalar_cache = None
+
+
+# binary values are bytearray objects or memoryview slices of the input buffer
+#
+# NOTE: they are never cached, because bytearrays can be modified in place and
+# memoryviews are not hashable; views keep the whole input buffer alive
+def make_binary(value, loc=None):
+    return ObjectProxy(value, None, loc)
+
+
+def is_binary(x):
+    return isinstance(x, (bytearray, memoryview))
+
+
+# numeric arrays
+#
+# with parse(..., numeric_arrays=...), repeated fields and lists of int and
+# float types are array.array or numpy arrays instead of lists of scalar
+# proxies
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# built-in type -> array.array typecode
+#
+# NOTE: floats are always doubles, i.e. values are the same as those parsed
+# into scalars; values that don't fit, e.g. ints above 64 bits, are parsed into
+# lists as usual
+ARRAY_TYPECODES = {
+    'int': 'l',
+    'uint': 'L',
+    'int32': 'i',
+    'uint32': 'I',
+    'int64': 'l',
+    'uint64': 'L',
+    'int32-fixed': 'i',
+    'uint32-fixed': 'I',
+    'int64-fixed': 'l',
+    'uint64-fixed': 'L',
+    'protobuf-int32': 'i',
+    'protobuf-int64': 'l',
+    'float': 'd',
+    'float32': 'd',
+    'float64': 'd',
+}
+
+
+if numpy is None:
+    NUMERIC_ARRAY_TYPES = (array.array,)
+else:
+    NUMERIC_ARRAY_TYPES = (array.array, numpy.ndarray)
+
+
+# make numeric array of kind 'array' or 'numpy' from a sequence of values;
+# raises TypeError if there are values of other types and OverflowError if
+# they don't fit
+#
+# NOTE: values are checked in bulk by array.array(); numpy arrays share its
+# buffer (numpy dtypes have the same character codes), so that e.g. numeric
+# strings are not converted silently
+def make_numeric_array(typecode, values, kind='array'):
+    if isinstance(values, array.array) and values.typecode == typecode:
+        res = values
+    else:
+        res = array.array(typecode, values)
+    if kind == 'numpy':
+        res = numpy.frombuffer(res, dtype=typecode)
+    return res
+
+
+def is_numeric_array(x):
+    return isinstance(x, NUMERIC_ARRAY_TYPES)
+
+
+# return array typecode of the type's values, or None if they are not numbers
+def get_array_typecode(typename, piqi_module=None):
+    if piqi_module is None:
+        piqi_module = _parse_piqi_module
+    return get_module_table(piqi_module, 'array_typecodes', make_array_typecodes_table).get(typename)
+
+
+# return typename -> array typecode for all numeric built-in types and aliases
+# of typedef_index
+def make_array_typecodes_table(typedef_index):
+    res = dict(ARRAY_TYPECODES)
+
+    def do_unalias(typename):
+        if typename in ARRAY_TYPECODES or is_piqi_type(typename):
+            return ARRAY_TYPECODES.get(typename)
+        type_tag, typedef = typedef_index[typename]
+        if type_tag == 'alias':
+            return do_unalias(typedef['type'])
+        else:
+            return None
+
+    for typename in typedef_index:
+        typecode = do_unalias(typename)
+        if typecode is not None:
+            res[typename] = typecode
+    return res
+
+
+# base64 is decoded and encoded in chunks of this many characters, so that
+# large binary values are not copied as a whole on the way; must be a multiple
+# of 4
+BASE64_CHUNK_SIZE = 64 * 1024
+
+
+# decode base64 string into a new bytearray; raises ValueError on invalid input
+def b64decode(x):
+    if isinstance(x, unicode):
+        try:
+            x = x.encode('ascii')
+        except UnicodeEncodeError:
+            raise ValueError('non-ascii character')
+
+    size = len(x)
+    if size % 4:
+        raise ValueError('incorrect padding')
+    res_size = size // 4 * 3
+    if size and x[-1] == '=':
+        res_size -= 1 + (x[-2] == '=')
+
+    res = bytearray(res_size)
+    view = memoryview(x)
+    pos = 0
+    for start in xrange(0, size, BASE64_CHUNK_SIZE):
+        try:
+            chunk = binascii.a2b_base64(view[start:start + BASE64_CHUNK_SIZE])
+        except binascii.Error as e:
+            raise ValueError(str(e))
+        res[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+
+    # NOTE: a2b_base64() skips invalid characters
+    if pos != res_size:
+        raise ValueError('invalid character')
+    return res
+
+
+# encode binary value (bytearray, memoryview or str) as base64 string
+def b64encode(x):
+    view = memoryview(x)
+    step = BASE64_CHUNK_SIZE // 4 * 3
+    # NOTE: b2a_base64() appends a newline to every chunk
+    chunks = [binascii.b2a_base64(view[i:i + step])[:-1] for i in xrange(0, len(view), step)]
+    return ''.join(chunks)
+
+
 def make_any(loc=None, **kwargs):
     obj = Any(**kwargs)
     return ObjectProxy(obj, 'piqi-any', loc)
 
 
+# builders of parsed values
+#
+# the parsers (piqi_of_piq, piqi_of_json) resolve fields, options and scalars
+# and pass the results to a builder: ObjectBuilder makes piqi objects,
+# piqi_to_json.JsonBuilder makes JSON values (see convert()) and
+# ValidationBuilder makes nothing at all (see validate())
+#
+# NOTE: builders must never return None for parsed values, None means that
+# try-parsing has failed
+class ObjectBuilder(object):
+    def make_scalar(self, x, loc=None):
+        return make_scalar(x, loc)
+
+    def make_binary(self, x, loc=None):
+        return make_binary(x, loc)
+
+    # values: field values in the order of t['field']
+    def make_record(self, t, values, loc=None):
+        fields = [
+            (make_field_name(field_spec), value)
+            for field_spec, value in zip(t['field'], values)
+        ]
+        return make_record(fields, t['name'], loc)
+
+    def make_list(self, t, items, loc=None):
+        return make_list(items, t['name'], loc)
+
+    def make_variant(self, t, tag, value, loc=None):
+        return make_variant(tag, value, t['name'], loc)
+
+    def make_enum(self, t, tag, loc=None):
+        return make_enum(tag, t['name'], loc)
+
+    def make_any(self, loc=None, **kwargs):
+        return make_any(loc, **kwargs)
+
+    def parse_default(self, field_type, default):
+        return piqi_of_json.parse_default(field_type, default)
+
+
+OBJECT_BUILDER = ObjectBuilder()
+
+
+# the only value made by ValidationBuilder
+VALID = object()
+
+
+class ValidationBuilder(object):
+    def make_scalar(self, x, loc=None):
+        return VALID
+
+    def make_binary(self, x, loc=None):
+        return VALID
+
+    def make_record(self, t, values, loc=None):
+        return VALID
+
+    def make_list(self, t, items, loc=None):
+        return VALID
+
+    def make_variant(self, t, tag, value, loc=None):
+        return VALID
+
+    def make_enum(self, t, tag, loc=None):
+        return VALID
+
+    def make_any(self, loc=None, **kwargs):
+        return VALID
+
+    # NOTE: defaults come from the schema and don't need validation
+    def parse_default(self, field_type, default):
+        return VALID
+
+
+VALIDATION_BUILDER = ValidationBuilder()
+
+
 # representation of a generic piqi object
 #
 # as e.g. returned by piqi_of_piq.parse()
 
-class Record(object):
+# base class of all records
+#
+# records are instances of Record, whose fields are kept in the instance
+# __dict__, or, for modules generated by piqic-python, of SlottedRecord
+# subclasses (see get_record_class)
+class BaseRecord(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return repr(dict(record_fields(self)))
+
+
+class Record(BaseRecord):
     def __init__(self, fields):
         for name, value in fields:
             self.__setattr__(name, value)
 
-    def __repr__(self):
-        return repr(vars(self))
+
+# base class of record classes generated by piqic-python
+#
+# subclasses define __slots__ named after the record's fields (see
+# make_field_name) and a constructor taking field values in the order of field
+# specs; modules list them in their record_classes dict
+class SlottedRecord(BaseRecord):
+    __slots__ = ()
+
+
+# record over its JSON object, whose fields are decoded when they are accessed
+# for the first time and are then kept in the instance __dict__ (see
+# piqi_of_json.parse_projected)
+class LazyRecord(Record):
+    __slots__ = ('_piqi_typedef', '_piqi_json', '_piqi_module', '_piqi_rest', '_piqi_numeric_arrays')
+
+    def __init__(self, typedef, json_obj, piqi_module, rest, numeric_arrays=None):
+        self._piqi_typedef = typedef
+        self._piqi_json = json_obj
+        self._piqi_module = piqi_module
+        # projection of the fields that are decoded on access
+        self._piqi_rest = rest
+        # numeric_arrays option of parse()
+        self._piqi_numeric_arrays = numeric_arrays
+
+    # NOTE: called only for fields that haven't been decoded yet
+    def __getattr__(self, name):
+        if name.startswith('_piqi_'):
+            raise AttributeError(name)
+        value = piqi_of_json.parse_lazy_field(self, name)
+        self.__dict__[name] = value
+        return value
+
+
+# return [(name, value)] of record's fields
+#
+# NOTE: fields of lazy records are decoded
+def record_fields(x):
+    if isinstance(x, LazyRecord):
+        names = get_field_specs(x._piqi_typedef['name'], x._piqi_module)
+        return [(name, getattr(x, name)) for name in names]
+    elif isinstance(x, Record):
+        return vars(x).items()
+    else:
+        return [(name, getattr(x, name)) for name in type(x).__slots__]
+
+
+# count objects of piqi object graph
+def count_objects(x):
+    x = unwrap_object(x)
+    if x is None:
+        return 0
+    elif isinstance(x, LazyRecord):
+        # NOTE: counting only decoded fields, i.e. without decoding the rest
+        return 1 + sum(count_objects(v) for v in vars(x).itervalues())
+    elif isinstance(x, BaseRecord):
+        return 1 + sum(count_objects(v) for _, v in record_fields(x))
+    elif isinstance(x, list):  # piqi.List or repeated field
+        return int(isinstance(x, List)) + sum(count_objects(v) for v in x)
+    elif is_numeric_array(x):
+        return len(x)
+    elif isinstance(x, Variant):
+        return 1 + count_objects(x[1])
+    else:
+        return 1
+
+
+# return field name (see make_field_name) -> field spec of the record type in
+# the order of declaration
+def get_field_specs(typename, piqi_module=None):
+    if piqi_module is None:
+        piqi_module = _parse_piqi_module
+    return get_module_table(piqi_module, 'field_specs', make_field_specs_table)[typename]
+
+
+def make_field_specs_table(typedef_index):
+    res = {}
+    for typename, (type_tag, typedef) in typedef_index.iteritems():
+        if type_tag == 'record':
+            res[typename] = collections.OrderedDict(
+                (make_field_name(f), f) for f in typedef['field']
+            )
+    return res
+
+
+# return generated class for the record type, or None if there isn't one
+def get_record_class(typename, piqi_module=None):
+    if piqi_module is None:
+        piqi_module = _parse_piqi_module
+    record_classes = getattr(piqi_module, 'record_classes', None)
+    if record_classes is None:
+        return None
+    return record_classes.get(typename)
 
 
 class List(list):
@@ -106,6 +546,86 @@ def make_name(x):
     return str(x).replace('-', '_')
 
 
+# interned tags of variant and enum options
+#
+# there is a single Tag or Enum object per option; modules generated by
+# piqic-python create them when they are loaded (see get_option_tags), for
+# other modules they are created on first use
+class OptionTags(object):
+    def __init__(self, type_tag, typedef):
+        tag_class = Enum if type_tag == 'enum' else Tag
+
+        # option name -> Tag or Enum
+        self.tags = {}
+        # Tag or Enum -> option spec
+        #
+        # NOTE: lookups of interned tags succeed on identity check
+        self.option_specs = {}
+
+        for option_spec in typedef['option']:
+            name = name_of_option(option_spec)
+            tag = tag_class(name)
+            self.tags[name] = tag
+            self.option_specs[tag] = option_spec
+
+
+# return typename -> OptionTags for all variants and enums of typedef_index
+def make_interned_tags(typedef_index):
+    res = {}
+    for typename, (type_tag, typedef) in typedef_index.iteritems():
+        if type_tag in ('variant', 'enum'):
+            res[typename] = OptionTags(type_tag, typedef)
+    return res
+
+
+# return the table derived from the schema module's typedef index, creating it
+# with make_table(typedef_index) on first use
+#
+# the table is stored in the module as attribute 'name' and is recreated when
+# the module's typedef index is replaced, e.g. when the module is reloaded
+def get_module_table(piqi_module, name, make_table):
+    typedef_index = piqi_module.typedef_index
+    table = getattr(piqi_module, name, None)
+    if table is None or table[0] is not typedef_index:
+        table = make_module_table(typedef_index, make_table)
+        setattr(piqi_module, name, table)
+    return table[1]
+
+
+# return the value of the module attribute holding the table, for modules that
+# create the table when they are loaded
+def make_module_table(typedef_index, make_table):
+    return (typedef_index, make_table(typedef_index))
+
+
+# return the cache of parsed default values of optional fields: id(default
+# spec) -> value (see piqi_of_json.parse_default)
+def get_default_values(piqi_module=None):
+    if piqi_module is None:
+        piqi_module = _parse_piqi_module
+    return get_module_table(piqi_module, 'default_values', lambda _: {})
+
+
+# return OptionTags of the variant or enum type, or None if the type is unknown
+def get_option_tags(typename, piqi_module=None):
+    if piqi_module is None:
+        piqi_module = _parse_piqi_module
+        if piqi_module is None:
+            return None
+
+    interned_tags = get_module_table(piqi_module, 'interned_tags', make_interned_tags)
+    return interned_tags.get(typename)
+
+
+def intern_tag(name, piqi_type, tag_class):
+    option_tags = get_option_tags(piqi_type)
+    if option_tags is not None:
+        tag = option_tags.tags.get(name)
+        if tag is not None:
+            return tag
+    return tag_class(name)
+
+
 def make_field_name(field_spec):
     piqi_name = name_of_field(field_spec)
     name = make_name(piqi_name)
@@ -126,40 +646,69 @@ class Any(object):
 
 
 #class ParseError(Exception):
+#
+# path: path to the invalid value, in the same form as in LocationTable
 class ParseError(RuntimeError):
-    def __init__(self, loc, error):
-        line = str(loc.line) if loc else 'unknown'
-        RuntimeError.__init__(self, line + ': ' + error)
+    def __init__(self, loc, error, path=()):
+        if loc:
+            where = str(loc.line)
+        elif path:
+            where = format_path(path)
+        else:
+            where = 'unknown'
+        RuntimeError.__init__(self, where + ': ' + error)
         self.error = error
         self.loc = loc
+        self.path = path
     def __repr__(self):
-        return error
+        return 'ParseError(' + repr(str(self)) + ')'
 
 
-# return one of built-in types, or None for user-defined types
+# format path as e.g. foo.bar_list[3].baz
+def format_path(path):
+    res = []
+    for x in path:
+        if isinstance(x, (int, long)):
+            res.append('[' + str(x) + ']')
+        else:
+            if res:
+                res.append('.')
+            res.append(str(x))
+    return ''.join(res)
+
+
+# built-in type name -> piqi type
 #
 # TODO: don't hardcode built-in piqi types, grab them from piqi self-spec as
 # others piqic do
+PIQI_TYPES = {
+    'bool': 'bool',
+    'string': 'string',
+    'binary': 'binary',
+    'piqi-any': 'any',
+
+    'int': 'int',
+    'uint': 'int',
+    'int32': 'int',
+    'uint32': 'int',
+    'int64': 'int',
+    'uint64': 'int',
+    'int32-fixed': 'int',
+    'uint32-fixed': 'int',
+    'int64-fixed': 'int',
+    'uint64-fixed': 'int',
+    'protobuf-int32': 'int',
+    'protobuf-int64': 'int',
+
+    'float32': 'float',
+    'float64': 'float',
+    'float': 'float',
+}
+
+
+# return one of built-in types, or None for user-defined types
 def get_piqi_type(typename):
-    piqi_type = None
-    if typename == 'bool':
-        piqi_type = 'bool'
-    elif typename == 'string':
-        piqi_type = 'string'
-    elif typename == 'binary':
-        piqi_type = 'binary'
-    elif typename == 'piqi-any':
-        piqi_type = 'any'
-    elif typename in ('int', 'uint',
-                        'int32', 'uint32',
-                        'int64', 'uint64',
-                        'int32-fixed', 'uint32-fixed',
-                        'int64-fixed', 'uint64-fixed',
-                        'protobuf-int32', 'protobuf-int64'):
-        piqi_type = 'int'
-    elif typename in ('float32', 'float64', 'float'):
-        piqi_type = 'float'
-    return piqi_type
+    return PIQI_TYPES.get(typename)
 
 
 def is_piqi_type(typename):
@@ -175,16 +724,119 @@ def name_of_option(t):
     return t.get('name', t.get('type'))
 
 
+# return (piqi type, None) for built-in types and (type tag, typedef) for
+# user-defined types, following aliases in both cases
 def unalias(typename):
-    piqi_type = get_piqi_type(typename)
+    # NOTE: this is called for every parsed value, hence the inlined check
+    unalias_table = _unalias_table
+    if unalias_table is None or unalias_table[0] is not _parse_piqi_module.typedef_index:
+        unalias_table = reset_unalias_table()
+    return unalias_table[1][typename]
+
+
+# (typedef index, unalias table) of the module that was used last
+_unalias_table = None
+
+
+def reset_unalias_table():
+    global _unalias_table
+    table = get_unalias_table(_parse_piqi_module)
+    _unalias_table = (_parse_piqi_module.typedef_index, table)
+    return _unalias_table
+
+
+# return typename -> unalias(typename) for all built-in types and all types of
+# typedef_index
+def make_unalias_table(typedef_index):
+    res = dict((name, (piqi_type, None)) for name, piqi_type in PIQI_TYPES.iteritems())
+    for typename in typedef_index:
+        res[typename] = unalias_in_index(typedef_index, typename)
+    return res
+
+
+# return the unalias table of the schema module
+def get_unalias_table(piqi_module=None):
+    if piqi_module is None:
+        piqi_module = _parse_piqi_module
+    return get_module_table(piqi_module, 'unalias_table', make_unalias_table)
+
+
+# schema analysis
+#
+# these functions work on a typedef index alone, i.e. without a loaded module,
+# and are shared by piqic-python and piqi_random
+
+
+# same as unalias(), but for types of typedef_index
+def unalias_in_index(typedef_index, typename):
+    piqi_type = PIQI_TYPES.get(typename)
     if piqi_type:
         return piqi_type, None
+    type_tag, typedef = typedef_index[typename]
+    if type_tag == 'alias':
+        return unalias_in_index(typedef_index, typedef['type'])
     else:
-        type_tag, typedef = res = resolve_type(typename)
-        if type_tag == 'alias':
-            return unalias(typedef['type'])
-        else:
-            return res
+        return type_tag, typedef
+
+
+# whether piqi_of_piq can parse the field's value without a label, same rules
+# as in piqi_of_piq.do_try_parse_field()
+def is_positional_field(typedef_index, field_spec):
+    field_type = field_spec.get('type')
+    if field_type is None:
+        return False  # flags can't be positional
+
+    piq_positional = field_spec.get('piq_positional')
+    if piq_positional == False:
+        return False
+
+    type_tag, _ = unalias_in_index(typedef_index, field_type)
+    if not piq_positional and type_tag in ('record', 'list'):
+        return False
+    else:
+        return True
+
+
+# kinds of piq nodes that can be parsed as a value of the type: 'bool', 'int',
+# 'float', 'string', 'list' and 'name' (i.e. a name or a named value); used for
+# finding positional fields that can be confused with each other
+def piq_node_kinds(typedef_index, typename, visited=None):
+    if visited is None:
+        visited = set()
+
+    type_tag, typedef = unalias_in_index(typedef_index, typename)
+    if type_tag == 'bool':
+        return set(['bool'])
+    elif type_tag == 'int':
+        return set(['int'])
+    elif type_tag == 'float':
+        return set(['int', 'float'])
+    elif type_tag == 'string':
+        # relaxed parsing allows numbers and booleans as strings
+        return set(['string', 'int', 'float', 'bool'])
+    elif type_tag == 'binary':
+        return set(['string'])
+    elif type_tag == 'any':
+        return set(['bool', 'int', 'float', 'string', 'list', 'name'])
+    elif type_tag in ('record', 'list'):
+        return set(['list'])
+    elif type_tag in ('variant', 'enum'):
+        if typedef['name'] in visited:
+            return set()
+        visited.add(typedef['name'])
+
+        res = set()
+        for option_spec in typedef['option']:
+            option_type = option_spec.get('type')
+            if option_spec.get('name') is not None:
+                res.add('name')
+                if not option_type:
+                    res.add('string')  # word as a name in relaxed mode
+            elif option_type:
+                res.update(piq_node_kinds(typedef_index, option_type, visited))
+        return res
+    else:
+        assert False
 
 
 # resolve user-defined type
@@ -194,21 +846,216 @@ def resolve_type(typename, piqi_module=None):
     return piqi_module.typedef_index[typename]
 
 
-def parse(x, module_name, typename, format='piq'):
+# counters: optional piqi_of_piq.ParseCounters() for collecting piq parsing
+# backtracking stats
+#
+# locations: what to do with piq locations of parsed objects:
+#
+#   'keep'  -- keep them in objects (default)
+#   'parse' -- use them only for reporting parse errors
+#   'none'  -- don't use them at all, i.e. parse errors have no locations
+#   LocationTable() -- move them to the table, see strip_locations()
+#
+# lazy: JSON only, make records LazyRecord objects that decode each field on
+# first access; the JSON object must not be modified while they refer to it.
+# Use validate_all() to decode and check everything at once.
+#
+# numeric_arrays: JSON and pb only, 'array' or 'numpy' to parse repeated fields
+# and lists of int and float types into numeric arrays of that kind (see
+# make_numeric_array), including fields decoded lazily
+#
+# NOTE: objects parsed from JSON and pb never have locations
+def parse(x, module_name, typename, format='piq', counters=None, locations='keep', lazy=False, numeric_arrays=None):
+    if lazy and format != 'json':
+        raise ValueError('lazy decoding is supported only for JSON')
+    assert numeric_arrays in (None, 'array', 'numpy')
+    if numeric_arrays == 'numpy' and numpy is None:
+        raise ImportError('numpy is required for numeric_arrays=\'numpy\'')
+
     # init parsing state
     global _parse_piqi_module
     _parse_piqi_module = sys.modules[module_name]
 
     if format == 'piq':
-        return piqi_of_piq.parse(typename, x)
+        if isinstance(locations, LocationTable):
+            res = piqi_of_piq.parse(typename, x, counters=counters)
+            return strip_locations(res, locations)
+        elif locations == 'keep':
+            return piqi_of_piq.parse(typename, x, counters=counters)
+        elif locations == 'parse':
+            return piqi_of_piq.parse(typename, x, counters=counters, keep_locations=False)
+        elif locations == 'none':
+            try:
+                return piqi_of_piq.parse(typename, x, counters=counters, keep_locations=False)
+            except ParseError as e:
+                raise ParseError(None, e.error, e.path)
+        else:
+            assert False
     elif format == 'json':
-        return piqi_of_json.parse(typename, x)
+        return piqi_of_json.parse(typename, x, lazy=lazy, numeric_arrays=numeric_arrays)
+    elif format == 'pb':
+        return piqi_of_pb.parse(typename, x, numeric_arrays=numeric_arrays)
     else:
         assert False
 
 
-def gen(x, format='json'):
+# decode all fields of lazy records found in x (see parse() and project()) and
+# check them for unknown fields; raises ParseError
+def validate_all(x):
+    piqi_of_json.validate_lazy(x)
+
+
+# parse JSON x decoding only the values at the given paths, e.g.
+# ['header.id', 'status']
+#
+# paths are strings or tuples of field names (as returned by make_field_name)
+# and variant tags; lists and repeated fields are projected item by item.
+# Records on the paths are LazyRecord objects, their other fields are decoded
+# when they are accessed for the first time, lazily as well when lazy is True.
+def project(x, module_name, typename, paths, lazy=False):
+    global _parse_piqi_module
+    _parse_piqi_module = sys.modules[module_name]
+
+    return piqi_of_json.parse(typename, x, projection=make_projection(paths), lazy=lazy)
+
+
+# return projection tree: field name or variant tag -> projection of the
+# nested value, or None for the whole value
+def make_projection(paths):
+    res = {}
+    for path in paths:
+        if isinstance(path, basestring):
+            path = path.split('.')
+        node = res
+        for name in path[:-1]:
+            if name in node and node[name] is None:
+                # the whole value is selected already
+                break
+            node = node.setdefault(name, {})
+        else:
+            node[path[-1]] = None
+    return res
+
+
+# check that x is a valid value of the type without building piqi objects;
+# return the list of ParseError, which is empty when x is valid
+#
+# NOTE: parsing stops at the first error, so the list has at most one element
+#
+# only piq and json are supported; raises ValueError for other formats
+def validate(x, module_name, typename, format='piq'):
+    if format not in ('piq', 'json'):
+        raise ValueError('unsupported format for validation: ' + repr(format))
+
+    global _parse_piqi_module
+    _parse_piqi_module = sys.modules[module_name]
+
+    try:
+        if format == 'piq':
+            piqi_of_piq.parse(typename, x, keep_locations=False, builder=VALIDATION_BUILDER)
+        else:
+            piqi_of_json.parse(typename, x, builder=VALIDATION_BUILDER)
+    except ParseError as e:
+        return [e]
+    return []
+
+
+# convert x from one format to another; returns the same as
+#
+#       gen(parse(x, module_name, typename, format), output_format)
+#
+# piq is converted to json directly, i.e. without building piqi objects
+def convert(x, module_name, typename, format='piq', output_format='json', counters=None):
+    if format == 'piq' and output_format == 'json':
+        global _parse_piqi_module
+        _parse_piqi_module = sys.modules[module_name]
+
+        builder = piqi_to_json.JsonBuilder()
+        return piqi_of_piq.parse(typename, x, counters=counters, builder=builder)
+    else:
+        obj = parse(x, module_name, typename, format, counters=counters, locations='parse')
+        return gen(obj, output_format, module_name, typename)
+
+
+# locations of objects identified by their paths
+#
+# path is a tuple of field names (as returned by make_field_name), list indexes
+# and variant tags leading to the object from the top-level object, e.g.
+# ('point_list', 0, 'x')
+class LocationTable(object):
+    def __init__(self):
+        # path -> (line, column)
+        self.locations = {}
+
+    def add(self, path, loc):
+        self.locations[path] = (loc.line, loc.column)
+
+    # return (line, column) or None
+    def get(self, path):
+        return self.locations.get(path)
+
+    def __len__(self):
+        return len(self.locations)
+
+
+# remove locations from the object graph, optionally moving them to the
+# LocationTable, and return the resulting object
+#
+# NOTE: objects are modified in place, except for scalars and variants with
+# scalar values which are replaced
+def strip_locations(x, table=None, path=()):
+    if not isinstance(x, ObjectProxy):
+        if isinstance(x, list):  # repeated field
+            for i, item in enumerate(x):
+                x[i] = strip_locations(item, table, path + (i,))
+        return x
+
+    loc = x.__loc__
+    if loc is not None and table is not None:
+        table.add(path, loc)
+
+    obj = x.__wrapped__
+    if x.__piqi_type__ is None:  # scalar
+        if loc is None:
+            return x
+        elif is_binary(obj):
+            return make_binary(obj)
+        else:
+            return make_scalar(obj)
+
+    x._self_loc = None
+
+    if isinstance(obj, BaseRecord):
+        for name, value in record_fields(obj):
+            setattr(obj, name, strip_locations(value, table, path + (name,)))
+    elif isinstance(obj, List):
+        for i, item in enumerate(obj):
+            obj[i] = strip_locations(item, table, path + (i,))
+    elif isinstance(obj, Variant):
+        tag, value = obj
+        new_value = strip_locations(value, table, path + (tag,))
+        if new_value is not value:
+            x.__wrapped__ = Variant((tag, new_value))
+    return x
+
+
+# parse values emitted by a streamed piq program (see
+# piq_transform.Program.stream()) one by one, passing each parsed object to the
+# consumer
+def parse_stream(program, module_name, typename, consumer, user_globals=None):
+    def parse_item(piq_ast):
+        consumer(parse(piq_ast, module_name, typename))
+
+    program.stream(parse_item, user_globals)
+
+
+# module_name, typename: pb only, type of x when it doesn't carry one, i.e. for
+# top-level scalars; the module can be omitted for built-in types
+def gen(x, format='json', module_name=None, typename=None):
     if format == 'json':
         return piqi_to_json.gen(x)
+    elif format == 'pb':
+        piqi_module = None if module_name is None else sys.modules[module_name]
+        return piqi_to_pb.gen(x, typename, piqi_module)
     else:
         assert False
@@ -0,0 +1,203 @@
+# memory footprint of parsed piqi object graphs
+#
+# usage:
+#
+#       obj = piqi.parse(...)
+#       report = piqi_memory.measure(obj)
+#       sys.stderr.write(report.format_report())
+#
+# bytes are broken down by piqi type and by category:
+#
+#   proxy   -- piqi.ObjectProxy wrappers and their attribute dicts
+#   loc     -- piq.Loc objects referenced by proxies
+#   dict    -- per-instance __dict__ of piqi.Record, including piqi.LazyRecord
+#              objects
+#   payload -- everything else: records, lists, variants, tags and scalars, as
+#              well as JSON objects of lazy records and their raw field values
+#              that haven't been decoded yet
+#
+# NOTE: sizes are shallow sizes reported by sys.getsizeof(); objects shared by
+# several values (e.g. True, small ints, locations) are counted only once, and
+# objects owned by schema modules (type and field names) are not counted at all
+
+import gc
+import sys
+import collections
+
+import piqi
+import piqi_of_json
+
+
+CATEGORIES = ('proxy', 'loc', 'dict', 'payload')
+
+
+class TypeStats(object):
+    def __init__(self, name):
+        self.name = name
+        # number of values
+        self.count = 0
+        # category -> bytes
+        self.bytes = dict((x, 0) for x in CATEGORIES)
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes.itervalues())
+
+    def __repr__(self):
+        return repr(vars(self))
+
+
+class MemoryReport(object):
+    def __init__(self):
+        # piqi type name -> TypeStats; scalars are named after their Python type
+        # in angle brackets, e.g. <int>
+        self.types = collections.OrderedDict()
+        self.seen = set()
+
+    def get_type_stats(self, name):
+        stats = self.types.get(name)
+        if stats is None:
+            stats = self.types[name] = TypeStats(name)
+        return stats
+
+    # add the size of x to the category unless it was already counted
+    def add(self, stats, category, x):
+        if x is None or id(x) in self.seen:
+            return
+        self.seen.add(id(x))
+        stats.bytes[category] += sys.getsizeof(x)
+
+    @property
+    def values(self):
+        return sum(x.count for x in self.types.itervalues())
+
+    @property
+    def total_bytes(self):
+        return sum(x.total_bytes for x in self.types.itervalues())
+
+    def category_bytes(self, category):
+        return sum(x.bytes[category] for x in self.types.itervalues())
+
+    @property
+    def bytes_per_value(self):
+        values = self.values
+        if values:
+            return float(self.total_bytes) / values
+        else:
+            return 0.0
+
+    def format_report(self):
+        header = '{:<24} {:>10} {:>12} {:>8} {:>10} {:>10} {:>10} {:>10}\n'
+        row = '{:<24} {:>10} {:>12} {:>8.1f} {:>10} {:>10} {:>10} {:>10}\n'
+
+        lines = [header.format('type', 'values', 'bytes', 'B/value', *CATEGORIES)]
+
+        types = sorted(self.types.itervalues(), key=lambda x: x.total_bytes, reverse=True)
+        for x in types:
+            per_value = float(x.total_bytes) / x.count if x.count else 0.0
+            lines.append(row.format(
+                x.name, x.count, x.total_bytes, per_value,
+                *[x.bytes[c] for c in CATEGORIES]
+            ))
+
+        lines.append(row.format(
+            'total', self.values, self.total_bytes, self.bytes_per_value,
+            *[self.category_bytes(c) for c in CATEGORIES]
+        ))
+        return ''.join(lines)
+
+
+# instance __dict__ of x, found without going through proxied attribute lookup
+def instance_dict(x):
+    for referent in gc.get_referents(x):
+        if type(referent) is dict:
+            return referent
+    return None
+
+
+def measure(x):
+    report = MemoryReport()
+    measure_obj(report, x, None)
+    return report
+
+
+def measure_obj(report, x, stats):
+    if isinstance(x, piqi.ObjectProxy):
+        wrapped = x.__wrapped__
+        typename = x.__piqi_type__
+        if typename is None:
+            typename = '<' + type(wrapped).__name__ + '>'
+
+        stats = report.get_type_stats(typename)
+        stats.count += 1
+
+        report.add(stats, 'proxy', x)
+        report.add(stats, 'proxy', instance_dict(x))
+
+        loc = x.__loc__
+        if loc is not None and id(loc) not in report.seen:
+            report.add(stats, 'loc', loc)
+            loc_dict = instance_dict(loc)
+            report.add(stats, 'loc', loc_dict)
+            if loc_dict is not None:
+                for v in loc_dict.itervalues():
+                    report.add(stats, 'loc', v)
+
+        measure_obj(report, wrapped, stats)
+    elif x is None:
+        pass
+    elif stats is None:
+        # top-level object is not a piqi object
+        measure_obj(report, x, report.get_type_stats('<' + type(x).__name__ + '>'))
+    elif isinstance(x, piqi.LazyRecord):
+        report.add(stats, 'payload', x)
+        # NOTE: instance_dict() could find the typedef or the JSON object
+        decoded_fields = vars(x)
+        report.add(stats, 'dict', decoded_fields)
+        # NOTE: walking only decoded fields, i.e. without decoding the rest;
+        # the JSON object of the record and raw values of the fields that are
+        # yet to be decoded are payload
+        for v in decoded_fields.itervalues():
+            measure_obj(report, v, stats)
+        report.add(stats, 'payload', x._piqi_json)
+        field_specs = piqi.get_field_specs(x._piqi_typedef['name'], x._piqi_module)
+        for name, field_spec in field_specs.iteritems():
+            if name not in decoded_fields:
+                json_name = piqi_of_json.json_name_of_field(field_spec)
+                measure_json(report, x._piqi_json.get(json_name), stats)
+    elif isinstance(x, piqi.BaseRecord):
+        report.add(stats, 'payload', x)
+        # NOTE: generated record classes don't have __dict__
+        if isinstance(x, piqi.Record):
+            report.add(stats, 'dict', instance_dict(x))
+        for _, v in piqi.record_fields(x):
+            measure_obj(report, v, stats)
+    elif isinstance(x, list):  # piqi.List or repeated field
+        report.add(stats, 'payload', x)
+        for v in x:
+            measure_obj(report, v, stats)
+    elif piqi.is_numeric_array(x):
+        # NOTE: items are stored inline, counted as values of the array's type
+        report.add(stats, 'payload', x)
+        stats.count += len(x)
+    elif isinstance(x, piqi.Variant):
+        report.add(stats, 'payload', x)
+        report.add(stats, 'payload', x[0])
+        measure_obj(report, x[1], stats)
+    elif isinstance(x, piqi.Any):
+        report.add(stats, 'payload', x)
+        report.add(stats, 'dict', instance_dict(x))
+    else:
+        report.add(stats, 'payload', x)
+
+
+# add raw JSON value to the payload
+def measure_json(report, x, stats):
+    report.add(stats, 'payload', x)
+    if isinstance(x, dict):
+        for k, v in x.iteritems():
+            report.add(stats, 'payload', k)
+            measure_json(report, v, stats)
+    elif isinstance(x, list):
+        for v in x:
+            measure_json(report, v, stats)
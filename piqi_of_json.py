@@ -1,55 +1,84 @@
-import base64
-
 import piqi
+import piqi_profile
 
 
 # state
 #
 # TODO, XXX: wrap in a Parser class?
 
+# builder of parsed values, see piqi.ObjectBuilder
+_builder = None
 
-# NOTE: there is no location info in Python's decoded json objects
-#
-# XXX: provide some other form of context like path, e.g. foo[3].bar ?
+# kind of numeric arrays to parse lists of numbers into, see piqi.parse()
+_numeric_arrays = None
+
+
+# NOTE: there is no location info in Python's decoded json objects, errors
+# carry paths instead
 class ParseError(Exception):
     def __init__(self, error):
         self.error = error
+        # path to the invalid value in reverse order, filled in while the
+        # error propagates
+        self.path = []
 
 
 # top-level call
-def parse(typename, x):
+#
+# builder: builder of parsed values, see piqi.ObjectBuilder
+# projection: values to decode, see parse_projected(); everything by default
+# lazy: whether values that are not in the projection are decoded lazily
+# numeric_arrays: None, 'array' or 'numpy', see piqi.parse()
+def parse(typename, x, builder=None, projection=None, lazy=False, numeric_arrays=None):
+    return piqi_profile.run_stage('piqi_of_json', piqi.count_objects, do_parse, typename, x, builder, projection, lazy, numeric_arrays)
+
+
+def do_parse(typename, x, builder=None, projection=None, lazy=False, numeric_arrays=None):
     # XXX: remove top-level piqi_type
     if isinstance(x, dict) and 'piqi_type' in x:
         x = x.copy()
         del x['piqi_type']
 
+    global _builder, _numeric_arrays
+    _builder = builder or piqi.OBJECT_BUILDER
+    _numeric_arrays = numeric_arrays
+
     # convert .ParseError into piqi.ParseError
     try:
-        return parse_obj(typename, x)
+        if lazy:
+            # NOTE: empty projection makes lazy records at every level
+            return parse_projected(typename, x, projection or {}, {})
+        elif projection is None:
+            return parse_obj(typename, x)
+        else:
+            return parse_projected(typename, x, projection, None)
     except ParseError as e:
         # NOTE: there are no locations in Python's json objects
-        raise piqi.ParseError(None, e.error)
+        raise piqi.ParseError(None, e.error, tuple(reversed(e.path)))
+    finally:
+        _builder = None
+        _numeric_arrays = None
 
 
 def parse_obj(typename, x):
-    piqi_type = piqi.get_piqi_type(typename)
-    if piqi_type:  # one of built-in types
-        if piqi_type == 'bool':
+    # NOTE: aliases are resolved by unalias()
+    type_tag, typedef = piqi.unalias(typename)
+    if typedef is None:  # one of built-in types
+        if type_tag == 'bool':
             return parse_bool(x)
-        elif piqi_type == 'int':
+        elif type_tag == 'int':
             return parse_int(x)
-        elif piqi_type == 'float':
+        elif type_tag == 'float':
             return parse_float(x)
-        elif piqi_type == 'string':
+        elif type_tag == 'string':
             return parse_string(x)
-        elif piqi_type == 'binary':
+        elif type_tag == 'binary':
             return parse_binary(x)
-        elif piqi_type == 'any':
+        elif type_tag == 'any':
             return parse_any(x)
         else:
             assert False
     else:  # user-defined type
-        type_tag, typedef = piqi.resolve_type(typename)
         if type_tag == 'record':
             return parse_record(typedef, x)
         elif type_tag == 'list':
@@ -58,22 +87,60 @@ def parse_obj(typename, x):
             return parse_variant(typedef, x)
         elif type_tag == 'enum':
             return parse_enum(typedef, x)
-        elif type_tag == 'alias':
-            return parse_alias(typedef, x)
         else:
             assert False
 
 
 def parse_list(t, x):
     if isinstance(x, list):
-        item_type = t['type']
-        l = x
-        items = [parse_obj(item_type, x) for x in l]
-        return piqi.make_list(items, t['name'])
+        items = parse_items(t['type'], x)
+        return _builder.make_list(t, items)
     else:
         raise ParseError('array expected')
 
 
+def parse_items(item_type, l, projection=None, rest=None):
+    if _numeric_arrays is not None:
+        typecode = piqi.get_array_typecode(item_type)
+        if typecode is not None:
+            return parse_numeric_array(typecode, item_type, l)
+
+    items = []
+    try:
+        if projection is None:
+            for x in l:
+                items.append(parse_obj(item_type, x))
+        else:
+            for x in l:
+                items.append(parse_projected(item_type, x, projection, rest))
+    except ParseError as e:
+        e.path.append(len(items))
+        raise
+    return items
+
+
+def parse_numeric_array(typecode, item_type, l):
+    global _numeric_arrays
+    try:
+        return piqi.make_numeric_array(typecode, l, _numeric_arrays)
+    except (TypeError, OverflowError):
+        pass
+
+    # there are values that need conversion, e.g. 'NaN', or invalid ones, which
+    # are reported as usual
+    kind = _numeric_arrays
+    _numeric_arrays = None
+    try:
+        items = parse_items(item_type, l)
+    finally:
+        _numeric_arrays = kind
+
+    try:
+        return piqi.make_numeric_array(typecode, [piqi.unwrap_object(x) for x in items], kind)
+    except OverflowError:
+        return items
+
+
 def parse_record(t, x):
     if isinstance(x, dict):
         l = x.items()
@@ -86,94 +153,110 @@ def parse_record(t, x):
 def do_parse_record(t, l):
     field_spec_list = t['field']
 
-    parsed_fields = []
+    values = []
     for field_spec in field_spec_list:
-        value, l = parse_field(field_spec, l)
-
-        name = piqi.make_field_name(field_spec)
+        try:
+            value, l = parse_field(field_spec, l)
+        except ParseError as e:
+            e.path.append(piqi.make_field_name(field_spec))
+            raise
 
-        parsed_fields.append((name, value))
+        values.append(value)
 
     for x in l:
         raise ParseError('unknown field: ' + str(x))
 
-    return piqi.make_record(parsed_fields, t['name'])
+    return _builder.make_record(t, values)
 
 
 def parse_field(t, l):
     #print 'parse field', piqi.name_of_field(t), l
 
-    if t.get('type'):
-        return do_parse_field(t, l)
-    else:
-        return do_parse_flag(t, l)
+    name = json_name_of_field(t)
+    res, rem = find_field(name, l)
+    return parse_field_value(t, name, res), rem
 
 
 def quote(name):
     return "'" + name + "'"
 
 
-def do_parse_flag(t, l):
-    name = json_name_of_field(t)
-    res, rem = find_flag(name, l)
-    if res is None:
-        # missing flag implies False value
-        return piqi.make_scalar(False), rem
-    else:
-        return piqi.make_scalar(res), rem
-
+# parse value of the field found in the record's JSON object, x is None when
+# the field is missing
+def parse_field_value(t, name, x, projection=None, rest=None):
+    field_type = t.get('type')
+    if field_type is None:  # flag
+        if x is None:
+            # missing flag implies False value
+            return _builder.make_scalar(False)
+        elif isinstance(x, bool):
+            return _builder.make_scalar(x)
+        else:
+            raise ParseError('only true and false can be used as values for flag ' + quote(name))
 
-def do_parse_field(t, l):
-    name = json_name_of_field(t)
-    field_type = t['type']
     field_mode = t['mode']
     if field_mode == 'required':
-        return parse_required_field(name, field_type, l)
+        if x is None:
+            raise ParseError('missing field ' + quote(name))
     elif field_mode == 'optional':
-        return parse_optional_field(name, field_type, t.get('default'), l)
+        if x is None:
+            default = t.get('default')
+            if default is None:
+                return None
+            return _builder.parse_default(field_type, default)
     elif field_mode == 'repeated':
-        return parse_repeated_field(name, field_type, l)
+        if x is None:
+            return []
+        if not isinstance(x, list):
+            raise ParseError('array expected for field ' + quote(name))
+        return parse_items(field_type, x, projection, rest)
     else:
         assert False
 
-
-def parse_required_field(name, field_type, l, loc=None):
-    res, rem = find_field(name, l)
-    if res is None:
-        raise ParseError('missing field ' + quote(name))
+    if projection is None:
+        return parse_obj(field_type, x)
     else:
-        obj = parse_obj(field_type, res)
-        return obj, rem
+        return parse_projected(field_type, x, projection, rest)
 
 
-def parse_optional_field(name, field_type, default, l):
-    res, rem = find_field(name, l)
+def parse_default(field_type, default):
+    if default is None:
+        return None
+
+    # NOTE: default specs live as long as the typedef index, so their ids are
+    # stable keys
+    default_values = piqi.get_default_values()
+    res = default_values.get(id(default))
     if res is None:
-        obj = parse_default(field_type, default)
-        return obj, l
-    else:
-        obj = parse_obj(field_type, res)
-        return obj, rem
+        res = parse_default_obj(field_type, default['json'])
+        if is_shareable_default(res):
+            default_values[id(default)] = res
+    return res
 
 
-def parse_repeated_field(name, field_type, l):
-    res, rem = find_field(name, l)
-    if res is None:
-        return [], rem
-    else:
-        if not isinstance(res, list):
-            raise ParseError('array expected for field ' + quote(name))
-        items = [parse_obj(field_type, x) for x in res]
-        return items, rem
+# defaults are always parsed into piqi objects, whatever the current builder
+def parse_default_obj(field_type, x):
+    global _builder
+    builder = _builder
+    _builder = piqi.OBJECT_BUILDER
+    try:
+        return parse_obj(field_type, x)
+    finally:
+        _builder = builder
 
 
-def parse_default(field_type, default):
-    if default is None:
-        return None
+# parsed defaults are shared by all records with the missing field, so only
+# values that can't be modified in place are cached: scalars other than binary,
+# enums, and variants of those
+#
+# NOTE: checking the parsed value rather than the type, because whether a
+# variant can be modified depends on its option
+def is_shareable_default(x):
+    x = piqi.unwrap_object(x)
+    if isinstance(x, piqi.Variant):
+        return is_shareable_default(x[1])
     else:
-        # TODO, XXX: parse default in piqic-python instead of runtime
-        json = default['json']
-        return parse_obj(field_type, json)
+        return x is None or isinstance(x, (bool, int, long, float, basestring))
 
 
 # find field by name, return found field and remaining fields
@@ -192,94 +275,154 @@ def find_field(name, l):
     return res, rem
 
 
-# find flag by name, return found flag and remaining fields
-def find_flag(name, l):
-    res = None
-    rem = []
-    for item in l:
-        if res is not None:
-            rem.append(item)
-        else:
-            n, v = item
-            if n == name:
-                if not isinstance(v, bool):
-                    raise ParseError('only true and false can be used as values for flag ' + quote(name))
-                res = v
-            else:
-                rem.append(item)
-    return res, rem
-
-
 def parse_enum(t, x):
-    option_spec_list = t['option']
     if isinstance(x, basestring):
-        for o in option_spec_list:
-            option_name = json_name_of_option(o)
-            if option_name == x:
-                return piqi.make_enum(piqi.name_of_option(o), t['name'])
+        o = find_json_option(t, x)
+        if o is not None:
+            return _builder.make_enum(t, piqi.name_of_option(o))
         raise ParseError("unknown enum option " + quote(x))
     else:
         raise ParseError('string enum value expected')
 
 
-def parse_variant(t, x):
-    option_spec_list = t['option']
+def parse_variant(t, x, projection=None, rest=None):
     if isinstance(x, dict):
         l = x.items()
         if len(l) != 1:
             raise ParseError('exactly one option field expected')
         n, v = l[0]
-        for o in option_spec_list:
-            option_name = json_name_of_option(o)
-            if option_name == n:
-                value = parse_option(o, v)
-                return piqi.make_variant(piqi.name_of_option(o), value, t['name'])
+        o = find_json_option(t, n)
+        if o is not None:
+            tag = piqi.name_of_option(o)
+            try:
+                if projection is not None:
+                    projection = projection.get(piqi.make_name(tag), rest)
+                value = parse_option(o, v, projection, rest)
+            except ParseError as e:
+                e.path.append(piqi.make_name(tag))
+                raise
+            return _builder.make_variant(t, tag, value)
         raise ParseError('unknown variant option ' + quote(n))
     else:
         raise ParseError('object expected')
 
 
-def parse_option(t, x):
+def parse_option(t, x, projection=None, rest=None):
     option_type = t.get('type')
     if option_type is None:
         if x == True:
             return None
         else:
             raise ParseError('True value expected')
-    else:
+    elif projection is None:
         return parse_obj(option_type, x)
+    else:
+        return parse_projected(option_type, x, projection, rest)
 
 
-def parse_alias(t, x):
-    alias_type = t['type']
-    return parse_obj(alias_type, x)
+# parse x decoding only the values selected by the projection: field name or
+# variant tag -> projection of the nested value, or None for the whole value
+# (see piqi.make_projection)
+#
+# records become piqi.LazyRecord objects; their fields that are not selected
+# are decoded on access with the `rest` projection, i.e. None for the whole
+# field
+def parse_projected(typename, x, projection, rest):
+    type_tag, typedef = piqi.unalias(typename)
+    if type_tag == 'record':
+        return parse_lazy_record(typedef, x, projection, rest)
+    elif type_tag == 'list':
+        if isinstance(x, list):
+            items = parse_items(typedef['type'], x, projection, rest)
+            return _builder.make_list(typedef, items)
+        else:
+            raise ParseError('array expected')
+    elif type_tag == 'variant':
+        return parse_variant(typedef, x, projection, rest)
+    elif projection:
+        raise ParseError('can not select fields of ' + quote(typename))
+    else:
+        return parse_obj(typename, x)
+
+
+def parse_lazy_record(t, x, projection, rest):
+    if not isinstance(x, dict):
+        raise ParseError('object expected')
+
+    field_specs = piqi.get_field_specs(t['name'])
+    record = piqi.make_lazy_record(t, x, rest, _numeric_arrays)
+    for name, field_projection in projection.iteritems():
+        field_spec = field_specs.get(name)
+        if field_spec is None:
+            raise ParseError('unknown field ' + quote(name))
+
+        json_name = json_name_of_field(field_spec)
+        try:
+            value = parse_field_value(field_spec, json_name, x.get(json_name), field_projection, rest)
+        except ParseError as e:
+            e.path.append(name)
+            raise
+
+        setattr(record, name, value)
+
+    return record
+
+
+# decode field of piqi.LazyRecord on first access; eager: decode the whole
+# field value instead of using the record's projection
+#
+# NOTE: fields are checked one by one, so unknown fields of lazy records are
+# reported only by validate_lazy()
+def parse_lazy_field(record, name, eager=False):
+    field_specs = piqi.get_field_specs(record._piqi_typedef['name'], record._piqi_module)
+    field_spec = field_specs.get(name)
+    if field_spec is None:
+        raise AttributeError(name)
+
+    # NOTE: the field can be accessed long after parse() has returned, or in
+    # the middle of another parse()
+    global _builder, _numeric_arrays
+    saved_state = piqi._parse_piqi_module, _builder, _numeric_arrays
+    piqi._parse_piqi_module = record._piqi_module
+    _builder = piqi.OBJECT_BUILDER
+    _numeric_arrays = record._piqi_numeric_arrays
+
+    rest = None if eager else record._piqi_rest
+    json_name = json_name_of_field(field_spec)
+    try:
+        return parse_field_value(field_spec, json_name, record._piqi_json.get(json_name), rest, rest)
+    except ParseError as e:
+        e.path.append(name)
+        raise piqi.ParseError(None, e.error, tuple(reversed(e.path)))
+    finally:
+        piqi._parse_piqi_module, _builder, _numeric_arrays = saved_state
 
 
 def parse_bool(x):
     if isinstance(x, bool):
-        return piqi.make_scalar(x)
+        return _builder.make_scalar(x)
     else:
         raise ParseError('bool constant expected')
 
 
 def parse_int(x):
     if isinstance(x, int):
-        return piqi.make_scalar(x)
+        return _builder.make_scalar(x)
     else:
         raise ParseError('int constant expected')
 
 
 def parse_float(x):
     if isinstance(x, float):
-        return piqi.make_scalar(x)
+        return _builder.make_scalar(x)
     elif isinstance(x, int):
-        return piqi.make_scalar(x * 1.0)
+        return _builder.make_scalar(x * 1.0)
     elif x == 'NaN':
-        return piqi.make_scalar(float("nan"))
+        return _builder.make_scalar(float("nan"))
     elif x == 'Infinity':
-        return piqi.make_scalar(float("inf"))
+        return _builder.make_scalar(float("inf"))
     elif x == '-Infinity':
-        return piqi.make_scalar(-float("inf"))
+        return _builder.make_scalar(-float("inf"))
     else:
         raise ParseError('float constant expected')
 
@@ -287,7 +430,7 @@ def parse_float(x):
 def parse_string(x):
     if isinstance(x, basestring):
         # TODO: check for correct unicode
-        return piqi.make_scalar(x)
+        return _builder.make_scalar(x)
     else:
         raise ParseError('string constant expected')
 
@@ -295,10 +438,10 @@ def parse_string(x):
 def parse_binary(x):
     if isinstance(x, basestring):
         try:
-            value = base64.b64decode(x)
-            return piqi.make_scalar(value)
-        except:
-            ParseError('invalid base64-encoded string')
+            value = piqi.b64decode(x)
+        except ValueError:
+            raise ParseError('invalid base64-encoded string')
+        return _builder.make_binary(value)
     else:
         raise ParseError('string constant expected')
 
@@ -314,10 +457,10 @@ def parse_any(x):
         json_ast = x.get('json')
 
         # TODO, XXX: other fields such as pb and piq
-        return piqi.make_any(typename=typename, json_ast=json_ast)
+        return _builder.make_any(typename=typename, json_ast=json_ast)
 
     else: # regular symbolic piqi-any
-        return piqi.make_any(json_ast=x)
+        return _builder.make_any(json_ast=x)
 
 
 def json_name_of_option(t):
@@ -339,3 +482,67 @@ def json_name_of_field(t):
 
 def make_json_name(x):
     return str(x).replace('-', '_')
+
+
+# decode all fields of lazy records in x and check them for unknown fields,
+# see piqi.validate_all()
+def validate_lazy(x, path=()):
+    obj = piqi.unwrap_object(x)
+    if isinstance(obj, piqi.LazyRecord):
+        typename = obj._piqi_typedef['name']
+        check_unknown_fields(obj, path)
+
+        decoded_fields = vars(obj)
+        for name in piqi.get_field_specs(typename, obj._piqi_module):
+            if name in decoded_fields:
+                validate_lazy(decoded_fields[name], path + (name,))
+            else:
+                # NOTE: decoding the rest eagerly, which validates it fully
+                try:
+                    value = parse_lazy_field(obj, name, eager=True)
+                except piqi.ParseError as e:
+                    raise piqi.ParseError(None, e.error, path + e.path)
+                decoded_fields[name] = value
+    elif isinstance(obj, piqi.BaseRecord):
+        for name, value in piqi.record_fields(obj):
+            validate_lazy(value, path + (name,))
+    elif isinstance(obj, list):  # piqi.List or repeated field
+        for i, item in enumerate(obj):
+            validate_lazy(item, path + (i,))
+    elif isinstance(obj, piqi.Variant):
+        tag, value = obj
+        validate_lazy(value, path + (tag,))
+
+
+def check_unknown_fields(record, path):
+    json_names = piqi.get_module_table(record._piqi_module, 'json_field_names', make_json_field_names_table)
+    record_json_names = json_names[record._piqi_typedef['name']]
+    for item in record._piqi_json.iteritems():
+        if item[0] not in record_json_names:
+            raise piqi.ParseError(None, 'unknown field: ' + str(item), path)
+
+
+# return variant or enum name -> {JSON name of its option -> option spec}
+def make_json_options_table(typedef_index):
+    res = {}
+    for typename, (type_tag, typedef) in typedef_index.iteritems():
+        if type_tag in ('variant', 'enum'):
+            options = res[typename] = {}
+            for o in typedef['option']:
+                options.setdefault(json_name_of_option(o), o)
+    return res
+
+
+# return the spec of the variant or enum option by its JSON name, or None
+def find_json_option(t, json_name):
+    json_options = piqi.get_module_table(piqi._parse_piqi_module, 'json_options', make_json_options_table)
+    return json_options[t['name']].get(json_name)
+
+
+# return record name -> set of JSON names of its fields
+def make_json_field_names_table(typedef_index):
+    res = {}
+    for typename, (type_tag, typedef) in typedef_index.iteritems():
+        if type_tag == 'record':
+            res[typename] = set(json_name_of_field(f) for f in typedef['field'])
+    return res
@@ -0,0 +1,558 @@
+# protobuf binary format
+#
+# the encoding follows piqi's protobuf mapping:
+#
+#   - records are messages; variants are messages with exactly one field, set
+#     to `true` for options without type; lists are messages with repeated
+#     field 1
+#   - top-level values other than records, lists and variants are wrapped in a
+#     message as field 1
+#   - int, int32 and int64 are zigzag varints; uint* are varints;
+#     protobuf-int32 and protobuf-int64 are sign-extended varints; *-fixed are
+#     fixed-width; float and float64 are doubles, float32 is float; enums are
+#     sign-extended varints of option codes
+#   - aliases can override the encoding with .protobuf-wire-type
+#   - repeated fields with .protobuf-packed are encoded as packed; both packed
+#     and unpacked numeric fields are accepted on input
+#   - piqi-any is not supported
+#
+# field and option codes come from .code; when they are missing, they are
+# assigned in the order of declaration starting from 1
+#
+# NOTE: the input is decoded over a memoryview, i.e. without copying; only
+# strings are copied out of it, binary values are views of the input
+
+import sys
+import array
+import struct
+
+import piqi
+import piqi_of_json
+import piqi_profile
+
+
+# parse state
+#
+# kind of numeric arrays to parse repeated numbers into, see piqi.parse()
+_numeric_arrays = None
+
+class ParseError(Exception):
+    def __init__(self, error):
+        self.error = error
+        # path to the invalid value in reverse order, filled in while the
+        # error propagates (see piqi_of_json.ParseError)
+        self.path = []
+
+
+# wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_BLOCK = 2
+WIRE_FIXED32 = 5
+
+
+# protobuf wire type of each piqi wire encoding
+WIRE_TYPES = {
+    'varint': WIRE_VARINT,
+    'zigzag-varint': WIRE_VARINT,
+    'signed-varint': WIRE_VARINT,
+    'fixed32': WIRE_FIXED32,
+    'signed-fixed32': WIRE_FIXED32,
+    'fixed64': WIRE_FIXED64,
+    'signed-fixed64': WIRE_FIXED64,
+    'block': WIRE_BLOCK,
+}
+
+
+# wire encodings of built-in types
+BUILTIN_WIRE_ENCODINGS = {
+    'bool': 'varint',
+    'string': 'block',
+    'binary': 'block',
+    'piqi-any': 'block',
+
+    'int': 'zigzag-varint',
+    'int32': 'zigzag-varint',
+    'int64': 'zigzag-varint',
+    'uint': 'varint',
+    'uint32': 'varint',
+    'uint64': 'varint',
+    'int32-fixed': 'signed-fixed32',
+    'uint32-fixed': 'fixed32',
+    'int64-fixed': 'signed-fixed64',
+    'uint64-fixed': 'fixed64',
+    'protobuf-int32': 'signed-varint',
+    'protobuf-int64': 'signed-varint',
+
+    'float': 'fixed64',
+    'float64': 'fixed64',
+    'float32': 'fixed32',
+}
+
+
+# struct formats of fixed-width encodings: (piqi type, wire encoding) -> format
+FIXED_FORMATS = {
+    ('int', 'fixed32'): '<I',
+    ('int', 'signed-fixed32'): '<i',
+    ('int', 'fixed64'): '<Q',
+    ('int', 'signed-fixed64'): '<q',
+    ('float', 'fixed32'): '<f',
+    ('float', 'signed-fixed32'): '<f',
+    ('float', 'fixed64'): '<d',
+    ('float', 'signed-fixed64'): '<d',
+}
+
+
+# (piqi type, encoding) -> array.array typecode of packed fixed-width values
+#
+# NOTE: used only where the typecode's item size matches the encoding's
+FIXED_ARRAY_TYPECODES = {
+    ('int', 'fixed32'): 'I',
+    ('int', 'signed-fixed32'): 'i',
+    ('int', 'fixed64'): 'L',
+    ('int', 'signed-fixed64'): 'l',
+    ('float', 'fixed32'): 'f',
+    ('float', 'signed-fixed32'): 'f',
+    ('float', 'fixed64'): 'd',
+    ('float', 'signed-fixed64'): 'd',
+}
+
+
+# pb-specific information about schema types, see get_pb_index()
+
+class FieldInfo(object):
+    def __init__(self, field_spec, code):
+        self.spec = field_spec
+        self.code = code
+        self.name = piqi.make_field_name(field_spec)
+        self.type = field_spec.get('type')  # None for flags
+        self.mode = field_spec['mode']
+        self.packed = field_spec.get('protobuf_packed', False)
+
+
+class OptionInfo(object):
+    def __init__(self, option_spec, code):
+        self.spec = option_spec
+        self.code = code
+        self.name = piqi.name_of_option(option_spec)
+        self.type = option_spec.get('type')
+
+
+class OptionsInfo(object):
+    def __init__(self, typedef):
+        self.options = [
+            OptionInfo(o, o.get('code', i + 1)) for i, o in enumerate(typedef['option'])
+        ]
+        self.by_code = dict((x.code, x) for x in self.options)
+        # NOTE: keyed by tags as they appear in piqi.Variant and piqi.Enum
+        self.by_tag = dict((piqi.make_name(x.name), x) for x in self.options)
+
+
+class PbIndex(object):
+    def __init__(self, typedef_index):
+        self.unalias = piqi.make_unalias_table(typedef_index)
+
+        # typename -> wire encoding
+        self.wire_encodings = dict(BUILTIN_WIRE_ENCODINGS)
+        # record name -> [FieldInfo]
+        self.records = {}
+        # variant or enum name -> OptionsInfo
+        self.options = {}
+
+        for typename, (type_tag, typedef) in typedef_index.iteritems():
+            self.wire_encodings[typename] = self.wire_encoding_of_typedef(typedef_index, typename)
+
+            if type_tag == 'record':
+                self.records[typename] = [
+                    FieldInfo(f, f.get('code', i + 1)) for i, f in enumerate(typedef['field'])
+                ]
+            elif type_tag in ('variant', 'enum'):
+                self.options[typename] = OptionsInfo(typedef)
+
+    def wire_encoding_of_typedef(self, typedef_index, typename):
+        res = BUILTIN_WIRE_ENCODINGS.get(typename)
+        if res is not None:
+            return res
+
+        type_tag, typedef = typedef_index[typename]
+        if type_tag == 'alias':
+            res = typedef.get('protobuf_wire_type')
+            if res is None:
+                res = self.wire_encoding_of_typedef(typedef_index, typedef['type'])
+            return res
+        elif type_tag == 'enum':
+            return 'signed-varint'
+        else:
+            return 'block'
+
+
+def get_pb_index(piqi_module=None):
+    if piqi_module is None:
+        piqi_module = piqi._parse_piqi_module
+    return piqi.get_module_table(piqi_module, 'pb_index', PbIndex)
+
+
+# index of built-in types alone, for encoding top-level scalars without a
+# schema module
+_builtin_pb_index = None
+
+
+def get_builtin_pb_index():
+    global _builtin_pb_index
+    if _builtin_pb_index is None:
+        _builtin_pb_index = PbIndex({})
+    return _builtin_pb_index
+
+
+# top-level call
+#
+# numeric_arrays: None, 'array' or 'numpy', see piqi.parse()
+def parse(typename, x, numeric_arrays=None):
+    return piqi_profile.run_stage('piqi_of_pb', piqi.count_objects, do_parse, typename, x, numeric_arrays)
+
+
+def do_parse(typename, x, numeric_arrays=None):
+    global _numeric_arrays
+    _numeric_arrays = numeric_arrays
+    try:
+        return do_parse_buf(typename, x)
+    finally:
+        _numeric_arrays = None
+
+
+def do_parse_buf(typename, x):
+    if isinstance(x, memoryview):
+        buf = x
+    else:
+        buf = memoryview(x)
+
+    index = get_pb_index()
+
+    # convert .ParseError into piqi.ParseError
+    try:
+        type_tag, typedef = index.unalias[typename]
+        if type_tag in ('record', 'list', 'variant'):
+            return parse_message_obj(index, type_tag, typedef, buf, 0, len(buf))
+        else:
+            fields = parse_message(buf, 0, len(buf))
+            values = fields.get(1)
+            if values is None:
+                raise ParseError('missing top-level value')
+            return parse_obj(index, typename, buf, values[-1])
+    except ParseError as e:
+        # NOTE: there are no locations in binary input, errors carry paths
+        raise piqi.ParseError(None, e.error, tuple(reversed(e.path)))
+
+
+# varints are at most this many bytes long
+MAX_VARINT_SIZE = 10
+
+
+# return (value, position after the varint); end: end of the enclosing message
+def read_varint(buf, pos, end):
+    if pos >= end:
+        raise ParseError('unexpected end of message')
+    b = ord(buf[pos])
+    pos += 1
+    if b < 0x80:
+        return b, pos
+
+    res = b & 0x7f
+    shift = 7
+    limit = min(end, pos + MAX_VARINT_SIZE - 1)
+    while pos < limit:
+        b = ord(buf[pos])
+        pos += 1
+        res |= (b & 0x7f) << shift
+        if b < 0x80:
+            return res, pos
+        shift += 7
+
+    if pos == end:
+        raise ParseError('unexpected end of message')
+    else:
+        raise ParseError('invalid varint')
+
+
+# return code -> [(wire type, value)], where value is an int for varints, the
+# position for fixed-width values, and (start, end) for blocks
+def parse_message(buf, pos, end):
+    fields = {}
+    while pos < end:
+        key, pos = read_varint(buf, pos, end)
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(buf, pos, end)
+        elif wire_type == WIRE_FIXED64:
+            value = pos
+            pos += 8
+        elif wire_type == WIRE_BLOCK:
+            size, pos = read_varint(buf, pos, end)
+            value = (pos, pos + size)
+            pos += size
+        elif wire_type == WIRE_FIXED32:
+            value = pos
+            pos += 4
+        else:
+            raise ParseError('unsupported wire type ' + str(wire_type))
+
+        if pos > end:
+            raise ParseError('unexpected end of message')
+
+        code = key >> 3
+        values = fields.get(code)
+        if values is None:
+            fields[code] = [(wire_type, value)]
+        else:
+            values.append((wire_type, value))
+    return fields
+
+
+# field is (wire type, value) as returned by parse_message()
+def parse_obj(index, typename, buf, field):
+    wire_type, value = field
+    type_tag, typedef = index.unalias[typename]
+    if type_tag == 'any':
+        raise ParseError('piqi-any is not supported in protobuf format')
+    elif typedef is None:  # one of built-in types
+        return parse_scalar(type_tag, index.wire_encodings[typename], buf, wire_type, value)
+    elif type_tag == 'enum':
+        return parse_enum(index, typedef, decode_varint(wire_type, value, 'signed-varint'))
+    else:
+        if wire_type != WIRE_BLOCK:
+            raise ParseError('block expected for ' + quote(typename))
+        start, end = value
+        return parse_message_obj(index, type_tag, typedef, buf, start, end)
+
+
+def parse_message_obj(index, type_tag, typedef, buf, start, end):
+    if type_tag == 'record':
+        return parse_record(index, typedef, buf, start, end)
+    elif type_tag == 'list':
+        return parse_list(index, typedef, buf, start, end)
+    elif type_tag == 'variant':
+        return parse_variant(index, typedef, buf, start, end)
+    else:
+        raise ParseError('unsupported type ' + quote(typedef['name']))
+
+
+def quote(name):
+    return "'" + name + "'"
+
+
+def parse_record(index, t, buf, start, end):
+    fields = parse_message(buf, start, end)
+
+    # NOTE: unknown fields are ignored as usual in protobuf
+    parsed_fields = []
+    for f in index.records[t['name']]:
+        try:
+            value = parse_field(index, f, buf, fields.get(f.code))
+        except ParseError as e:
+            e.path.append(f.name)
+            raise
+
+        parsed_fields.append((f.name, value))
+
+    return piqi.make_record(parsed_fields, t['name'])
+
+
+# values: [(wire type, value)] of the field, or None when the field is missing
+def parse_field(index, f, buf, values):
+    if f.type is None:  # flag, encoded as bool which is true when present
+        if values is None:
+            return piqi.make_scalar(False)
+        else:
+            return parse_scalar('bool', 'varint', buf, *values[-1])
+    elif f.mode == 'repeated':
+        if values is None:
+            return []
+        else:
+            return parse_repeated(index, f.type, buf, values)
+    elif values is None:
+        if f.mode == 'required':
+            raise ParseError('missing field ' + quote(f.name))
+        return piqi_of_json.parse_default(f.type, f.spec.get('default'))
+    else:
+        # the last value wins
+        return parse_obj(index, f.type, buf, values[-1])
+
+
+def parse_repeated(index, typename, buf, values):
+    if _numeric_arrays is not None:
+        typecode = piqi.get_array_typecode(typename)
+        if typecode is not None:
+            res = parse_numeric_array(index, typecode, typename, buf, values)
+            if res is not None:
+                return res
+    return parse_repeated_items(index, typename, buf, values)
+
+
+def parse_repeated_items(index, typename, buf, values):
+    type_tag, _ = index.unalias[typename]
+    encoding = index.wire_encodings[typename]
+
+    res = []
+    try:
+        # NOTE: packed and unpacked values can be mixed
+        if type_tag in ('bool', 'int', 'float', 'enum') and encoding != 'block':
+            for wire_type, value in values:
+                if wire_type == WIRE_BLOCK:
+                    start, end = value
+                    for item in parse_packed(encoding, buf, start, end):
+                        res.append(parse_obj(index, typename, buf, item))
+                else:
+                    res.append(parse_obj(index, typename, buf, (wire_type, value)))
+        else:
+            for x in values:
+                res.append(parse_obj(index, typename, buf, x))
+    except ParseError as e:
+        e.path.append(len(res))
+        raise
+    return res
+
+
+# return numeric array of repeated values, or None if they don't fit
+def parse_numeric_array(index, typecode, typename, buf, values):
+    type_tag, _ = index.unalias[typename]
+    encoding = index.wire_encodings[typename]
+
+    fixed_typecode = FIXED_ARRAY_TYPECODES.get((type_tag, encoding))
+    if fixed_typecode is not None and \
+            array.array(fixed_typecode).itemsize == struct.calcsize(FIXED_FORMATS[(type_tag, encoding)]) and \
+            all(wire_type == WIRE_BLOCK for wire_type, _ in values):
+        # packed fixed-width values are copied in bulk
+        res = array.array(fixed_typecode)
+        for _, (start, end) in values:
+            if (end - start) % res.itemsize:
+                raise ParseError('invalid packed field')
+            res.fromstring(buf[start:end].tobytes())
+        if sys.byteorder == 'big':
+            res.byteswap()
+    else:
+        # NOTE: packed and unpacked values can be mixed
+        res = []
+        try:
+            for wire_type, value in values:
+                if wire_type == WIRE_BLOCK:
+                    start, end = value
+                    for item_wire_type, item in parse_packed(encoding, buf, start, end):
+                        res.append(decode_number(type_tag, encoding, buf, item_wire_type, item))
+                else:
+                    res.append(decode_number(type_tag, encoding, buf, wire_type, value))
+        except ParseError as e:
+            e.path.append(len(res))
+            raise
+
+    try:
+        return piqi.make_numeric_array(typecode, res, _numeric_arrays)
+    except OverflowError:
+        return None
+
+
+# return [(wire type, value)] of packed values
+def parse_packed(encoding, buf, pos, end):
+    wire_type = WIRE_TYPES[encoding]
+    res = []
+    if wire_type == WIRE_VARINT:
+        while pos < end:
+            value, pos = read_varint(buf, pos, end)
+            res.append((wire_type, value))
+    else:
+        size = 4 if wire_type == WIRE_FIXED32 else 8
+        while pos < end:
+            res.append((wire_type, pos))
+            pos += size
+    if pos != end:
+        raise ParseError('invalid packed field')
+    return res
+
+
+def parse_list(index, t, buf, start, end):
+    fields = parse_message(buf, start, end)
+    values = fields.get(1)
+    if values is None:
+        items = []
+    else:
+        items = parse_repeated(index, t['type'], buf, values)
+    return piqi.make_list(items, t['name'])
+
+
+def parse_variant(index, t, buf, start, end):
+    fields = parse_message(buf, start, end)
+    if len(fields) != 1:
+        raise ParseError('exactly one option field expected')
+
+    code, values = fields.items()[0]
+    option = index.options[t['name']].by_code.get(code)
+    if option is None:
+        raise ParseError('unknown variant option code ' + str(code))
+
+    try:
+        if option.type is None:
+            decode_varint(values[-1][0], values[-1][1], 'varint')
+            value = None
+        else:
+            value = parse_obj(index, option.type, buf, values[-1])
+    except ParseError as e:
+        e.path.append(piqi.make_name(option.name))
+        raise
+
+    return piqi.make_variant(option.name, value, t['name'])
+
+
+def parse_enum(index, t, code):
+    option = index.options[t['name']].by_code.get(code)
+    if option is None:
+        raise ParseError('unknown enum option code ' + str(code))
+    return piqi.make_enum(option.name, t['name'])
+
+
+def decode_varint(wire_type, value, encoding):
+    if wire_type != WIRE_VARINT:
+        raise ParseError('varint expected')
+
+    if encoding == 'zigzag-varint':
+        return (value >> 1) ^ -(value & 1)
+    elif encoding == 'signed-varint':
+        if value >= (1 << 63):
+            value = int(value - (1 << 64))
+        return value
+    else:
+        return value
+
+
+def parse_scalar(piqi_type, encoding, buf, wire_type, value):
+    if piqi_type in ('string', 'binary'):
+        if wire_type != WIRE_BLOCK:
+            raise ParseError('block expected')
+        start, end = value
+        if piqi_type == 'binary':
+            # NOTE: slice of the input, i.e. no copy
+            return piqi.make_binary(buf[start:end])
+        try:
+            res = buf[start:end].tobytes().decode('utf-8')
+        except UnicodeDecodeError:
+            raise ParseError('invalid utf-8 string')
+        return piqi.make_scalar(res)
+
+    elif piqi_type == 'bool':
+        return piqi.make_scalar(decode_varint(wire_type, value, encoding) != 0)
+
+    elif piqi_type in ('int', 'float'):
+        return piqi.make_scalar(decode_number(piqi_type, encoding, buf, wire_type, value))
+
+    else:
+        raise ParseError('unsupported type ' + quote(piqi_type))
+
+
+def decode_number(piqi_type, encoding, buf, wire_type, value):
+    if WIRE_TYPES[encoding] != wire_type:
+        raise ParseError(piqi_type + ' constant expected')
+    if wire_type == WIRE_VARINT:
+        res = decode_varint(wire_type, value, encoding)
+        if piqi_type == 'float':
+            res = res * 1.0
+        return res
+    else:
+        return struct.unpack_from(FIXED_FORMATS[(piqi_type, encoding)], buf, value)[0]
@@ -1,8 +1,11 @@
+import collections
+
 import wrappers
 
 import piqi
 import piq
 import piqi_of_json
+import piqi_profile
 
 
 # config
@@ -16,12 +19,25 @@ piq_relaxed_parsing = True
 # TODO, XXX: wrap in a Parser class?
 _depth = 0
 
+# backtracking and dispatch counters, None when counting is off
+_counters = None
+
+# whether parsed objects keep their locations; parse errors are reported with
+# locations either way
+_keep_locations = True
+
+# builder of parsed values, see piqi.ObjectBuilder
+_builder = None
+
 
 class ParseError(Exception):
     def __init__(self, loc, error):
         self.depth = _depth  # used for backtracking
         self.error = error
         self.loc = loc
+        # path to the invalid value in reverse order, filled in while the
+        # error propagates
+        self.path = []
 
 
 def make_scalar(x, loc):
@@ -31,11 +47,87 @@ def make_scalar(x, loc):
         # values
         assert False
 
-    return piqi.make_scalar(x, loc)
+    return _builder.make_scalar(x, obj_loc(loc))
+
+
+# location to attach to a parsed object
+def obj_loc(loc):
+    if _keep_locations:
+        return loc
+    else:
+        return None
+
+
+class FieldCounters(object):
+    def __init__(self):
+        self.attempts = 0  # try-parse attempts
+        self.failures = 0  # attempts that didn't parse the field
+        self.exceptions = 0  # parse errors raised and caught during attempts
+
+    def __repr__(self):
+        return repr(vars(self))
+
+
+class VariantCounters(object):
+    def __init__(self):
+        self.parses = 0
+        self.failures = 0  # parses where none of the options matched
+        self.options_scanned = 0
+
+    def __repr__(self):
+        return repr(vars(self))
+
+
+# counters that can be turned on for a parse, e.g.
+#
+#       counters = piqi_of_piq.ParseCounters()
+#       piqi.parse(x, module_name, typename, counters=counters)
+#       print counters.format_report()
+class ParseCounters(object):
+    def __init__(self):
+        # (record name, field name) -> FieldCounters
+        self.fields = collections.defaultdict(FieldCounters)
+        # variant or enum name -> VariantCounters
+        self.variants = collections.defaultdict(VariantCounters)
+
+        # names of records being parsed
+        self.record_stack = []
+
+    def get_field(self, field_spec):
+        record_name = self.record_stack[-1] if self.record_stack else None
+        return self.fields[(record_name, piqi.name_of_field(field_spec))]
+
+    def count_try_parse(self, field_spec, res):
+        field = self.get_field(field_spec)
+        field.attempts += 1
+        if res is None:  # same check as in find_first_parsed_field()
+            field.failures += 1
+
+    def count_try_parse_exception(self, field_spec):
+        self.get_field(field_spec).exceptions += 1
+
+    def format_report(self):
+        lines = ['{:<40} {:>10} {:>10} {:>10}\n'.format('record.field', 'attempts', 'failures', 'exceptions')]
+        for (record_name, field_name), x in sorted(self.fields.items(), key=lambda x: -x[1].attempts):
+            name = '{}.{}'.format(record_name, field_name)
+            lines.append('{:<40} {:>10} {:>10} {:>10}\n'.format(name, x.attempts, x.failures, x.exceptions))
+
+        lines.append('{:<40} {:>10} {:>10} {:>10}\n'.format('variant', 'parses', 'failures', 'scanned'))
+        for name, x in sorted(self.variants.items(), key=lambda x: -x[1].options_scanned):
+            lines.append('{:<40} {:>10} {:>10} {:>10}\n'.format(name, x.parses, x.failures, x.options_scanned))
+
+        return ''.join(lines)
 
 
 # top-level call
-def parse(typename, x):
+#
+# keep_locations: whether parsed objects should keep their piq locations
+# builder: builder of parsed values, see piqi.ObjectBuilder
+def parse(typename, x, counters=None, keep_locations=True, builder=None):
+    return piqi_profile.run_stage('piqi_of_piq', piqi.count_objects, do_parse, typename, x, counters, keep_locations, builder)
+
+
+def do_parse(typename, x, counters=None, keep_locations=True, builder=None):
     # init parsing state
     global _depth
     _depth = 0
@@ -46,32 +138,41 @@ def parse(typename, x):
     except piq.ParseError as e:
         raise piqi.ParseError(e.loc, e.error)
 
+    global _counters, _keep_locations, _builder
+    _counters = counters
+    _keep_locations = keep_locations
+    _builder = builder or piqi.OBJECT_BUILDER
+
     # convert .ParseError into piqi.ParseError
     try:
         return parse_obj(typename, piq_ast)
     except ParseError as e:
-        raise piqi.ParseError(e.loc, e.error)
+        raise piqi.ParseError(e.loc, e.error, tuple(reversed(e.path)))
+    finally:
+        _counters = None
+        _keep_locations = True
+        _builder = None
 
 
 def parse_obj(typename, x, try_mode=False, nested_variant=False, labeled=False, typedef_index=None):
-    piqi_type = piqi.get_piqi_type(typename)
-    if piqi_type:  # one of built-in types
-        if piqi_type == 'bool':
+    # NOTE: aliases are resolved by unalias()
+    type_tag, typedef = piqi.unalias(typename)
+    if typedef is None:  # one of built-in types
+        if type_tag == 'bool':
             return parse_bool(x)
-        elif piqi_type == 'int':
+        elif type_tag == 'int':
             return parse_int(x)
-        elif piqi_type == 'float':
+        elif type_tag == 'float':
             return parse_float(x)
-        elif piqi_type == 'string':
+        elif type_tag == 'string':
             return parse_string(x)
-        elif piqi_type == 'binary':
+        elif type_tag == 'binary':
             return parse_binary(x)
-        elif piqi_type == 'any':
+        elif type_tag == 'any':
             return parse_any(x)
         else:
             assert False
     else:  # user-defined type
-        type_tag, typedef = piqi.resolve_type(typename)
         if type_tag == 'record':
             return parse_record(typedef, x, labeled=labeled)
         elif type_tag == 'list':
@@ -80,8 +181,6 @@ def parse_obj(typename, x, try_mode=False, nested_variant=False, labeled=False,
             return parse_variant(typedef, x, try_mode=try_mode, nested_variant=nested_variant)
         elif type_tag == 'enum':
             return parse_enum(typedef, x, try_mode=try_mode, nested_variant=nested_variant)
-        elif type_tag == 'alias':
-            return parse_alias(typedef, x, try_mode=try_mode, nested_variant=nested_variant, labeled=labeled)
         else:
             assert False
 
@@ -91,7 +190,7 @@ def parse_list(t, x):
         # TODO: fix this ugliness, for parse_record too
         global _depth
         _depth += 1
-        res = do_parse_list(t, l, loc=x.loc)
+        res = do_parse_list(t, x.items, loc=x.loc)
         _depth -= 1;
         return res
     else:
@@ -100,8 +199,14 @@ def parse_list(t, x):
 
 def do_parse_list(t, l, loc=None):
     item_type = t['type']
-    items = [parse_obj(item_type, x) for x in l]
-    return piqi.make_list(items, t['name'], loc)
+    items = []
+    try:
+        for x in l:
+            items.append(parse_obj(item_type, x))
+    except ParseError as e:
+        e.path.append(len(items))
+        raise
+    return _builder.make_list(t, items, obj_loc(loc))
 
 
 def parse_record(t, x, labeled=False):
@@ -125,26 +230,38 @@ def parse_record(t, x, labeled=False):
 
 
 def do_parse_record(t, l, loc=None):
+    counters = _counters
+    if counters is None:
+        return do_parse_record_fields(t, l, loc=loc)
+
+    counters.record_stack.append(t['name'])
+    try:
+        return do_parse_record_fields(t, l, loc=loc)
+    finally:
+        counters.record_stack.pop()
+
+
+def do_parse_record_fields(t, l, loc=None):
     field_spec_list = t['field']
 
     # parse required fields first
     required, optional = [], []
-    for f in field_spec_list:
-        (optional, required)[f['mode'] == 'required'].append(f)
-    field_spec_list = required + optional
-
-    parsed_fields = []
-    for field_spec in field_spec_list:
-        value, l = parse_field(field_spec, l, loc=loc)
-
-        name = piqi.make_field_name(field_spec)
+    for i, f in enumerate(field_spec_list):
+        (optional, required)[f['mode'] == 'required'].append(i)
 
-        parsed_fields.append((name, value))
+    # NOTE: builders expect fields in their original order
+    values = [None] * len(field_spec_list)
+    for i in required + optional:
+        try:
+            values[i], l = parse_field(field_spec_list[i], l, loc=loc)
+        except ParseError as e:
+            e.path.append(piqi.make_field_name(field_spec_list[i]))
+            raise
 
     for x in l:
         raise ParseError(x.loc, 'unknown field: ' + str(x))
 
-    return piqi.make_record(parsed_fields, t['name'], loc)
+    return _builder.make_record(t, values, obj_loc(loc))
 
 
 def parse_field(t, l, loc=None):
@@ -247,28 +364,33 @@ def parse_repeated_field(t, name, field_type, l):
         return res, rem
     else:
         # use strict parsing
-        res = [parse_obj(field_type, x, labeled=True) for x in res]
-        return res, rem
+        items = []
+        try:
+            for x in res:
+                items.append(parse_obj(field_type, x, labeled=True))
+        except ParseError as e:
+            e.path.append(len(items))
+            raise
+        return items, rem
 
 
 def parse_default(field_type, default):
     if default is None:
         return None
     else:
-        # TODO, XXX: parse default in piqic-python instead of runtime
-        return piqi_of_json.parse_default(field_type, default)
+        return _builder.parse_default(field_type, default)
 
 
 def find_first_parsed_field(t, field_type, l):
     res = None
     rem = []
     for x in l:
-        if res:
+        if res is not None:
             # already found => copy the reminder
             rem.append(x)
         else:
             obj = try_parse_field(t, field_type, x)
-            if obj:  # found
+            if obj is not None:  # found
                 res = obj
             else:
                 rem.append(x)
@@ -280,7 +402,7 @@ def find_all_parsed_fields(t, field_type, l):
     rem = []
     for x in l:
         obj = try_parse_field(t, field_type, x)
-        if obj:
+        if obj is not None:
             res.append(obj)
         else:
             rem.append(x)
@@ -288,6 +410,13 @@ def find_all_parsed_fields(t, field_type, l):
 
 
 def try_parse_field(field_spec, field_type, x):
+    res = do_try_parse_field(field_spec, field_type, x)
+    if _counters is not None:
+        _counters.count_try_parse(field_spec, res)
+    return res
+
+
+def do_try_parse_field(field_spec, field_type, x):
     type_tag, typedef = piqi.unalias(field_type)
     piq_positional = field_spec.get('piq_positional')
     if piq_positional == False:
@@ -309,6 +438,9 @@ def try_parse_field(field_spec, field_type, x):
         try:
             return parse_obj(field_type, x, try_mode=True)
         except ParseError as e:
+            if _counters is not None:
+                _counters.count_try_parse_exception(field_spec)
+
             # ignore errors which occur at the same parse depth, i.e. when
             # parsing everything except for lists and records which increment
             # depth
@@ -365,22 +497,30 @@ def find_flags(name, alt_name, l):
 
 def parse_variant(t, x, try_mode=False, nested_variant=False):
     option_spec_list = t['option']
-    tag, value = parse_options(option_spec_list, x, try_mode=try_mode, nested_variant=nested_variant)
-    return piqi.make_variant(tag, value, t['name'], x.loc)
+    tag, value = parse_options(option_spec_list, x, try_mode=try_mode, nested_variant=nested_variant, name=t['name'])
+    return _builder.make_variant(t, tag, value, obj_loc(x.loc))
 
 
 def parse_enum(t, x, try_mode=False, nested_variant=False):
     option_spec_list = t['option']
-    tag, _ = parse_options(option_spec_list, x, try_mode=try_mode, nested_variant=nested_variant)
-    return piqi.make_enum(tag, t['name'], x.loc)
+    tag, _ = parse_options(option_spec_list, x, try_mode=try_mode, nested_variant=nested_variant, name=t['name'])
+    return _builder.make_enum(t, tag, obj_loc(x.loc))
 
 
 class UnknownVariant(Exception):
     pass
 
 
-def parse_options(option_spec_list, x, try_mode=False, nested_variant=False):
+def parse_options(option_spec_list, x, try_mode=False, nested_variant=False, name=None):
+    counters = _counters
+    if counters is not None:
+        variant_counters = counters.variants[name]
+        variant_counters.parses += 1
+
     for option_spec in option_spec_list:
+        if counters is not None:
+            variant_counters.options_scanned += 1
+
         res = parse_option(option_spec, x, try_mode=try_mode)
         if res is not None:  # success
             return res
@@ -393,6 +533,9 @@ def parse_options(option_spec_list, x, try_mode=False, nested_variant=False):
                 pass
 
     # none of the options matches
+    if counters is not None:
+        variant_counters.failures += 1
+
     if nested_variant:
         raise UnknownVariant
     else:
@@ -420,13 +563,21 @@ def parse_nested_option(t, x, try_mode=False):
         if is_nested_variant:
             try:
                 tag = option_name
-                value = parse_obj(option_type, x, try_mode=try_mode, nested_variant=True)
+                value = parse_option_value(option_name, option_type, x, try_mode=try_mode, nested_variant=True)
                 return tag, value
             except UnknownVariant:
                 pass
     return None
 
 
+def parse_option_value(option_name, option_type, x, **kwargs):
+    try:
+        return parse_obj(option_type, x, **kwargs)
+    except ParseError as e:
+        e.path.append(piqi.make_name(option_name))
+        raise
+
+
 def parse_name_option(t, name, loc=None):
     option_name = piqi.name_of_option(t)
     if name == option_name or name == t.get('piq_alias'):
@@ -450,7 +601,7 @@ def parse_named_option(t, name, x, loc=None):
             raise ParseError(loc, 'value can not be specified for option ', quote(name))
         else:
             tag = option_name
-            value = parse_obj(option_type, x, labeled=True)
+            value = parse_option_value(option_name, option_type, x, labeled=True)
             return tag, value
     else:
         return None
@@ -496,7 +647,7 @@ def parse_option_by_type(t, x, try_mode=False):
 
         if parse:
             tag = piqi.name_of_option(t)
-            value = parse_obj(option_type, x)
+            value = parse_option_value(tag, option_type, x)
             return tag, value
         else:
             return None
@@ -504,11 +655,6 @@ def parse_option_by_type(t, x, try_mode=False):
         assert False
 
 
-def parse_alias(t, x, try_mode=False, nested_variant=False, labeled=False):
-    alias_type = t['type']
-    return parse_obj(alias_type, x, try_mode=try_mode, nested_variant=nested_variant, labeled=labeled)
-
-
 def parse_bool(x):
     if isinstance(x, piq.Scalar) and isinstance(x.value, bool):
         return make_scalar(x.value, x.loc)
@@ -548,9 +694,15 @@ def parse_string(x):
 
 
 def parse_binary(x):
-    if isinstance(x, piq.Scalar) and isinstance(x.value, basestring):
-        # TODO: check for 8-bit characters
-        return make_scalar(x.value, x.loc)
+    if isinstance(x, piq.Scalar) and isinstance(x.value, str):
+        # NOTE: read-only view of the scalar's string, i.e. no copy
+        return _builder.make_binary(memoryview(x.value), obj_loc(x.loc))
+    elif isinstance(x, piq.Scalar) and isinstance(x.value, unicode):
+        try:
+            value = bytearray(x.value, 'latin-1')
+        except UnicodeEncodeError:
+            raise ParseError(x.loc, 'binary can only contain 8-bit characters')
+        return _builder.make_binary(value, obj_loc(x.loc))
     else:
         raise ParseError(x.loc, 'binary expected')
 
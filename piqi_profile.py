@@ -0,0 +1,384 @@
+# per-stage timing instrumentation for the parse pipeline
+#
+# usage:
+#
+#       with piqi_profile.profile() as p:
+#           piq_transform.exec_file(...)
+#           piqi.parse(...)
+#
+#       sys.stderr.write(p.format_report())
+#
+# for each stage, the profiler records the number of calls, total and self
+# (i.e. excluding nested stages) wall time and the number of produced nodes
+#
+# with profile(count_gc_objects=True), it also records the net number of
+# gc-tracked objects the stage leaves behind ("gc net" column). This is not an
+# allocation count: gc-tracked objects are only containers, e.g. lists, dicts
+# and instances of user-defined classes, but not strings or numbers, and they
+# are counted with gc.get_count(), i.e. objects that are freed while the stage
+# is running cancel out their allocation. To keep the counter monotonic,
+# garbage collection is disabled while such stages are running, which changes
+# how the profiled code behaves; stages that run user code (see
+# USER_CODE_STAGES) are not counted and keep garbage collection as it is.
+# Counting allocations would require sys.getallocatedblocks() or tracemalloc,
+# which are not available in Python 2
+#
+# there is also a location profiler that charges piq script evaluation time and
+# piqi_of_piq typing time to source lines:
+#
+#       with piqi_profile.profile_locations(filename) as p:
+#           res = piq_transform.compile_file(filename).run()
+#           piqi.parse(res, ...)
+#
+#       sys.stderr.write(p.format_report(limit=20))
+
+import gc
+import sys
+import time
+import linecache
+import collections
+
+
+# active profiler, None when profiling is off
+_profiler = None
+
+
+# stages that evaluate piq scripts; they can run for arbitrarily long and
+# produce any amount of cyclic garbage, so garbage collection is left as it is
+# while they are running
+USER_CODE_STAGES = frozenset(['exec'])
+
+
+class StageRecord(object):
+    def __init__(self, name, elapsed, self_time, nodes, gc_objects, self_gc_objects):
+        self.name = name
+        self.elapsed = elapsed
+        self.self_time = self_time
+        self.nodes = nodes
+        self.gc_objects = gc_objects
+        self.self_gc_objects = self_gc_objects
+
+    def __repr__(self):
+        return repr(vars(self))
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.elapsed = 0.0
+        self.self_time = 0.0
+        self.nodes = 0
+        self.gc_objects = 0
+        self.self_gc_objects = 0
+
+    # NOTE: gc objects are None when they are not counted for some of the
+    # stage's runs
+    def add(self, record):
+        self.calls += 1
+        self.elapsed += record.elapsed
+        self.self_time += record.self_time
+        self.nodes += record.nodes
+        if record.gc_objects is None or self.gc_objects is None:
+            self.gc_objects = self.self_gc_objects = None
+        else:
+            self.gc_objects += record.gc_objects
+            self.self_gc_objects += record.self_gc_objects
+
+    def __repr__(self):
+        return repr(vars(self))
+
+
+# running stage
+class Stage(object):
+    def __init__(self, name, disabled_gc, count_gc_objects):
+        self.name = name
+        # whether the profiler disabled garbage collection for the stage
+        self.disabled_gc = disabled_gc
+        self.count_gc_objects = count_gc_objects
+        self.child_time = 0.0
+        self.child_gc_objects = 0
+        self.start_gc_objects = gc.get_count()[0]
+        self.start_time = time.time()
+
+
+class Profiler(object):
+    def __init__(self, callback=None, count_gc_objects=False):
+        self.callback = callback
+        self.count_gc_objects = count_gc_objects
+        self.stats = collections.OrderedDict()
+        self.stack = []
+        self.prev_profiler = None
+
+    def __enter__(self):
+        global _profiler
+        self.prev_profiler = _profiler
+        _profiler = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _profiler
+        _profiler = self.prev_profiler
+        return False
+
+    def start(self, name):
+        disable_gc = self.count_gc_objects and name not in USER_CODE_STAGES and gc.isenabled()
+        if disable_gc:
+            gc.disable()
+
+        # gc objects are counted only while garbage collection is disabled
+        stage = Stage(name, disable_gc, self.count_gc_objects and not gc.isenabled())
+        self.stack.append(stage)
+        return stage
+
+    def end(self, stage, end_time, end_gc_objects, nodes=0):
+        # NOTE: stages are always properly nested, but an exception may unwind
+        # several of them at once
+        while self.stack and self.stack.pop() is not stage:
+            pass
+
+        elapsed = end_time - stage.start_time
+        if stage.count_gc_objects:
+            gc_objects = max(0, end_gc_objects - stage.start_gc_objects)
+            self_gc_objects = max(0, gc_objects - stage.child_gc_objects)
+        else:
+            gc_objects = self_gc_objects = None
+
+        record = StageRecord(
+            stage.name,
+            elapsed,
+            elapsed - stage.child_time,
+            nodes,
+            gc_objects,
+            self_gc_objects,
+        )
+
+        if self.stack:
+            parent = self.stack[-1]
+            # NOTE: node counting time is excluded from the parent too
+            parent.child_time += time.time() - stage.start_time
+            # NOTE: when gc objects of the stage are not counted, neither are
+            # those of its parent
+            if stage.count_gc_objects:
+                parent.child_gc_objects += gc.get_count()[0] - stage.start_gc_objects
+
+        stats = self.stats.get(stage.name)
+        if stats is None:
+            stats = self.stats[stage.name] = StageStats(stage.name)
+        stats.add(record)
+
+        if stage.disabled_gc:
+            gc.enable()
+
+        if self.callback is not None:
+            self.callback(record)
+
+    def format_report(self):
+        total_time = sum(x.self_time for x in self.stats.values())
+
+        lines = [
+            '{:<20} {:>7} {:>10} {:>10} {:>6} {:>10} {:>10}\n'.format(
+                'stage', 'calls', 'total(s)', 'self(s)', 'self%', 'nodes', 'gc net'
+            )
+        ]
+        for x in self.stats.values():
+            if total_time > 0:
+                percent = 100.0 * x.self_time / total_time
+            else:
+                percent = 0.0
+            lines.append('{:<20} {:>7} {:>10.4f} {:>10.4f} {:>6.1f} {:>10} {:>10}\n'.format(
+                x.name, x.calls, x.elapsed, x.self_time, percent, x.nodes,
+                '-' if x.self_gc_objects is None else x.self_gc_objects
+            ))
+        return ''.join(lines)
+
+
+def profile(callback=None, count_gc_objects=False):
+    return Profiler(callback, count_gc_objects)
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+# run f(*args, **kwargs) as a named stage and return its result
+#
+# count_nodes(result) is called only when profiling is on; neither its time
+# nor its gc objects are attributed to the stage
+def run_stage(name, count_nodes, f, *args, **kwargs):
+    profiler = _profiler
+    if profiler is None:
+        return f(*args, **kwargs)
+
+    stage = profiler.start(name)
+    try:
+        res = f(*args, **kwargs)
+    except:
+        profiler.end(stage, time.time(), gc.get_count()[0])
+        raise
+
+    end_time = time.time()
+    end_gc_objects = gc.get_count()[0]
+
+    if count_nodes is not None and res is not None:
+        nodes = count_nodes(res)
+    else:
+        nodes = 0
+
+    profiler.end(stage, end_time, end_gc_objects, nodes)
+    return res
+
+
+# piq script frames are recognized by the presence of runtime bindings in their
+# globals (see piq_transform.runtime_globals)
+def is_piq_script_frame(frame):
+    return '_piq_wrap_object' in frame.f_globals
+
+
+# typing_filename: the file of the piq objects that are typed outside of piq
+# script evaluation, e.g. of a script's result
+#
+# NOTE: piq locations don't include filenames; objects typed while a script is
+# running, e.g. when they are emitted, are attributed to the evaluated file
+class LocationProfiler(object):
+    def __init__(self, typing_filename=None):
+        # (filename, line) -> seconds
+        self.eval_times = collections.defaultdict(float)
+        # (filename, line) -> seconds
+        self.typing_times = collections.defaultdict(float)
+
+        self.typing_filename = typing_filename
+        # file of the objects that are currently being typed
+        self.current_typing_filename = None
+
+        # currently evaluated (filename, line) and when it started
+        self.current = None
+        self.current_start = None
+
+        # time spent in nested parse_obj() calls, one item per running call
+        self.typing_stack = []
+
+        self.prev_trace = None
+        self.orig_parse_obj = None
+
+    def __enter__(self):
+        # NOTE: importing here, because piqi_of_piq depends on this module
+        import piqi_of_piq
+
+        self.orig_parse_obj = piqi_of_piq.parse_obj
+        piqi_of_piq.parse_obj = self.wrap_parse_obj(self.orig_parse_obj)
+
+        self.prev_trace = sys.gettrace()
+        sys.settrace(self.trace)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import piqi_of_piq
+
+        sys.settrace(self.prev_trace)
+        self.switch(None)
+
+        piqi_of_piq.parse_obj = self.orig_parse_obj
+        return False
+
+    # charge time elapsed since the last switch to the current location
+    def switch(self, location):
+        now = time.time()
+        if self.current is not None:
+            self.eval_times[self.current] += now - self.current_start
+        self.current = location
+        self.current_start = now
+
+    def trace(self, frame, event, arg):
+        if event == 'call' and is_piq_script_frame(frame):
+            self.switch((frame.f_code.co_filename, frame.f_lineno))
+            return self.trace_script_frame
+        else:
+            return None
+
+    def trace_script_frame(self, frame, event, arg):
+        if event == 'line':
+            self.switch((frame.f_code.co_filename, frame.f_lineno))
+        elif event == 'return':
+            caller = frame.f_back
+            if caller is not None and is_piq_script_frame(caller):
+                self.switch((caller.f_code.co_filename, caller.f_lineno))
+            else:
+                self.switch(None)
+        return self.trace_script_frame
+
+    def wrap_parse_obj(self, parse_obj):
+        def profiled_parse_obj(typename, x, *args, **kwargs):
+            is_outermost = not self.typing_stack
+            if is_outermost:
+                # don't charge typing time to the evaluated line, e.g. when
+                # values are parsed while they are emitted
+                paused_location = self.current
+                self.switch(None)
+
+                if paused_location is not None:
+                    self.current_typing_filename = paused_location[0]
+                else:
+                    self.current_typing_filename = self.typing_filename
+
+            start_time = time.time()
+            self.typing_stack.append(0.0)
+            try:
+                return parse_obj(typename, x, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start_time
+                child_time = self.typing_stack.pop()
+                if self.typing_stack:
+                    self.typing_stack[-1] += elapsed
+
+                loc = getattr(x, 'loc', None)
+                line = loc.line if loc is not None else None
+                self.typing_times[(self.current_typing_filename, line)] += elapsed - child_time
+
+                if is_outermost:
+                    self.switch(paused_location)
+
+        return profiled_parse_obj
+
+    # return [(filename, line, eval_time, typing_time)] sorted by total time
+    def hot_spots(self):
+        res = {}
+        for location, t in self.eval_times.iteritems():
+            res[location] = [t, 0.0]
+        for location, t in self.typing_times.iteritems():
+            res.setdefault(location, [0.0, 0.0])[1] += t
+
+        hot_spots = [
+            (filename, line, eval_time, typing_time)
+            for (filename, line), (eval_time, typing_time) in res.iteritems()
+        ]
+        hot_spots.sort(key=lambda x: x[2] + x[3], reverse=True)
+        return hot_spots
+
+    def format_report(self, limit=None):
+        hot_spots = self.hot_spots()
+        total_time = sum(x[2] + x[3] for x in hot_spots)
+
+        lines = [
+            '{:>4} {:<30} {:>10} {:>10} {:>6}  {}\n'.format(
+                'rank', 'location', 'eval(s)', 'typing(s)', '%', 'source'
+            )
+        ]
+        for rank, (filename, line, eval_time, typing_time) in enumerate(hot_spots[:limit], 1):
+            location = '{}:{}'.format(filename or '-', line if line is not None else 'unknown')
+            if filename and line:
+                source = linecache.getline(filename, line).strip()
+            else:
+                source = ''
+            if total_time > 0:
+                percent = 100.0 * (eval_time + typing_time) / total_time
+            else:
+                percent = 0.0
+            lines.append('{:>4} {:<30} {:>10.4f} {:>10.4f} {:>6.1f}  {}\n'.format(
+                rank, location, eval_time, typing_time, percent, source
+            ))
+        return ''.join(lines)
+
+
+def profile_locations(typing_filename=None):
+    return LocationProfiler(typing_filename)
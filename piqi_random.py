@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+#
+# schema-driven generator of random valid documents for load testing
+#
+# usage: piqi_random.py [options] MODULE TYPENAME
+#
+#   MODULE is a module generated by piqic-python
+#
+# options:
+#
+#   --format json|piq       output format (default: json)
+#   --count N               number of top-level documents (default: 1)
+#   --seed N                random seed
+#   --max-depth N           depth after which optional fields are omitted and
+#                           repeated fields are empty (default: 8)
+#   --repeated-length N     maximum length of repeated fields and lists
+#                           (default: 10)
+#   --string-length N       maximum length of strings (default: 16)
+#   --optional-density P    probability of including an optional field
+#                           (default: 0.5)
+#   --positional            use positional (unlabeled) piq fields where piq
+#                           parsing can't confuse them with other fields
+#
+# JSON documents are written one per line; piq documents are written as
+# top-level expression statements, one per line, see
+# piq_transform.compile_file(emit_expressions=True)
+#
+# output is written while it is being generated, so memory use doesn't depend
+# on the size of the output
+
+import os
+import sys
+import json
+import base64
+import random
+import string
+
+import piqi
+import piqi_of_json
+
+
+# nesting depth beyond max_depth at which generation fails, e.g. for schemas
+# with required recursive fields
+MAX_EXTRA_DEPTH = 64
+
+
+# built-in int type -> (min, max)
+INT_RANGES = {
+    'int': (-2 ** 31, 2 ** 31 - 1),
+    'int32': (-2 ** 31, 2 ** 31 - 1),
+    'int32-fixed': (-2 ** 31, 2 ** 31 - 1),
+    'protobuf-int32': (-2 ** 31, 2 ** 31 - 1),
+    'uint': (0, 2 ** 32 - 1),
+    'uint32': (0, 2 ** 32 - 1),
+    'uint32-fixed': (0, 2 ** 32 - 1),
+    'int64': (-2 ** 63, 2 ** 63 - 1),
+    'int64-fixed': (-2 ** 63, 2 ** 63 - 1),
+    'protobuf-int64': (-2 ** 63, 2 ** 63 - 1),
+    # NOTE: piq and json parsers accept only int values, i.e. up to sys.maxint
+    'uint64': (0, min(2 ** 64 - 1, sys.maxint)),
+    'uint64-fixed': (0, min(2 ** 64 - 1, sys.maxint)),
+}
+
+
+class Generator(object):
+    def __init__(self, module, seed=None, max_depth=8, repeated_length=10,
+                 string_length=16, optional_density=0.5, positional=False):
+        self.module = module
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.repeated_length = repeated_length
+        self.string_length = string_length
+        self.optional_density = optional_density
+        self.positional = positional
+
+        # record name -> set of names of fields that can be positional
+        self._positional_fields = {}
+
+    def unalias(self, typename):
+        return piqi.get_unalias_table(self.module)[typename]
+
+    # return the built-in type the alias chain of a scalar type ends with
+    def builtin_type(self, typename):
+        while not piqi.is_piqi_type(typename):
+            type_tag, typedef = self.module.typedef_index[typename]
+            assert type_tag == 'alias'
+            typename = typedef['type']
+        return typename
+
+    def check_depth(self, depth):
+        if depth > self.max_depth + MAX_EXTRA_DEPTH:
+            raise ValueError('maximum nesting depth exceeded, check for required recursive fields')
+
+    # random choices shared by all output formats
+
+    def gen_scalar(self, type_tag, typename):
+        r = self.random
+        if type_tag == 'bool':
+            return r.random() < 0.5
+        elif type_tag == 'int':
+            lo, hi = INT_RANGES[self.builtin_type(typename)]
+            return r.randint(lo, hi)
+        elif type_tag == 'float':
+            return r.uniform(-1e6, 1e6)
+        elif type_tag == 'string':
+            n = r.randint(0, self.string_length)
+            return ''.join(r.choice(string.ascii_lowercase) for _ in xrange(n))
+        elif type_tag == 'binary':
+            n = r.randint(0, self.string_length)
+            return ''.join(chr(r.randint(0, 255)) for _ in xrange(n))
+        else:
+            assert False
+
+    def gen_length(self, depth):
+        if depth > self.max_depth:
+            return 0
+        else:
+            return self.random.randint(0, self.repeated_length)
+
+    # return [(field_spec, number of values)]
+    def choose_fields(self, t, depth):
+        res = []
+        for field_spec in t['field']:
+            mode = field_spec['mode']
+            if mode == 'required':
+                n = 1
+            elif mode == 'optional':
+                include = depth <= self.max_depth and self.random.random() < self.optional_density
+                n = int(include)
+            elif mode == 'repeated':
+                n = self.gen_length(depth)
+            else:
+                assert False
+            res.append((field_spec, n))
+        return res
+
+    def is_terminal_option(self, option_spec):
+        option_type = option_spec.get('type')
+        if option_type is None:
+            return True
+        type_tag, _ = self.unalias(option_type)
+        return type_tag not in ('record', 'list', 'variant', 'any')
+
+    def choose_option(self, t, depth):
+        options = t['option']
+        if depth > self.max_depth:
+            # prefer options that don't nest any further
+            terminal_options = [x for x in options if self.is_terminal_option(x)]
+            if terminal_options:
+                options = terminal_options
+        return self.random.choice(options)
+
+    # positional fields are emitted without labels only when none of the other
+    # fields that piqi_of_piq may parse positionally accept the same kind of
+    # piq nodes (see piqi_of_piq.try_parse_field)
+    def positional_fields(self, t):
+        res = self._positional_fields.get(t['name'])
+        if res is not None:
+            return res
+
+        typedef_index = self.module.typedef_index
+        candidates = [
+            (piqi.name_of_field(f), piqi.piq_node_kinds(typedef_index, f['type']))
+            for f in t['field'] if piqi.is_positional_field(typedef_index, f)
+        ]
+
+        res = set()
+        for name, kinds in candidates:
+            overlaps = any(kinds & other_kinds for other_name, other_kinds in candidates if other_name != name)
+            # NOTE: names could be confused with labels of other fields
+            if not overlaps and 'name' not in kinds:
+                res.add(name)
+
+        self._positional_fields[t['name']] = res
+        return res
+
+    # JSON
+
+    def write_json(self, typename, write, depth=0):
+        self.check_depth(depth)
+
+        type_tag, typedef = self.unalias(typename)
+        if type_tag == 'binary':
+            write(json.dumps(base64.b64encode(self.gen_scalar(type_tag, typename))))
+        elif type_tag == 'any':
+            write(json.dumps(self.gen_scalar('int', 'int')))
+        elif typedef is None:
+            write(json.dumps(self.gen_scalar(type_tag, typename)))
+        elif type_tag == 'record':
+            write('{')
+            sep = ''
+            for field_spec, n in self.choose_fields(typedef, depth):
+                if n == 0:
+                    continue
+                write(sep + json.dumps(piqi_of_json.json_name_of_field(field_spec)) + ':')
+                sep = ','
+                field_type = field_spec.get('type')
+                if field_type is None:  # flag
+                    write('true')
+                elif field_spec['mode'] == 'repeated':
+                    self.write_json_items(field_type, n, write, depth + 1)
+                else:
+                    self.write_json(field_type, write, depth + 1)
+            write('}')
+        elif type_tag == 'list':
+            self.write_json_items(typedef['type'], self.gen_length(depth), write, depth + 1)
+        elif type_tag == 'variant':
+            option_spec = self.choose_option(typedef, depth)
+            write('{' + json.dumps(piqi_of_json.json_name_of_option(option_spec)) + ':')
+            option_type = option_spec.get('type')
+            if option_type is None:
+                write('true')
+            else:
+                self.write_json(option_type, write, depth + 1)
+            write('}')
+        elif type_tag == 'enum':
+            option_spec = self.choose_option(typedef, depth)
+            write(json.dumps(piqi_of_json.json_name_of_option(option_spec)))
+        else:
+            assert False
+
+    def write_json_items(self, item_type, n, write, depth):
+        write('[')
+        for i in xrange(n):
+            if i:
+                write(',')
+            self.write_json(item_type, write, depth)
+        write(']')
+
+    # piq (piq_transform script syntax)
+
+    def write_piq(self, typename, write, depth=0):
+        self.check_depth(depth)
+
+        type_tag, typedef = self.unalias(typename)
+        if type_tag == 'any':
+            raise ValueError('piqi-any is not supported in piq')
+        elif typedef is None:
+            write(repr(self.gen_scalar(type_tag, typename)))
+        elif type_tag == 'record':
+            if self.positional:
+                positional_fields = self.positional_fields(typedef)
+            else:
+                positional_fields = ()
+
+            write('[')
+            sep = ''
+            for field_spec, n in self.choose_fields(typedef, depth):
+                name = piqi.name_of_field(field_spec)
+                field_type = field_spec.get('type')
+                for _ in xrange(n):
+                    write(sep)
+                    sep = ', '
+                    if field_type is None:  # flag
+                        write('.' + name)
+                    elif name in positional_fields:
+                        self.write_piq(field_type, write, depth + 1)
+                    else:
+                        self.write_piq_named(name, field_type, write, depth + 1)
+            write(']')
+        elif type_tag == 'list':
+            write('[')
+            for i in xrange(self.gen_length(depth)):
+                if i:
+                    write(', ')
+                self.write_piq(typedef['type'], write, depth + 1)
+            write(']')
+        elif type_tag in ('variant', 'enum'):
+            option_spec = self.choose_option(typedef, depth)
+            name = option_spec.get('name')
+            option_type = option_spec.get('type')
+            if option_type is None:
+                write('.' + name)
+            elif name is None:
+                # nameless option is represented by its value
+                self.write_piq(option_type, write, depth + 1)
+            else:
+                self.write_piq_named(name, option_type, write, depth + 1)
+        else:
+            assert False
+
+    def write_piq_named(self, name, typename, write, depth):
+        write('.' + name + ' ')
+
+        type_tag, _ = self.unalias(typename)
+        if type_tag in ('variant', 'enum'):
+            # values that start with a name must be parenthesized
+            write('(')
+            self.write_piq(typename, write, depth)
+            write(')')
+        else:
+            self.write_piq(typename, write, depth)
+
+    # top-level piq document as a script statement
+    def write_piq_document(self, typename, write):
+        type_tag, _ = self.unalias(typename)
+        if type_tag in ('variant', 'enum'):
+            # names are allowed only inside parens or brackets
+            write('(')
+            self.write_piq(typename, write)
+            write(')')
+        else:
+            self.write_piq(typename, write)
+        write('\n')
+
+    # piqi objects
+
+    def gen_obj(self, typename):
+        # NOTE: piqi objects refer to the module they are parsed with
+        saved_module = piqi._parse_piqi_module
+        piqi._parse_piqi_module = self.module
+        try:
+            return self.make_obj(typename)
+        finally:
+            piqi._parse_piqi_module = saved_module
+
+    def make_obj(self, typename, depth=0):
+        self.check_depth(depth)
+
+        type_tag, typedef = self.unalias(typename)
+        if type_tag == 'any':
+            return piqi.make_any(json_ast=self.gen_scalar('int', 'int'))
+        elif type_tag == 'binary':
+            return piqi.make_binary(bytearray(self.gen_scalar(type_tag, typename)))
+        elif typedef is None:
+            return piqi.make_scalar(self.gen_scalar(type_tag, typename))
+        elif type_tag == 'record':
+            fields = []
+            for field_spec, n in self.choose_fields(typedef, depth):
+                field_type = field_spec.get('type')
+                mode = field_spec['mode']
+                if field_type is None:  # flag
+                    value = piqi.make_scalar(n == 1)
+                elif mode == 'repeated':
+                    value = [self.make_obj(field_type, depth + 1) for _ in xrange(n)]
+                elif n == 1:
+                    value = self.make_obj(field_type, depth + 1)
+                else:
+                    value = piqi_of_json.parse_default(field_type, field_spec.get('default'))
+                fields.append((piqi.make_field_name(field_spec), value))
+            return piqi.make_record(fields, typedef['name'])
+        elif type_tag == 'list':
+            items = [self.make_obj(typedef['type'], depth + 1) for _ in xrange(self.gen_length(depth))]
+            return piqi.make_list(items, typedef['name'])
+        elif type_tag == 'variant':
+            option_spec = self.choose_option(typedef, depth)
+            option_type = option_spec.get('type')
+            if option_type is None:
+                value = None
+            else:
+                value = self.make_obj(option_type, depth + 1)
+            return piqi.make_variant(piqi.name_of_option(option_spec), value, typedef['name'])
+        elif type_tag == 'enum':
+            option_spec = self.choose_option(typedef, depth)
+            return piqi.make_enum(piqi.name_of_option(option_spec), typedef['name'])
+        else:
+            assert False
+
+
+# write count documents in json or piq format to output, or return an iterator
+# over count piqi objects if format is 'obj'
+def generate(module, typename, format='json', count=1, output=None, **kwargs):
+    generator = Generator(module, **kwargs)
+
+    if format == 'obj':
+        return (generator.gen_obj(typename) for _ in xrange(count))
+
+    if output is None:
+        output = sys.stdout
+    write = output.write
+
+    for _ in xrange(count):
+        if format == 'json':
+            generator.write_json(typename, write)
+            write('\n')
+        elif format == 'piq':
+            generator.write_piq_document(typename, write)
+        else:
+            assert False
+
+
+def main():
+    arg_format = 'json'
+    arg_count = 1
+    options = {}
+
+    args = sys.argv[1:]
+    positional_args = []
+
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '--format':
+            i += 1
+            arg_format = args[i]
+        elif a == '--count':
+            i += 1
+            arg_count = int(args[i])
+        elif a == '--seed':
+            i += 1
+            options['seed'] = int(args[i])
+        elif a == '--max-depth':
+            i += 1
+            options['max_depth'] = int(args[i])
+        elif a == '--repeated-length':
+            i += 1
+            options['repeated_length'] = int(args[i])
+        elif a == '--string-length':
+            i += 1
+            options['string_length'] = int(args[i])
+        elif a == '--optional-density':
+            i += 1
+            options['optional_density'] = float(args[i])
+        elif a == '--positional':
+            options['positional'] = True
+        elif a.startswith('-'):
+            sys.exit('unknown option: ' + a)
+        else:
+            positional_args.append(a)
+        i += 1
+
+    if len(positional_args) != 2 or arg_format not in ('json', 'piq'):
+        sys.exit('usage: piqi_random.py [options] MODULE TYPENAME')
+
+    module_name, typename = positional_args
+
+    # generated modules are normally found in the current directory
+    sys.path.insert(0, os.getcwd())
+    module = __import__(module_name)
+
+    generate(module, typename, format=arg_format, count=arg_count, output=sys.stdout, **options)
+
+
+if __name__ == '__main__':
+    main()
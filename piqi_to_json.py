@@ -1,5 +1,4 @@
 import collections
-import base64
 import wrappers
 
 import piqi
@@ -28,7 +27,7 @@ def gen(x):
 def gen_obj(x):
     if isinstance(x, piqi.List):
         return gen_list(x)
-    elif isinstance(x, piqi.Record):
+    elif isinstance(x, piqi.BaseRecord):
         return gen_record(x)
     elif isinstance(x, piqi.Enum):
         return gen_enum(x)
@@ -36,8 +35,12 @@ def gen_obj(x):
         return gen_variant(x)
     elif isinstance(x, piqi.Any):
         return gen_any(x)
-    elif isinstance(x, (bool, int, float, basestring)):
-        # TODO: binary -> base64
+    elif piqi.is_numeric_array(x):
+        # NOTE: converted in bulk, items are plain numbers
+        return x.tolist()
+    elif isinstance(x, (bytearray, memoryview)):  # binary
+        return piqi.b64encode(piqi.unwrap_object(x))
+    elif isinstance(x, (bool, int, long, float, basestring)):
         return piqi.unwrap_object(x)
     else:
         # TODO, XXX: piqi.Alias?
@@ -78,21 +81,30 @@ def gen_record(x):
 def gen_field(field_spec, record):
     field_name = piqi.make_field_name(field_spec)
     field_value = getattr(record, field_name)
+    return gen_field_value(field_spec, field_value, gen_obj)
+
+
+# return (skip, json value) of the field; gen converts field values to JSON
+def gen_field_value(field_spec, field_value, gen):
     field_mode = field_spec['mode']
     omit_missing = omit_missing_field(field_spec)
 
     if field_mode == 'repeated':
+        if piqi.is_numeric_array(field_value):
+            skip = (omit_missing and len(field_value) == 0)
+            return skip, field_value.tolist()
+
         assert isinstance(field_value, list)
 
         skip = (omit_missing and field_value == [])
 
-        return skip, [gen_obj(x) for x in field_value]
+        return skip, [gen(x) for x in field_value]
 
     elif field_mode == 'required':
         assert (field_value is not None)
 
         skip = False
-        return skip, gen_obj(field_value)
+        return skip, gen(field_value)
 
     elif field_mode == 'optional':
         if field_value is None:
@@ -110,7 +122,7 @@ def gen_field(field_spec, record):
 
         else:
             skip = False
-            return skip, gen_obj(field_value)
+            return skip, gen(field_value)
     else:
         assert False
 
@@ -133,7 +145,13 @@ def gen_variant(x):
 
 
 def find_option_spec(x, tag):
-    # TODO, XXX: is there a more efficient way to retrieve option name? 
+    option_tags = piqi.get_option_tags(x.__piqi_type__, x.__piqi_module__)
+    if option_tags is not None:
+        option_spec = option_tags.option_specs.get(tag)
+        if option_spec is not None:
+            return option_spec
+
+    # tags that were not interned
     type_tag, variant_or_enum_spec = resolve_type(x)
     option_spec_list = variant_or_enum_spec['option']
 
@@ -145,7 +163,72 @@ def find_option_spec(x, tag):
 
 
 def gen_enum(x):
-    option_spec = find_option_spec(x, x)
+    option_spec = find_option_spec(x, piqi.unwrap_object(x))
     json_name = piqi_of_json.json_name_of_option(option_spec)
 
     return json_name
+
+
+# builder of JSON values (see piqi.ObjectBuilder), i.e. piq is converted to JSON
+# without building piqi objects; the result is the same as gen() would return
+# for the parsed object
+class JsonBuilder(object):
+    def __init__(self):
+        # record name -> [(field spec, json name)]
+        self.record_fields = {}
+
+    def make_scalar(self, x, loc=None):
+        return x
+
+    def make_binary(self, x, loc=None):
+        return piqi.b64encode(x)
+
+    def make_record(self, t, values, loc=None):
+        record_fields = self.record_fields.get(t['name'])
+        if record_fields is None:
+            record_fields = self.record_fields[t['name']] = [
+                (field_spec, piqi_of_json.json_name_of_field(field_spec))
+                for field_spec in t['field']
+            ]
+
+        fields = []
+        for (field_spec, json_name), value in zip(record_fields, values):
+            # NOTE: values are JSON already
+            skip, json_value = gen_field_value(field_spec, value, json_value_of)
+            if not skip:
+                fields.append((json_name, json_value))
+
+        return collections.OrderedDict(fields)
+
+    def make_list(self, t, items, loc=None):
+        return items
+
+    def make_variant(self, t, tag, value, loc=None):
+        option_spec = find_option_spec_by_name(t, tag)
+        json_name = piqi_of_json.json_name_of_option(option_spec)
+
+        if value is None:  # option without type
+            value = True
+
+        return {json_name : value}
+
+    def make_enum(self, t, tag, loc=None):
+        option_spec = find_option_spec_by_name(t, tag)
+        return piqi_of_json.json_name_of_option(option_spec)
+
+    def make_any(self, loc=None, **kwargs):
+        return gen_any(piqi.Any(**kwargs))
+
+    def parse_default(self, field_type, default):
+        # NOTE: going through piqi objects to get exactly what gen() returns,
+        # e.g. 1.0 for float fields with default 1
+        return gen_obj(piqi_of_json.parse_default(field_type, default))
+
+
+def json_value_of(x):
+    return x
+
+
+def find_option_spec_by_name(t, name):
+    option_tags = piqi.get_option_tags(t['name'])
+    return option_tags.option_specs[piqi.make_name(name)]
@@ -0,0 +1,163 @@
+# protobuf binary format, see piqi_of_pb for the encoding
+
+import struct
+
+import piqi
+import piqi_of_pb
+
+from piqi_of_pb import WIRE_VARINT, WIRE_BLOCK, WIRE_TYPES, FIXED_FORMATS
+
+
+# top-level call
+#
+# typename, piqi_module: type of x and its schema module, needed only for
+# scalars, which don't carry their types; top-level values other than records,
+# lists and variants are encoded as field 1
+def gen(x, typename=None, piqi_module=None):
+    if typename is None:
+        typename = getattr(x, '__piqi_type__', None)
+        if typename is None:
+            raise ValueError('type of top-level scalar is unknown, typename is required')
+    if piqi_module is None:
+        piqi_module = getattr(x, '__piqi_module__', None)
+
+    if piqi_module is None and piqi.is_piqi_type(typename):
+        index = piqi_of_pb.get_builtin_pb_index()
+    else:
+        index = piqi_of_pb.get_pb_index(piqi_module)
+
+    unaliased = index.unalias.get(typename)
+    if unaliased is None:
+        raise ValueError('unknown type ' + piqi_of_pb.quote(typename))
+    type_tag, typedef = unaliased
+    if type_tag == 'any':
+        raise ValueError('piqi-any is not supported in protobuf format')
+
+    out = bytearray()
+    if type_tag in ('record', 'list', 'variant'):
+        gen_message(index, type_tag, typedef, x, out)
+    else:
+        gen_field(index, 1, typename, x, out)
+    return str(out)
+
+
+def gen_message(index, type_tag, typedef, x, out):
+    if type_tag == 'record':
+        gen_record(index, typedef, x, out)
+    elif type_tag == 'list':
+        gen_repeated(index, 1, typedef['type'], False, x, out)
+    elif type_tag == 'variant':
+        gen_variant(index, typedef, x, out)
+    else:
+        assert False
+
+
+def gen_record(index, t, x, out):
+    for f in index.records[t['name']]:
+        value = getattr(x, f.name)
+        if f.type is None:  # flag
+            if value:
+                gen_key(f.code, WIRE_VARINT, out)
+                gen_varint(1, out)
+        elif f.mode == 'repeated':
+            gen_repeated(index, f.code, f.type, f.packed, value, out)
+        elif value is not None:
+            gen_field(index, f.code, f.type, value, out)
+
+
+def gen_repeated(index, code, typename, packed, items, out):
+    # NOTE: not using "not items", because numpy arrays with several items
+    # have no truth value
+    if len(items) == 0:
+        return
+
+    if packed:
+        encoding = index.wire_encodings[typename]
+        block = bytearray()
+        for x in items:
+            gen_value(index, typename, encoding, x, block)
+        gen_block(code, block, out)
+    else:
+        for x in items:
+            gen_field(index, code, typename, x, out)
+
+
+def gen_variant(index, t, x, out):
+    tag, value = x
+    option = index.options[t['name']].by_tag[tag]
+    if option.type is None:
+        gen_key(option.code, WIRE_VARINT, out)
+        gen_varint(1, out)
+    else:
+        gen_field(index, option.code, option.type, value, out)
+
+
+def gen_field(index, code, typename, x, out):
+    encoding = index.wire_encodings[typename]
+    if encoding == 'block':
+        block = bytearray()
+        gen_value(index, typename, encoding, x, block)
+        gen_block(code, block, out)
+    else:
+        gen_key(code, WIRE_TYPES[encoding], out)
+        gen_value(index, typename, encoding, x, out)
+
+
+# generate value without key and, for blocks, without length
+def gen_value(index, typename, encoding, x, out):
+    type_tag, typedef = index.unalias[typename]
+    x = piqi.unwrap_object(x)
+
+    if typedef is not None:
+        if type_tag == 'enum':
+            code = index.options[typedef['name']].by_tag[x].code
+            gen_varint_value(code, encoding, out)
+        else:
+            gen_message(index, type_tag, typedef, x, out)
+
+    elif type_tag == 'string':
+        if isinstance(x, unicode):
+            x = x.encode('utf-8')
+        out += x
+    elif type_tag == 'binary':
+        out += x
+    elif type_tag == 'bool':
+        gen_varint(1 if x else 0, out)
+    elif type_tag in ('int', 'float'):
+        if WIRE_TYPES[encoding] == WIRE_VARINT:
+            gen_varint_value(int(x), encoding, out)
+        else:
+            out += struct.pack(FIXED_FORMATS[(type_tag, encoding)], x)
+    elif type_tag == 'any':
+        raise ValueError('piqi-any is not supported in protobuf format')
+    else:
+        assert False
+
+
+def gen_key(code, wire_type, out):
+    gen_varint((code << 3) | wire_type, out)
+
+
+def gen_block(code, block, out):
+    gen_key(code, WIRE_BLOCK, out)
+    gen_varint(len(block), out)
+    out += block
+
+
+def gen_varint_value(x, encoding, out):
+    if encoding == 'zigzag-varint':
+        if x >= 0:
+            x = x << 1
+        else:
+            x = ((-x) << 1) - 1
+    elif encoding == 'signed-varint':
+        if x < 0:
+            x += (1 << 64)
+    gen_varint(x, out)
+
+
+def gen_varint(x, out):
+    while x >= 0x80:
+        out.append((x & 0x7f) | 0x80)
+        x >>= 7
+    out.append(x)
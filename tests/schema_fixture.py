@@ -0,0 +1,74 @@
+# shared test fixtures: schema modules with the same interface as modules
+# generated by piqic-python, i.e. with typedef_index, but without generated
+# record classes unless a test adds them
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piq_transform
+
+
+def field(name, typename, mode='optional', **kwargs):
+    res = {'name': name, 'type': typename, 'mode': mode}
+    res.update(kwargs)
+    return res
+
+
+def option(name, typename=None):
+    res = {'name': name}
+    if typename is not None:
+        res['type'] = typename
+    return res
+
+
+def default(x):
+    return {'json': x}
+
+
+def make_schema_module(name, typedef_index):
+    m = types.ModuleType(name)
+    m.typedef_index = typedef_index
+    return m
+
+
+# test case with a schema module installed into sys.modules
+#
+# subclasses set module_name and define make_typedef_index(), which is called
+# for every test, so that tests don't share schema-level caches
+class SchemaTestCase(unittest.TestCase):
+    module_name = None
+
+    def make_typedef_index(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.schema_module = self.install_schema_module(self.module_name)
+
+    def install_schema_module(self, name):
+        m = make_schema_module(name, self.make_typedef_index())
+        sys.modules[name] = m
+        self.addCleanup(sys.modules.pop, name, None)
+        return m
+
+    # write piq script to a temporary file and return its name
+    def write_script(self, text):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        filename = os.path.join(tmpdir, 'doc.piq.py')
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    # evaluate piq script and return the value of its 'doc' variable
+    def exec_script(self, text, **kwargs):
+        filename = self.write_script(text)
+        exec_globals = {}
+        piq_transform.exec_file(filename, exec_globals, **kwargs)
+        return exec_globals['doc']
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# tests for the benchmark suite
+#
+# usage: python tests/test_bench.py
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench
+
+
+class BenchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    # every stage runs on every case; scale 0 makes empty documents, so that
+    # this only checks that the stages work, not how fast they are
+    def test_run_stages(self):
+        for case_name, make_case in bench.CASES:
+            for stage_name, make_stage in bench.STAGES:
+                x = bench.run_stage(case_name, make_case, stage_name, make_stage, 0, 1, self.tmpdir)
+                self.assertEqual((x['case'], x['stage']), (case_name, stage_name))
+                self.assertTrue(x['seconds'] >= 0)
+                self.assertTrue(bench.format_result(x).startswith(case_name))
+
+    def test_compare_results(self):
+        def result(stage, seconds, bytes_per_value=None):
+            return {'case': 'wide', 'stage': stage, 'seconds': seconds, 'bytes_per_value': bytes_per_value}
+
+        old = {'results': [result('a', 1.0, 100.0), result('b', 1.0), result('c', 1.0)]}
+        new = {'results': [
+            result('a', 1.05, 200.0),
+            result('b', 2.0),
+            {'case': 'wide', 'stage': 'c', 'error': 'ValueError: '},
+            result('d', 1.0),
+        ]}
+        self.assertEqual(bench.compare_results(old, new, 0.1), [
+            ('wide', 'a', 'bytes_per_value', 100.0, 200.0),
+            ('wide', 'b', 'seconds', 1.0, 2.0),
+        ])
+        self.assertEqual(bench.compare_results(old, new, 1.5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
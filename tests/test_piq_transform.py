@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# tests for the piq_transform module
+#
+# usage: python tests/test_piq_transform.py
+
+import os
+import sys
+import shutil
+import StringIO
+import tempfile
+import itertools
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piq
+import piq_transform
+
+
+class ScriptTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write_script(self, text, name='doc.piq.py'):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+
+class TokenStreamTest(unittest.TestCase):
+    def test_lookahead(self):
+        s = piq_transform.TokenStream(iter([1, 2, 3]))
+        self.assertEqual((s.peek(0), s.peek(2), s.peek(3)), (1, 3, None))
+        self.assertEqual([s.pop(), s.pop(), s.pop()], [1, 2, 3])
+        self.assertRaises(StopIteration, s.pop)
+
+    def test_transform(self):
+        text = 'x = [.foo-bar 1, .baz]\n'
+        res = piq_transform.untokenize(piq_transform.tokenize_and_transform_string(text))
+        self.assertEqual(res.split(), "x =[_piq_make_named ('foo-bar',(1 ,6 ))**1 ,_piq_make_name ('baz',(1 ,18 ))]".split())
+
+        tokens = list(piq_transform.tokenize_string(text))
+        self.assertEqual(
+            piq_transform.transform_token_list('-', tokens),
+            list(piq_transform.tokenize_and_transform_string(text)))
+
+    # only a few tokens are read ahead of the transformed output
+    def test_streaming(self):
+        consumed = [0]
+
+        def count_tokens(tokens):
+            for token in tokens:
+                consumed[0] += 1
+                yield token
+
+        text = 'x = [.a 1, .b]\n' * 1000
+        tokens = count_tokens(piq_transform.tokenize_string(text))
+        res = list(itertools.islice(piq_transform.transform_tokens('-', tokens), 20))
+        self.assertEqual(len(res), 20)
+        self.assertTrue(consumed[0] < 30)
+
+
+# domain boolean expression that records how it was built
+class Expr(object):
+    def __init__(self, s):
+        self.s = s
+
+    def __bool_and__(self, other):
+        return Expr('(' + self.s + ' & ' + other.s + ')')
+
+    def __bool_or__(self, other):
+        return Expr('(' + self.s + ' | ' + other.s + ')')
+
+    def __bool_not__(self):
+        return Expr('!' + self.s)
+
+
+class OperatorsTest(ScriptTestCase):
+    def execute(self, text, **kwargs):
+        filename = self.write_script(text)
+        program = piq_transform.compile_file(filename, transform_operators=True)
+        return program.execute(kwargs)
+
+    def test_bool_operators(self):
+        calls = []
+
+        def f(x):
+            calls.append(x)
+            return x
+
+        res = self.execute(
+            'a = 1 and f(2)\n'
+            'b = 0 and f(3)\n'
+            'c = [] and f(4)\n'
+            'd = 0 or f(5)\n'
+            'e = 6 or f(7)\n'
+            'g = 1 and 2 and 0 or f(8)\n',
+            f=f
+        )
+        # right-hand sides are evaluated only when needed; a false left-hand
+        # side of "and" makes the result False
+        self.assertEqual(calls, [2, 5, 8])
+        values = [piq.unwrap_object(res[x]) for x in 'abcdeg']
+        self.assertEqual(values, [2, False, False, 5, 6, 8])
+        self.assertTrue(values[2] is False)
+
+    def test_domain_operators(self):
+        res = self.execute('x = p and q or not p\ny = p or q and p\n', p=Expr('p'), q=Expr('q'))
+        self.assertEqual(piq.unwrap_object(res['x']).s, '((p & q) | !p)')
+        self.assertEqual(piq.unwrap_object(res['y']).s, '(p | (q & p))')
+
+        # domain and regular boolean values can't be mixed
+        for text in ('z = p and 1\n', 'z = 1 and p\n', 'z = p or 0\n'):
+            self.assertRaises(AssertionError, self.execute, text, p=Expr('p'))
+
+
+class ProgramTest(ScriptTestCase):
+    def test_run(self):
+        filename = self.write_script('x = [.n n]\n[.foo x]\n')
+        program = piq_transform.compile_file(filename)
+
+        # the same program runs with different parameters
+        for n in (1, 2):
+            user_globals = {'n': n}
+            res = program.run(user_globals)
+            self.assertEqual(str(res), '[.foo [.n ' + str(n) + ']]')
+            self.assertFalse(piq_transform.RESULT_NAME in user_globals)
+
+        res = program.run({'n': 3}, result_name='x')
+        self.assertEqual(str(res), '[.n 3]')
+
+        exec_globals = program.execute({'n': 4})
+        self.assertEqual(str(piq.parse(exec_globals['x'])), '[.n 4]')
+        self.assertFalse(piq_transform.RESULT_NAME in exec_globals)
+
+    def test_no_result(self):
+        filename = self.write_script('x = 1\n')
+        program = piq_transform.compile_file(filename)
+        self.assertEqual(program.run(), None)
+        self.assertEqual(program.run(result_name='y'), None)
+
+
+class BatchTest(ScriptTestCase):
+    def setUp(self):
+        ScriptTestCase.setUp(self)
+        self.write_script('[.a 1]\n', 'a.py')
+        self.write_script('[.b undefined_name]\n', 'b.py')
+        self.write_script('[.c 3]\n', 'c.txt')
+
+        # NOTE: not printing batch summaries among test results
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+
+    def run_batch(self, **kwargs):
+        output = StringIO.StringIO()
+        error_count = piq_transform.run_batch([self.tmpdir], output=output, **kwargs)
+        return error_count, output.getvalue().replace(self.tmpdir + os.sep, '').splitlines()
+
+    def test_run_batch(self):
+        expected_lines = ['a.py: [.a 1]', "b.py: NameError: name 'undefined_name' is not defined"]
+        for jobs in (1, 2):
+            self.assertEqual(self.run_batch(jobs=jobs), (1, expected_lines))
+        self.assertTrue('processed 2 files (1 failed' in sys.stderr.getvalue())
+
+        self.assertEqual(self.run_batch(jobs=1, suffix='.txt'), (0, ['c.txt: [.c 3]']))
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.assertEqual(self.run_batch(jobs=1, cache_dir=cache_dir)[0], 1)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        # programs are loaded from the cache by other processes without being
+        # compiled...
+        compiled = []
+        compile_file = piq_transform.compile_file
+
+        def counting_compile_file(filename, **kwargs):
+            compiled.append(filename)
+            return compile_file(filename, **kwargs)
+
+        piq_transform.compile_file = counting_compile_file
+        self.addCleanup(setattr, piq_transform, 'compile_file', compile_file)
+
+        piq_transform._program_cache.clear()
+        filename = os.path.join(self.tmpdir, 'a.py')
+        program = piq_transform.load_program(filename, transform_operators=True, cache_dir=cache_dir)
+        self.assertEqual(str(program.run()), '[.a 1]')
+        self.assertEqual(compiled, [])
+
+        # ... unless their source changes
+        self.write_script('[.a 2]\n', 'a.py')
+        os.utime(filename, (0, 0))
+        program = piq_transform.load_program(filename, transform_operators=True, cache_dir=cache_dir)
+        self.assertEqual(str(program.run()), '[.a 2]')
+        self.assertEqual(compiled, [filename])
+
+
+class StreamTest(ScriptTestCase):
+    def test_stream(self):
+        filename = self.write_script('"docstring"\nemit(1)\nx\nNone\n[.foo 2]\n')
+        program = piq_transform.compile_file(filename, emit_expressions=True)
+
+        values = []
+        user_globals = {'x': 3}
+        program.stream(values.append, user_globals)
+        self.assertEqual([str(x) for x in values], ['1', '3', '[.foo 2]'])
+
+        # emit functions are not left in the caller's globals
+        for name in (piq_transform.EMIT_NAME, piq_transform.EMIT_EXPRESSION_NAME, piq_transform.RESULT_NAME):
+            self.assertFalse(name in user_globals)
+        self.assertEqual(user_globals['x'], 3)
+
+        self.assertRaises(TypeError, program.run)
+
+    def test_stream_errors(self):
+        filename = self.write_script('emit(1)\nundefined_name\n')
+        program = piq_transform.compile_file(filename)
+
+        values = []
+        user_globals = {}
+        self.assertRaises(NameError, program.stream, values.append, user_globals)
+        self.assertEqual([str(x) for x in values], ['1'])
+        self.assertFalse(piq_transform.EMIT_NAME in user_globals)
+        self.assertFalse(piq_transform.EMIT_EXPRESSION_NAME in user_globals)
+
+
+if __name__ == '__main__':
+    unittest.main()
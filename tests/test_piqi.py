@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# tests for the piqi module
+#
+# usage: python tests/test_piqi.py
+
+import os
+import sys
+import base64
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+
+import schema_fixture
+from schema_fixture import field, option
+
+
+MODULE_NAME = 'test_piqi_schema'
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'point': ('record', {
+                'name': 'point',
+                'field': [
+                    field('x', 'int', 'required'),
+                    field('y', 'int', 'required'),
+                    field('label', 'string'),
+                ]
+            }),
+            'shape': ('record', {
+                'name': 'shape',
+                'field': [field('point', 'point', 'repeated')]
+            }),
+            'blob': ('record', {
+                'name': 'blob',
+                'field': [field('data', 'binary', 'required')]
+            }),
+            'color': ('enum', {
+                'name': 'color',
+                'option': [option('dark-red'), option('green')]
+            }),
+            'coord': ('alias', {'name': 'coord', 'type': 'small-int'}),
+            'small-int': ('alias', {'name': 'small-int', 'type': 'int32'}),
+            'my-point': ('alias', {'name': 'my-point', 'type': 'point'}),
+            'figure': ('variant', {
+                'name': 'figure',
+                'option': [option('point', 'point'), option('none')]
+            }),
+        }
+
+
+class RecordTest(SchemaTest):
+    def test_generic_record(self):
+        obj = piqi.Record([('x', 1), ('y', 2)])
+        self.assertEqual((obj.x, obj.y), (1, 2))
+        self.assertEqual(vars(obj), {'x': 1, 'y': 2})
+
+        # records of modules without generated classes are generic
+        obj = piqi.parse({'x': 1, 'y': 2}, MODULE_NAME, 'point', format='json')
+        self.assertTrue(type(piqi.unwrap_object(obj)) is piqi.Record)
+        self.assertEqual(vars(obj), {'x': 1, 'y': 2, 'label': None})
+        self.assertEqual(sorted(piqi.record_fields(obj)), [('label', None), ('x', 1), ('y', 2)])
+
+
+class ScalarCacheTest(SchemaTest):
+    def setUp(self):
+        SchemaTest.setUp(self)
+        self.other_module_name = MODULE_NAME + '_other'
+        self.install_schema_module(self.other_module_name)
+
+    def test_shared_proxies(self):
+        doc = {'x': 1, 'y': 1, 'label': 'a'}
+        obj = piqi.parse(doc, MODULE_NAME, 'point', format='json')
+        self.assertTrue(obj.x is obj.y)
+        self.assertTrue(obj.x.__piqi_module__ is sys.modules[MODULE_NAME])
+
+        # the same values parsed with another module are bound to that module
+        other = piqi.parse(doc, self.other_module_name, 'point', format='json')
+        self.assertTrue(other.x.__piqi_module__ is sys.modules[self.other_module_name])
+        self.assertTrue(other.label.__piqi_module__ is sys.modules[self.other_module_name])
+        self.assertTrue(obj.x.__piqi_module__ is sys.modules[MODULE_NAME])
+
+        # large values are not cached, but are bound to the module as well
+        doc = {'x': 10 ** 6, 'y': 10 ** 6, 'label': 'a' * 100}
+        obj = piqi.parse(doc, MODULE_NAME, 'point', format='json')
+        self.assertFalse(obj.x is obj.y)
+        self.assertTrue(obj.x.__piqi_module__ is sys.modules[MODULE_NAME])
+        self.assertTrue(obj.label.__piqi_module__ is sys.modules[MODULE_NAME])
+
+    def test_read_only(self):
+        obj = piqi.parse({'x': 1, 'y': 1}, MODULE_NAME, 'point', format='json')
+        self.assertRaises(AttributeError, setattr, obj.x, '_self_loc', None)
+        self.assertRaises(AttributeError, setattr, obj.x, 'foo', None)
+        self.assertRaises(AttributeError, delattr, obj.x, '_self_loc')
+        self.assertTrue(obj.y.__loc__ is None)
+
+
+class UnaliasTest(SchemaTest):
+    def test_piqi_types(self):
+        self.assertEqual(piqi.get_piqi_type('uint64-fixed'), 'int')
+        self.assertEqual(piqi.get_piqi_type('float32'), 'float')
+        self.assertEqual(piqi.get_piqi_type('piqi-any'), 'any')
+        self.assertEqual(piqi.get_piqi_type('point'), None)
+        self.assertFalse(piqi.is_piqi_type('coord'))
+
+    def test_unalias_table(self):
+        table = piqi.get_unalias_table(self.schema_module)
+        typedef_index = self.schema_module.typedef_index
+        self.assertEqual(table['coord'], ('int', None))
+        self.assertEqual(table['int64'], ('int', None))
+        self.assertEqual(table['my-point'], typedef_index['point'])
+        self.assertEqual(table['color'], typedef_index['color'])
+        self.assertEqual(piqi.unalias_in_index(typedef_index, 'coord'), ('int', None))
+        self.assertTrue(piqi.get_unalias_table(self.schema_module) is table)
+
+    # the unalias table of the module used last is switched along with the
+    # module being parsed
+    def test_modules(self):
+        other_module_name = MODULE_NAME + '_other'
+        typedef_index = self.make_typedef_index()
+        typedef_index['coord'] = ('alias', {'name': 'coord', 'type': 'string'})
+        sys.modules[other_module_name] = schema_fixture.make_schema_module(other_module_name, typedef_index)
+        self.addCleanup(sys.modules.pop, other_module_name, None)
+
+        for _ in range(2):
+            self.assertEqual(piqi.parse(1, MODULE_NAME, 'coord', format='json'), 1)
+            self.assertRaises(piqi.ParseError, piqi.parse, 'a', MODULE_NAME, 'coord', format='json')
+            self.assertEqual(piqi.parse('a', other_module_name, 'coord', format='json'), 'a')
+            self.assertRaises(piqi.ParseError, piqi.parse, 1, other_module_name, 'coord', format='json')
+
+        # ... and with the module's typedef index
+        self.schema_module.typedef_index = typedef_index
+        self.assertEqual(piqi.parse('a', MODULE_NAME, 'coord', format='json'), 'a')
+
+
+class BinaryTest(SchemaTest):
+    def test_base64(self):
+        # NOTE: small chunks to check decoding across chunk boundaries
+        self.addCleanup(setattr, piqi, 'BASE64_CHUNK_SIZE', piqi.BASE64_CHUNK_SIZE)
+        piqi.BASE64_CHUNK_SIZE = 8
+
+        for n in range(20):
+            data = ''.join(chr(i * 37 % 256) for i in range(n))
+            encoded = base64.b64encode(data)
+            self.assertEqual(piqi.b64encode(bytearray(data)), encoded)
+            res = piqi.b64decode(encoded)
+            self.assertTrue(type(res) is bytearray)
+            self.assertEqual(res, data)
+            self.assertEqual(piqi.b64decode(unicode(encoded)), data)
+
+        for x in ('abc', 'ab!d', 'abcd!bcd', u'ab\xe9d'):
+            self.assertRaises(ValueError, piqi.b64decode, x)
+
+    def test_json(self):
+        doc = {'data': base64.b64encode('\x00\xffab')}
+        a = piqi.parse(doc, MODULE_NAME, 'blob', format='json')
+        b = piqi.parse(doc, MODULE_NAME, 'blob', format='json')
+        self.assertTrue(type(piqi.unwrap_object(a.data)) is bytearray)
+        self.assertEqual(a.data, '\x00\xffab')
+        # binary values are mutable, i.e. never shared
+        self.assertFalse(piqi.unwrap_object(a.data) is piqi.unwrap_object(b.data))
+        self.assertEqual(piqi.gen(a), doc)
+
+        try:
+            piqi.parse({'data': 'ab!d'}, MODULE_NAME, 'blob', format='json')
+        except piqi.ParseError as e:
+            self.assertEqual(e.path, ('data',))
+        else:
+            self.fail('ParseError expected')
+
+    def test_views(self):
+        # pb binary fields are views of the input
+        data = bytearray('\n\x04\x00\xffab')
+        obj = piqi.parse(data, MODULE_NAME, 'blob', format='pb')
+        self.assertTrue(type(piqi.unwrap_object(obj.data)) is memoryview)
+        data[2] = 'x'
+        self.assertEqual(obj.data.tobytes(), 'x\xffab')
+
+        # piq binary values are views of the script's strings
+        obj = piqi.parse(self.exec_script('doc = [.data "\\x00ab"]\n'), MODULE_NAME, 'blob')
+        self.assertTrue(type(piqi.unwrap_object(obj.data)) is memoryview)
+        self.assertEqual(piqi.gen(obj), {'data': base64.b64encode('\x00ab')})
+
+
+class InternedTagsTest(SchemaTest):
+    def test_enum(self):
+        a = piqi.unwrap_object(piqi.parse('dark_red', MODULE_NAME, 'color', format='json'))
+        b = piqi.unwrap_object(piqi.parse(self.exec_script('doc = (.dark-red)\n'), MODULE_NAME, 'color'))
+        self.assertTrue(type(a) is piqi.Enum)
+        self.assertEqual(a, 'dark_red')
+        self.assertTrue(a is b)
+
+        option_tags = piqi.get_option_tags('color', self.schema_module)
+        self.assertTrue(option_tags.tags['dark-red'] is a)
+        self.assertEqual(option_tags.option_specs[a], {'name': 'dark-red'})
+
+    def test_variant(self):
+        obj = piqi.parse({'none': True}, MODULE_NAME, 'figure', format='json')
+        a = piqi.unwrap_object(obj)
+        b = piqi.unwrap_object(piqi.parse(self.exec_script('doc = (.none)\n'), MODULE_NAME, 'figure'))
+        self.assertTrue(type(a[0]) is piqi.Tag)
+        self.assertTrue(a[0] is b[0])
+        self.assertEqual(piqi.gen(obj), {'none': True})
+
+    # tags are interned per typedef index, i.e. recreated along with it
+    def test_typedef_index_change(self):
+        tag = piqi.get_option_tags('color', self.schema_module).tags['green']
+        self.assertTrue(piqi.get_option_tags('color', self.schema_module).tags['green'] is tag)
+
+        self.schema_module.typedef_index = self.make_typedef_index()
+        new_tag = piqi.get_option_tags('color', self.schema_module).tags['green']
+        self.assertFalse(new_tag is tag)
+        self.assertEqual(new_tag, tag)
+
+        self.assertEqual(piqi.get_option_tags('point', self.schema_module), None)
+
+
+class LocationsTest(SchemaTest):
+    def script(self, y):
+        return self.exec_script('doc = [\n    .point [.x 1, .y 2],\n    .point [.x 3, .y ' + y + ']\n]\n')
+
+    def test_keep(self):
+        obj = piqi.parse(self.script('4'), MODULE_NAME, 'shape')
+        self.assertEqual(obj.__loc__.line, 1)
+        self.assertEqual((obj.point_list[1].__loc__.line, obj.point_list[1].x.__loc__.line), (3, 3))
+
+    def test_parse(self):
+        obj = piqi.parse(self.script('4'), MODULE_NAME, 'shape', locations='parse')
+        self.assertTrue(obj.__loc__ is None)
+        self.assertTrue(obj.point_list[1].x.__loc__ is None)
+
+    def test_table(self):
+        table = piqi.LocationTable()
+        obj = piqi.parse(self.script('4'), MODULE_NAME, 'shape', locations=table)
+        self.assertTrue(obj.point_list[1].__loc__ is None)
+        self.assertTrue(obj.point_list[1].x.__loc__ is None)
+        self.assertEqual(len(table), 7)
+        self.assertEqual(table.get(())[0], 1)
+        self.assertEqual(table.get(('point_list', 1, 'x'))[0], 3)
+        self.assertEqual(table.get(('point_list', 2)), None)
+
+    def test_errors(self):
+        doc = self.script('"a"')
+        for locations, line in (('keep', 3), ('parse', 3), ('none', None)):
+            try:
+                piqi.parse(doc, MODULE_NAME, 'shape', locations=locations)
+            except piqi.ParseError as e:
+                self.assertEqual(e.loc.line if e.loc else None, line)
+                self.assertEqual(e.path, ('point_list', 1, 'y'))
+            else:
+                self.fail('ParseError expected')
+
+
+class ValidateTest(SchemaTest):
+    def validate(self, x, format):
+        return [
+            (e.error, piqi.format_path(e.path))
+            for e in piqi.validate(x, MODULE_NAME, 'shape', format=format)
+        ]
+
+    def test_piq(self):
+        doc = self.exec_script('doc = [.point [.x 1, .y 2], .point [.x 3, .y 4, .label "a"]]\n')
+        self.assertEqual(self.validate(doc, 'piq'), [])
+
+        doc = self.exec_script('doc = [.point [.x 1, .y 2], .point [.x 3, .y "a"]]\n')
+        self.assertEqual(self.validate(doc, 'piq'), [('int constant expected', 'point_list[1].y')])
+
+        # errors carry locations as well
+        errors = piqi.validate(doc, MODULE_NAME, 'shape')
+        self.assertEqual(errors[0].loc.line, 1)
+
+    def test_json(self):
+        doc = {'point': [{'x': 1, 'y': 2}, {'x': 3, 'y': 4, 'label': 'a'}]}
+        self.assertEqual(self.validate(doc, 'json'), [])
+
+        doc = {'point': [{'x': 1, 'y': 2}, {'x': 3}]}
+        self.assertEqual(self.validate(doc, 'json'), [("missing field 'y'", 'point_list[1].y')])
+
+        doc = {'point': [{'x': 1, 'y': 2, 'z': 3}]}
+        self.assertEqual(self.validate(doc, 'json'), [("unknown field: ('z', 3)", 'point_list[0]')])
+
+    def test_unsupported_formats(self):
+        self.assertRaises(ValueError, piqi.validate, '', MODULE_NAME, 'shape', format='pb')
+
+    def test_validate_all(self):
+        doc = {'point': [{'x': 1, 'y': 2}, {'x': 3, 'y': 'a'}]}
+
+        # objects without lazy records are valid once parsed
+        obj = piqi.parse({'point': doc['point'][:1]}, MODULE_NAME, 'shape', format='json')
+        piqi.validate_all(obj)
+
+        obj = piqi.parse(doc, MODULE_NAME, 'shape', format='json', lazy=True)
+        try:
+            piqi.validate_all(obj)
+        except piqi.ParseError as e:
+            self.assertEqual(str(e), 'point_list[1].y: int constant expected')
+        else:
+            self.fail('ParseError expected')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# tests for memory footprint reports
+#
+# usage: python tests/test_piqi_memory.py
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+import piqi_memory
+
+import schema_fixture
+from schema_fixture import field
+
+
+MODULE_NAME = 'test_piqi_memory_schema'
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'point': ('record', {
+                'name': 'point',
+                'field': [
+                    field('x', 'int', 'required'),
+                    field('y', 'int', 'required'),
+                ]
+            }),
+            'shape': ('record', {
+                'name': 'shape',
+                'field': [
+                    field('name', 'string', 'required'),
+                    field('point', 'point', 'repeated'),
+                ]
+            }),
+        }
+
+
+class LazyRecordTest(SchemaTest):
+    # measuring lazy records doesn't decode their fields
+    def test_measure_lazy_record(self):
+        doc = {'name': 'square', 'point': [{'x': i, 'y': i} for i in range(100)]}
+        obj = piqi.project(doc, MODULE_NAME, 'shape', ['name'])
+
+        decoded_fields = dict(vars(obj))
+        self.assertEqual(decoded_fields.keys(), ['name'])
+
+        report = piqi_memory.measure(obj)
+        self.assertEqual(vars(obj), decoded_fields)
+
+        # raw points are counted as payload of the lazy record
+        stats = report.types['shape']
+        self.assertEqual(stats.count, 1)
+        self.assertTrue(stats.bytes['payload'] > sys.getsizeof(doc['point']))
+        self.assertTrue('point' not in report.types)
+
+        # once decoded, points are counted as piqi objects
+        self.assertEqual(len(obj.point_list), 100)
+        report = piqi_memory.measure(obj)
+        self.assertEqual(report.types['point'].count, 100)
+
+
+class ReportTest(SchemaTest):
+    SCRIPT = 'doc = [.name "s", .point [.x 1, .y 2], .point [.x 3, .y 1]]\n'
+
+    def test_types(self):
+        obj = piqi.parse(self.exec_script(self.SCRIPT), MODULE_NAME, 'shape')
+        report = piqi_memory.measure(obj)
+
+        self.assertEqual(
+            sorted((x.name, x.count) for x in report.types.values()),
+            [('<int>', 4), ('<str>', 1), ('point', 2), ('shape', 1)])
+        self.assertEqual(report.values, 8)
+        self.assertEqual(report.total_bytes, sum(report.category_bytes(c) for c in piqi_memory.CATEGORIES))
+        self.assertEqual(report.bytes_per_value, report.total_bytes / 8.0)
+
+        # records of modules without generated classes have __dict__
+        self.assertTrue(report.types['point'].bytes['dict'] > 0)
+        self.assertEqual(report.types['<int>'].bytes['dict'], 0)
+
+        lines = report.format_report().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[-1].split()[:3], ['total', '8', str(report.total_bytes)])
+
+    def test_locations(self):
+        doc = self.exec_script(self.SCRIPT)
+        report = piqi_memory.measure(piqi.parse(doc, MODULE_NAME, 'shape'))
+        self.assertTrue(report.category_bytes('loc') > 0)
+
+        obj = piqi.parse(doc, MODULE_NAME, 'shape', locations='none')
+        report = piqi_memory.measure(obj)
+        self.assertEqual(report.category_bytes('loc'), 0)
+
+        # without locations, proxies of equal small ints are shared and counted
+        # once
+        proxies = dict((id(x), x) for p in obj.point_list for x in (p.x, p.y))
+        self.assertEqual(len(proxies), 3)
+        self.assertEqual(report.types['<int>'].bytes['proxy'], sum(
+            sys.getsizeof(x) + sys.getsizeof(piqi_memory.instance_dict(x))
+            for x in proxies.values()
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
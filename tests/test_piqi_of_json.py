@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+# tests for parsing JSON
+#
+# usage: python tests/test_piqi_of_json.py
+
+import os
+import sys
+import array
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+
+import schema_fixture
+from schema_fixture import field, option, default
+
+
+MODULE_NAME = 'test_piqi_of_json_schema'
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'point': ('record', {
+                'name': 'point',
+                'field': [
+                    field('x', 'int', 'required'),
+                    field('y', 'int', 'required'),
+                ]
+            }),
+            'shape': ('variant', {
+                'name': 'shape',
+                'option': [
+                    option('point', 'point'),
+                    option('points', 'point-list'),
+                    option('radius', 'float'),
+                    option('empty'),
+                ]
+            }),
+            'my-shape': ('alias', {'name': 'my-shape', 'type': 'shape'}),
+            'point-list': ('list', {'name': 'point-list', 'type': 'point'}),
+            'samples': ('record', {
+                'name': 'samples',
+                'field': [
+                    field('name', 'string', 'required'),
+                    field('value', 'int', 'repeated'),
+                    field('origin', 'point'),
+                ]
+            }),
+            'float-list': ('list', {'name': 'float-list', 'type': 'float'}),
+            'arrays': ('record', {
+                'name': 'arrays',
+                'field': [
+                    field('i', 'int', 'repeated'),
+                    field('u', 'uint32', 'repeated'),
+                    field('f', 'float', 'repeated'),
+                    field('l', 'float-list'),
+                    field('s', 'string', 'repeated'),
+                ]
+            }),
+            'doc': ('record', {
+                'name': 'doc',
+                'field': [
+                    field('header', 'samples', 'required'),
+                    field('item', 'samples', 'repeated'),
+                    field('shape', 'shape'),
+                    field('status', 'int'),
+                ]
+            }),
+            'defaults': ('record', {
+                'name': 'defaults',
+                'field': [
+                    field('i', 'int', default=default(1)),
+                    field('point', 'point', default=default({'x': 1, 'y': 2})),
+                    field('points', 'point-list', default=default([{'x': 1, 'y': 2}])),
+                    field('shape-point', 'my-shape', default=default({'point': {'x': 1, 'y': 2}})),
+                    field('shape-points', 'shape', default=default({'points': [{'x': 1, 'y': 2}]})),
+                    field('shape-radius', 'my-shape', default=default({'radius': 1.5})),
+                    field('shape-empty', 'shape', default=default({'empty': True})),
+                ]
+            }),
+        }
+
+
+class DefaultsTest(SchemaTest):
+    def parse(self, x, typename):
+        return piqi.parse(x, MODULE_NAME, typename, format='json')
+
+    # defaults that can be modified in place are not shared between records
+    def test_mutable_defaults(self):
+        a = self.parse({}, 'defaults')
+        b = self.parse({}, 'defaults')
+
+        a.point.x = 10
+        a.points.append(None)
+        a.shape_point[1].x = 10
+        a.shape_points[1][0].x = 10
+
+        self.assertEqual(piqi.gen(b), {
+            'i': 1,
+            'point': {'x': 1, 'y': 2},
+            'points': [{'x': 1, 'y': 2}],
+            'shape_point': {'point': {'x': 1, 'y': 2}},
+            'shape_points': {'points': [{'x': 1, 'y': 2}]},
+            'shape_radius': {'radius': 1.5},
+            'shape_empty': {'empty': True},
+        })
+
+    # immutable defaults are parsed once
+    def test_shared_defaults(self):
+        a = self.parse({}, 'defaults')
+        b = self.parse({}, 'defaults')
+        self.assertTrue(a.i is b.i)
+        self.assertTrue(a.shape_radius is b.shape_radius)
+        self.assertTrue(a.shape_empty is b.shape_empty)
+        self.assertFalse(a.point is b.point)
+        self.assertFalse(a.shape_point is b.shape_point)
+        self.assertFalse(a.shape_points is b.shape_points)
+
+
+class OptionsTest(SchemaTest):
+    def test_options(self):
+        obj = piqi.parse({'radius': 1.5}, MODULE_NAME, 'my-shape', format='json')
+        self.assertEqual(tuple(obj), ('radius', 1.5))
+        try:
+            piqi.parse({'square': 1}, MODULE_NAME, 'shape', format='json')
+        except piqi.ParseError as e:
+            self.assertEqual(e.error, "unknown variant option 'square'")
+        else:
+            self.fail('ParseError expected')
+
+
+class ArraysTest(SchemaTest):
+    def parse(self, doc, numeric_arrays='array'):
+        return piqi.parse(doc, MODULE_NAME, 'arrays', format='json', numeric_arrays=numeric_arrays)
+
+    def test_arrays(self):
+        doc = {'i': [1, -2], 'u': [3], 'f': [1, 2.5], 'l': [0.5], 's': ['a']}
+        obj = self.parse(doc)
+        self.assertEqual(obj.i_list, array.array('l', [1, -2]))
+        self.assertEqual(obj.u_list, array.array('I', [3]))
+        self.assertEqual(obj.f_list, array.array('d', [1.0, 2.5]))
+        self.assertEqual(piqi.unwrap_object(obj.l), array.array('d', [0.5]))
+        self.assertEqual(obj.s_list, ['a'])
+        self.assertEqual(piqi.gen(obj), doc)
+
+        # the same values without numeric arrays
+        self.assertEqual(piqi.gen(self.parse(doc, numeric_arrays=None)), doc)
+
+    def test_conversions(self):
+        obj = self.parse({'f': [1.5, 'NaN', 'Infinity']})
+        self.assertEqual(obj.f_list.typecode, 'd')
+        self.assertEqual(obj.f_list[2], float('inf'))
+
+        # values that don't fit are parsed into lists as usual
+        obj = self.parse({'u': [1, -1]})
+        self.assertEqual(obj.u_list, [1, -1])
+
+    def test_errors(self):
+        for doc, path in (({'i': [1, 'x']}, 'i_list[1]'), ({'i': [1.5]}, 'i_list[0]'), ({'l': [0.5, 'x']}, 'l[1]')):
+            try:
+                self.parse(doc)
+            except piqi.ParseError as e:
+                self.assertEqual(piqi.format_path(e.path), path)
+            else:
+                self.fail('ParseError expected')
+
+    @unittest.skipIf(piqi.numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        obj = self.parse({'i': [1, 2], 'f': [0.5]}, numeric_arrays='numpy')
+        self.assertTrue(isinstance(obj.i_list, piqi.numpy.ndarray))
+        self.assertEqual(obj.i_list.tolist(), [1, 2])
+        self.assertEqual(obj.f_list.tolist(), [0.5])
+
+
+class LazyTest(SchemaTest):
+    def test_numeric_arrays(self):
+        doc = {'name': 'a', 'value': [1, 2, 3]}
+        obj = piqi.parse(doc, MODULE_NAME, 'samples', format='json', lazy=True, numeric_arrays='array')
+        self.assertTrue(isinstance(piqi.unwrap_object(obj), piqi.LazyRecord))
+        self.assertEqual(obj.value_list, array.array('l', [1, 2, 3]))
+
+    def test_unsupported_formats(self):
+        for format in ('piq', 'pb'):
+            self.assertRaises(ValueError, piqi.parse, '', MODULE_NAME, 'samples', format=format, lazy=True)
+
+
+DOC = {
+    'header': {'name': 'h', 'value': [1], 'origin': {'x': 1, 'y': 2}},
+    'item': [
+        {'name': 'a', 'value': [1, 2], 'origin': {'x': 3, 'y': 4}},
+        {'name': 'b'},
+    ],
+    'shape': {'point': {'x': 5, 'y': 6}},
+    'status': 0,
+}
+
+
+class ProjectionTest(SchemaTest):
+    def project(self, doc, paths, lazy=False):
+        return piqi.project(doc, MODULE_NAME, 'doc', paths, lazy=lazy)
+
+    def decoded_fields(self, x):
+        return sorted(vars(piqi.unwrap_object(x)).keys())
+
+    def test_make_projection(self):
+        self.assertEqual(
+            piqi.make_projection(['header.origin.x', ('header', 'name'), 'status']),
+            {'header': {'origin': {'x': None}, 'name': None}, 'status': None})
+        # selecting the whole value overrides selecting its parts
+        self.assertEqual(
+            piqi.make_projection(['header', 'header.name']),
+            {'header': None})
+
+    def test_nested_paths(self):
+        obj = self.project(DOC, ['header.origin.x', 'item_list.name', 'shape.point.y'])
+
+        self.assertEqual(self.decoded_fields(obj), ['header', 'item_list', 'shape'])
+        self.assertEqual(self.decoded_fields(obj.header), ['origin'])
+        self.assertEqual(self.decoded_fields(obj.header.origin), ['x'])
+        self.assertEqual(obj.header.origin.x, 1)
+        self.assertEqual([self.decoded_fields(x) for x in obj.item_list], [['name'], ['name']])
+        self.assertEqual([x.name for x in obj.item_list], ['a', 'b'])
+        self.assertEqual(self.decoded_fields(obj.shape[1]), ['y'])
+
+    def test_unselected_fields(self):
+        obj = self.project(DOC, ['header.name'])
+        self.assertEqual(self.decoded_fields(obj.header), ['name'])
+
+        # unselected fields are decoded as a whole on access
+        origin = obj.header.origin
+        self.assertFalse(isinstance(piqi.unwrap_object(origin), piqi.LazyRecord))
+        self.assertEqual((origin.x, origin.y), (1, 2))
+        self.assertEqual(self.decoded_fields(obj.header), ['name', 'origin'])
+        self.assertEqual(piqi.gen(obj), DOC)
+
+        # ... or lazily
+        obj = self.project(DOC, ['header.name'], lazy=True)
+        self.assertTrue(isinstance(piqi.unwrap_object(obj.header.origin), piqi.LazyRecord))
+        self.assertTrue(isinstance(piqi.unwrap_object(obj.item_list[0]), piqi.LazyRecord))
+        self.assertEqual(piqi.gen(obj), DOC)
+
+    def test_invalid_unselected_fields(self):
+        doc = dict(DOC, status='x')
+        obj = self.project(doc, ['header'])
+        self.assertEqual(obj.header.name, 'h')
+        try:
+            obj.status
+        except piqi.ParseError as e:
+            self.assertEqual((e.error, e.path), ('int constant expected', ('status',)))
+        else:
+            self.fail('ParseError expected')
+
+    def test_invalid_paths(self):
+        self.assertRaises(piqi.ParseError, self.project, DOC, ['foo'])
+        self.assertRaises(piqi.ParseError, self.project, DOC, ['status.foo'])
+
+    def assertValidationError(self, doc, paths, error, path):
+        obj = self.project(doc, paths, lazy=True)
+        try:
+            piqi.validate_all(obj)
+        except piqi.ParseError as e:
+            self.assertEqual((e.error, piqi.format_path(e.path)), (error, path))
+        else:
+            self.fail('ParseError expected')
+
+    def test_validate_all(self):
+        obj = self.project(DOC, ['item_list.name'], lazy=True)
+        piqi.validate_all(obj)
+        self.assertEqual(self.decoded_fields(obj), ['header', 'item_list', 'shape', 'status'])
+        self.assertEqual(piqi.gen(obj), DOC)
+
+        # invalid values
+        doc = dict(DOC, item=[DOC['item'][0], {'name': 'b', 'value': ['x']}])
+        self.assertValidationError(doc, ['item_list.name'], 'int constant expected', 'item_list[1].value_list[0]')
+        doc = dict(DOC, shape={'point': {'x': 1}})
+        self.assertValidationError(doc, [], "missing field 'y'", 'shape.point.y')
+
+        # unknown fields
+        doc = dict(DOC, foo=1)
+        self.assertValidationError(doc, [], "unknown field: ('foo', 1)", '')
+        doc = dict(DOC, header=dict(DOC['header'], foo=1))
+        self.assertValidationError(doc, ['header.name'], "unknown field: ('foo', 1)", 'header')
+        doc = dict(DOC, item=[DOC['item'][0], {'name': 'b', 'origin': {'x': 1, 'y': 2, 'z': 3}}])
+        self.assertValidationError(doc, [], "unknown field: ('z', 3)", 'item_list[1].origin')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# tests for parsing piq
+#
+# usage: python tests/test_piqi_of_piq.py
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+import piqi_of_piq
+
+import schema_fixture
+from schema_fixture import field, option
+
+
+MODULE_NAME = 'test_piqi_of_piq_schema'
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'pos': ('record', {
+                'name': 'pos',
+                'field': [
+                    field('i', 'int', 'required'),
+                    field('s', 'string', 'required'),
+                    field('f', 'float', 'required'),
+                    field('b', 'bool'),
+                ]
+            }),
+            'pos-doc': ('record', {
+                'name': 'pos-doc',
+                'field': [field('p', 'pos', 'repeated', piq_positional=True)]
+            }),
+            'value': ('variant', {
+                'name': 'value',
+                'option': [option('i', 'int'), option('s', 'string')]
+            }),
+            'value-doc': ('record', {
+                'name': 'value-doc',
+                'field': [field('v', 'value', 'repeated')]
+            }),
+        }
+
+
+class PositionalFieldsTest(SchemaTest):
+    # positional values which are false in a boolean context are parsed
+    # successfully rather than treated as failed try-parse attempts
+    def test_false_positional_values(self):
+        doc = self.exec_script('doc = [[0, "", 0.0, False], [1, "a", 1.5, True]]\n')
+
+        obj = piqi.parse(doc, MODULE_NAME, 'pos-doc', locations='none')
+        self.assertEqual(
+            [(p.i, p.s, p.f, p.b) for p in obj.p_list],
+            [(0, '', 0.0, False), (1, 'a', 1.5, True)])
+
+        self.assertEqual(piqi.validate(doc, MODULE_NAME, 'pos-doc'), [])
+
+        # piq -> json conversion builds plain values, i.e. 0, '', False
+        res = piqi.convert(doc, MODULE_NAME, 'pos-doc')
+        self.assertEqual(res, {'p': [
+            {'i': 0, 's': '', 'f': 0.0, 'b': False},
+            {'i': 1, 's': 'a', 'f': 1.5, 'b': True},
+        ]})
+
+    def test_invalid_positional_value(self):
+        doc = self.exec_script('doc = [[0, "", 0.0, "x"]]\n')
+        self.assertRaises(piqi.ParseError, piqi.parse, doc, MODULE_NAME, 'pos-doc', locations='none')
+        self.assertEqual(len(piqi.validate(doc, MODULE_NAME, 'pos-doc')), 1)
+
+
+class CountersTest(SchemaTest):
+    def parse(self, text, typename):
+        counters = piqi_of_piq.ParseCounters()
+        piqi.parse(self.exec_script(text), MODULE_NAME, typename, counters=counters)
+        self.assertTrue(piqi_of_piq._counters is None)
+        return counters
+
+    def field_counters(self, counters):
+        return dict(
+            (record_name + '.' + field_name, (x.attempts, x.failures, x.exceptions))
+            for (record_name, field_name), x in counters.fields.items()
+        )
+
+    def test_fields(self):
+        # "a" is tried as i before it is parsed as s; b is optional and not
+        # tried once all elements are parsed
+        counters = self.parse('doc = [["a", 1, 1.5]]\n', 'pos-doc')
+        self.assertEqual(self.field_counters(counters), {
+            'pos-doc.p': (1, 0, 0),
+            'pos.i': (2, 1, 1),
+            'pos.s': (1, 0, 0),
+            'pos.f': (1, 0, 0),
+        })
+
+    def test_variants(self):
+        counters = self.parse('doc = ["a", 1, .s "b"]\n', 'value-doc')
+        x = counters.variants['value']
+        self.assertEqual((x.parses, x.failures, x.options_scanned), (3, 0, 5))
+
+        report = counters.format_report().splitlines()
+        self.assertEqual(report[-1].split(), ['value', '3', '0', '5'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# tests for protobuf encoding and decoding
+#
+# usage: python tests/test_piqi_pb.py
+
+import os
+import sys
+import array
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+
+import schema_fixture
+from schema_fixture import field, option
+
+
+MODULE_NAME = 'test_piqi_pb_schema'
+
+# NOTE: 2 ** 63 - 1 is a long, but parsing JSON ints accepts only ints
+INT64_MAX = int(2 ** 63 - 1)
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'my-int': ('alias', {'name': 'my-int', 'type': 'int'}),
+            'numbers': ('record', {
+                'name': 'numbers',
+                'field': [
+                    field('i', 'int'),
+                    field('i64', 'int64'),
+                    field('u', 'uint64'),
+                    field('p32', 'protobuf-int32'),
+                    field('p64', 'protobuf-int64'),
+                    field('fi32', 'int32-fixed'),
+                    field('fu32', 'uint32-fixed'),
+                    field('fi64', 'int64-fixed'),
+                    field('fu64', 'uint64-fixed'),
+                    field('f32', 'float32'),
+                    field('f64', 'float64'),
+                    field('b', 'bool'),
+                    field('s', 'string'),
+                ]
+            }),
+            'arrays': ('record', {
+                'name': 'arrays',
+                'field': [
+                    field('packed-int', 'int', 'repeated', protobuf_packed=True),
+                    field('packed-fixed', 'int64-fixed', 'repeated', protobuf_packed=True),
+                    field('packed-float', 'float', 'repeated', protobuf_packed=True),
+                    field('packed-color', 'color', 'repeated', protobuf_packed=True),
+                    field('unpacked-int', 'int', 'repeated'),
+                ]
+            }),
+            'color': ('enum', {
+                'name': 'color',
+                'option': [option('red'), option('green'), option('blue')],
+            }),
+            'shape': ('variant', {
+                'name': 'shape',
+                'option': [
+                    option('point', 'numbers'),
+                    option('circle', 'float'),
+                    option('color', 'color'),
+                    option('empty'),
+                ]
+            }),
+            'shape-list': ('list', {'name': 'shape-list', 'type': 'shape'}),
+        }
+
+
+class PbTest(SchemaTest):
+    # JSON -> piqi -> pb -> piqi -> JSON
+    def round_trip(self, typename, doc, **kwargs):
+        obj = piqi.parse(doc, MODULE_NAME, typename, format='json')
+        data = piqi.gen(obj, 'pb', MODULE_NAME, typename)
+        res = piqi.parse(data, MODULE_NAME, typename, format='pb', **kwargs)
+        self.assertEqual(piqi.gen(res), doc)
+        return data
+
+    def test_numbers(self):
+        for sign in (1, -1):
+            self.round_trip('numbers', {
+                'i': sign * 1,
+                'i64': sign * (2 ** 62),
+                'u': INT64_MAX,
+                'p32': sign * (2 ** 31 - 1),
+                'p64': sign * INT64_MAX,
+                'fi32': sign * (2 ** 31 - 1),
+                'fu32': 2 ** 32 - 1,
+                'fi64': sign * INT64_MAX,
+                'fu64': INT64_MAX,
+                'f32': sign * 1.5,
+                'f64': sign * 1e300,
+                'b': sign > 0,
+                's': u'\u043f\u0438\u043a',
+            })
+
+    def test_zigzag(self):
+        # field 1, varint; zigzag: -1 -> 1, 1 -> 2, -64 -> 127
+        self.assertEqual(self.round_trip('numbers', {'i': -1}), '\x08\x01')
+        self.assertEqual(self.round_trip('numbers', {'i': 1}), '\x08\x02')
+        self.assertEqual(self.round_trip('numbers', {'i': -64}), '\x08\x7f')
+
+    def test_sign_extended(self):
+        # negative protobuf-int32 and protobuf-int64 are 10-byte varints
+        for name, code in (('p32', 4), ('p64', 5)):
+            data = self.round_trip('numbers', {name: -1})
+            self.assertEqual(data, chr(code << 3) + '\xff' * 9 + '\x01')
+
+    def test_fixed(self):
+        data = self.round_trip('numbers', {'fi32': -2})
+        self.assertEqual(data, '\x35\xfe\xff\xff\xff')
+        data = self.round_trip('numbers', {'f32': 0.5})
+        self.assertEqual(data, '\x55\x00\x00\x00\x3f')
+
+    def test_packed(self):
+        doc = {
+            'packed_int': [0, -1, 2 ** 40],
+            'packed_fixed': [-1, 2 ** 62],
+            'packed_float': [0.5, -1.5],
+            'packed_color': ['red', 'blue'],
+            'unpacked_int': [1, 2],
+        }
+        data = self.round_trip('arrays', doc)
+        self.round_trip('arrays', doc, numeric_arrays='array')
+
+        # packed-color: field 4, block of two varints; option codes start from 1
+        self.assertTrue('\x22\x02\x01\x03' in data)
+        # unpacked-int: field 5, varint per item
+        self.assertTrue(data.endswith('\x28\x02\x28\x04'))
+
+    def test_numeric_arrays(self):
+        doc = {
+            'packed_int': [0, -1, 2 ** 40],
+            'packed_fixed': [-1, 2 ** 62],
+            'packed_float': [0.5, -1.5],
+            'unpacked_int': [1, 2],
+        }
+        obj = piqi.parse(doc, MODULE_NAME, 'arrays', format='json', numeric_arrays='array')
+        self.assertTrue(isinstance(obj.packed_float_list, array.array))
+        data = piqi.gen(obj, 'pb', MODULE_NAME, 'arrays')
+        self.assertEqual(data, self.round_trip('arrays', doc))
+        self.round_trip('arrays', doc, numeric_arrays='array')
+
+    @unittest.skipIf(piqi.numpy is None, 'numpy is not installed')
+    def test_numpy_arrays(self):
+        doc = {
+            'packed_int': [0, -1, 2 ** 40],
+            'packed_fixed': [-1, 2 ** 62],
+            'packed_float': [0.5, -1.5],
+            'unpacked_int': [1, 2],
+        }
+        obj = piqi.parse(doc, MODULE_NAME, 'arrays', format='json', numeric_arrays='numpy')
+        self.assertTrue(isinstance(obj.packed_int_list, piqi.numpy.ndarray))
+        data = piqi.gen(obj, 'pb', MODULE_NAME, 'arrays')
+        self.assertEqual(data, self.round_trip('arrays', doc))
+        self.round_trip('arrays', doc, numeric_arrays='numpy')
+
+    def test_variant(self):
+        self.round_trip('shape-list', [
+            {'point': {'i': -3}},
+            {'circle': 2.5},
+            {'color': 'green'},
+            {'empty': True},
+        ])
+
+    def test_top_level(self):
+        self.round_trip('color', 'blue')
+        self.round_trip('my-int', -5)
+        self.round_trip('float32', 0.25)
+        self.round_trip('string', 'abc')
+        self.round_trip('bool', True)
+
+        # enums carry their types
+        obj = piqi.parse('blue', MODULE_NAME, 'color', format='json')
+        self.assertEqual(piqi.gen(obj, 'pb'), '\x08\x03')
+
+        # built-in types don't need a schema module
+        self.assertEqual(piqi.gen(piqi.make_scalar(-1), 'pb', typename='int'), '\x08\x01')
+
+    def test_top_level_errors(self):
+        self.assertRaises(ValueError, piqi.gen, piqi.make_scalar(1), 'pb')
+        self.assertRaises(ValueError, piqi.gen, piqi.make_scalar(1), 'pb', MODULE_NAME, 'foo')
+
+    def assertParseError(self, typename, data, error, path):
+        try:
+            piqi.parse(data, MODULE_NAME, typename, format='pb')
+        except piqi.ParseError as e:
+            self.assertEqual((e.error, e.path), (error, path))
+        else:
+            self.fail('ParseError expected')
+
+    def test_invalid_input(self):
+        data = self.round_trip('shape-list', [{'circle': 1.0}, {'point': {'i': 1, 'fi64': 1}}])
+        for size in (len(data) - 1, len(data) - 9):
+            self.assertParseError('shape-list', data[:size], 'unexpected end of message', ())
+
+        # truncated values in a nested message
+        self.assertParseError('shape-list', '\x0a\x04\x0a\x02\x08\x80', 'unexpected end of message', (0, 'point'))
+        self.assertParseError('shape-list', '\x0a\x03\x0a\x01\x09', 'unexpected end of message', (0, 'point'))
+
+        # varint over 10 bytes
+        self.assertParseError('numbers', '\x08' + '\x80' * 10 + '\x01', 'invalid varint', ())
+
+        # unsupported wire type
+        self.assertParseError('numbers', '\x0b', 'unsupported wire type 3', ())
+
+        # wire type mismatch
+        self.assertParseError('shape-list', '\x0a\x02\x08\x01', 'block expected for \'numbers\'', (0, 'point'))
+        self.assertParseError('arrays', '\x28\x02\x2d\x00\x00\x00\x00', 'int constant expected', ('unpacked_int_list', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# tests for the piqi_profile module
+#
+# usage: python tests/test_piqi_profile.py
+
+import os
+import gc
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+import piqi_profile
+import piqi_of_piq
+import piq_transform
+
+import schema_fixture
+from schema_fixture import field
+
+
+MODULE_NAME = 'test_piqi_profile_schema'
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'point': ('record', {
+                'name': 'point',
+                'field': [
+                    field('x', 'int', 'required'),
+                    field('y', 'int', 'required'),
+                ]
+            }),
+            'doc': ('record', {
+                'name': 'doc',
+                'field': [field('point', 'point', 'repeated')]
+            }),
+        }
+
+
+SCRIPT = 'x = 1\n[.point [.x 1, .y x], .point [.x 2, .y 3]]\n'
+
+
+def make_lists(n):
+    return [[] for _ in range(n)]
+
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.assertTrue(gc.isenabled())
+
+    def run_stage(self, name, f, *args):
+        return piqi_profile.run_stage(name, len, f, *args)
+
+    def test_stages(self):
+        records = []
+        with piqi_profile.profile(records.append) as p:
+            self.assertTrue(piqi_profile.is_enabled())
+            self.run_stage('outer', lambda: self.run_stage('inner', make_lists, 10) + [1])
+            self.run_stage('inner', make_lists, 5)
+        self.assertFalse(piqi_profile.is_enabled())
+
+        self.assertEqual([x.name for x in records], ['inner', 'outer', 'inner'])
+        self.assertEqual([x.nodes for x in records], [10, 11, 5])
+        self.assertEqual([(x.name, x.calls, x.nodes) for x in p.stats.values()], [('inner', 2, 15), ('outer', 1, 11)])
+        outer = p.stats['outer']
+        self.assertTrue(0 <= outer.self_time <= outer.elapsed)
+
+    def test_errors(self):
+        def fail():
+            raise ValueError()
+
+        with piqi_profile.profile() as p:
+            self.assertRaises(ValueError, self.run_stage, 'outer', lambda: self.run_stage('inner', fail))
+        self.assertEqual(p.stack, [])
+        self.assertEqual([(x.name, x.calls) for x in p.stats.values()], [('inner', 1), ('outer', 1)])
+
+    # by default, garbage collection is left as it is and gc objects are not
+    # counted
+    def test_gc_untouched(self):
+        gc_states = []
+        with piqi_profile.profile() as p:
+            self.run_stage('stage', lambda: gc_states.append(gc.isenabled()) or [])
+        self.assertEqual(gc_states, [True])
+        self.assertEqual(p.stats['stage'].self_gc_objects, None)
+        self.assertTrue(p.format_report().splitlines()[1].endswith(' -'))
+
+    def test_gc_objects(self):
+        gc_states = []
+
+        def stage():
+            gc_states.append(gc.isenabled())
+            return make_lists(1000)
+
+        with piqi_profile.profile(count_gc_objects=True) as p:
+            res = self.run_stage('stage', stage)
+            self.run_stage('exec', lambda: gc_states.append(gc.isenabled()) or [])
+        self.assertTrue(gc.isenabled())
+
+        # stages that run user code keep garbage collection enabled and are
+        # not counted
+        self.assertEqual(gc_states, [False, True])
+        # NOTE: only roughly, because objects freed in the meantime, e.g.
+        # frames, cancel out
+        self.assertTrue(p.stats['stage'].self_gc_objects > len(res) / 2)
+        self.assertEqual(p.stats['exec'].self_gc_objects, None)
+
+
+class PipelineTest(SchemaTest):
+    def test_stages(self):
+        filename = self.write_script(SCRIPT)
+        with piqi_profile.profile() as p:
+            res = piq_transform.compile_file(filename).run()
+            piqi.parse(res, MODULE_NAME, 'doc')
+
+        stages = p.stats.keys()
+        for name in ('piq_transform', 'compile', 'exec', 'piq.parse', 'piqi_of_piq'):
+            self.assertTrue(name in stages, name)
+        # the document, its points and their fields
+        self.assertEqual(p.stats['piqi_of_piq'].nodes, 7)
+        self.assertEqual(len(p.format_report().splitlines()), len(stages) + 1)
+
+
+class LocationsTest(SchemaTest):
+    def test_hot_spots(self):
+        parse_obj = piqi_of_piq.parse_obj
+
+        trace = sys.gettrace()
+
+        filename = self.write_script(SCRIPT)
+        program = piq_transform.compile_file(filename)
+        with piqi_profile.profile_locations(filename) as p:
+            res = program.run()
+            piqi.parse(res, MODULE_NAME, 'doc')
+        self.assertTrue(piqi_of_piq.parse_obj is parse_obj)
+        self.assertEqual(sys.gettrace(), trace)
+
+        # evaluation and typing time is charged to the script's lines
+        hot_spots = p.hot_spots()
+        self.assertEqual(sorted((x[0], x[1]) for x in hot_spots), [(filename, 1), (filename, 2)])
+        line_2 = [x for x in hot_spots if x[1] == 2][0]
+        self.assertTrue(line_2[2] > 0 and line_2[3] > 0)
+
+        self.assertEqual(len(p.format_report(limit=1).splitlines()), 2)
+        report = p.format_report().splitlines()
+        self.assertEqual(sorted(x.split(None, 5)[-1] for x in report[1:]), sorted(SCRIPT.splitlines()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# tests for the random document generator
+#
+# usage: python tests/test_piqi_random.py
+
+import os
+import sys
+import json
+import StringIO
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+import piqi_random
+import piq_transform
+
+import schema_fixture
+from schema_fixture import field, option
+
+
+MODULE_NAME = 'test_piqi_random_schema'
+
+
+class SchemaTest(schema_fixture.SchemaTestCase):
+    module_name = MODULE_NAME
+
+    def make_typedef_index(self):
+        return {
+            'small-int': ('alias', {'name': 'small-int', 'type': 'int32'}),
+            'point': ('record', {
+                'name': 'point',
+                'field': [
+                    field('x', 'small-int', 'required'),
+                    field('y', 'int64', 'required'),
+                    field('label', 'string'),
+                ]
+            }),
+            'color': ('enum', {
+                'name': 'color',
+                'option': [option('red'), option('green')]
+            }),
+            'shape': ('variant', {
+                'name': 'shape',
+                'option': [
+                    option('point', 'point'),
+                    option('radius', 'float'),
+                    option('empty'),
+                    {'type': 'color'},
+                ]
+            }),
+            'tree': ('record', {
+                'name': 'tree',
+                'field': [
+                    field('shape', 'shape', 'required'),
+                    field('data', 'binary'),
+                    field('flag', 'bool'),
+                    field('points', 'point-list'),
+                    field('child', 'tree', 'repeated'),
+                ]
+            }),
+            'point-list': ('list', {'name': 'point-list', 'type': 'point'}),
+            'loop': ('record', {
+                'name': 'loop',
+                'field': [field('next', 'loop', 'required')]
+            }),
+        }
+
+
+OPTIONS = dict(seed=1, max_depth=3, repeated_length=3, optional_density=0.7)
+
+
+class GenerateTest(SchemaTest):
+    def generate(self, format, count, **kwargs):
+        output = StringIO.StringIO()
+        piqi_random.generate(self.schema_module, 'tree', format=format, count=count, output=output, **kwargs)
+        return output.getvalue()
+
+    def test_json(self):
+        lines = self.generate('json', 10, **OPTIONS).splitlines()
+        self.assertEqual(len(lines), 10)
+        for line in lines:
+            doc = json.loads(line)
+            self.assertEqual(piqi.validate(doc, MODULE_NAME, 'tree', format='json'), [])
+            obj = piqi.parse(doc, MODULE_NAME, 'tree', format='json')
+            self.assertEqual(piqi.gen(obj), doc)
+
+        # the same seed generates the same documents
+        self.assertEqual(self.generate('json', 10, **OPTIONS).splitlines(), lines)
+
+    def test_piq(self):
+        for positional in (False, True):
+            filename = self.write_script(self.generate('piq', 10, positional=positional, **OPTIONS))
+            program = piq_transform.compile_file(filename, emit_expressions=True)
+
+            docs = []
+            program.stream(docs.append)
+            self.assertEqual(len(docs), 10)
+            for doc in docs:
+                self.assertEqual(piqi.validate(doc, MODULE_NAME, 'tree'), [])
+
+    def test_obj(self):
+        objs = list(piqi_random.generate(self.schema_module, 'tree', format='obj', count=3, **OPTIONS))
+        self.assertEqual(len(objs), 3)
+        for obj in objs:
+            doc = piqi.gen(obj)
+            self.assertEqual(piqi.validate(doc, MODULE_NAME, 'tree', format='json'), [])
+
+    def test_int_ranges(self):
+        generator = piqi_random.Generator(self.schema_module, seed=1)
+        values = [generator.gen_scalar('int', 'small-int') for _ in range(1000)]
+        self.assertTrue(all(-2 ** 31 <= x < 2 ** 31 for x in values))
+        self.assertTrue(max(abs(x) for x in values) > 2 ** 16)
+
+    def test_required_recursion(self):
+        self.assertRaises(ValueError, piqi_random.generate, self.schema_module, 'loop', output=StringIO.StringIO())
+
+
+if __name__ == '__main__':
+    unittest.main()
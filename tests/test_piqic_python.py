@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# tests for modules generated by piqic-python
+#
+# usage: python tests/test_piqic_python.py
+
+import os
+import sys
+import imp
+import array
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import piqi
+
+from schema_fixture import field, option
+
+
+PIQIC_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'piqic-python')
+
+MODULE_NAME = 'test_piqic_python_schema'
+
+
+def load_piqic():
+    # NOTE: not leaving piqic-pythonc next to the script
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source('piqic_python', PIQIC_FILENAME)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+
+piqic = load_piqic()
+
+
+def flatten_iolist(l, accu):
+    for x in l:
+        if isinstance(x, basestring):
+            accu.append(x)
+        else:
+            flatten_iolist(x, accu)
+    return accu
+
+
+# piqi compile -t json output for the schema
+PIQI_JSON = {
+    'typedef': [
+        {'record': {
+            'name': 'item',
+            'field': [
+                field('self', 'int', 'required'),
+                field('class', 'string'),
+                field('value', 'int', 'repeated'),
+            ]
+        }},
+        {'record': {
+            'name': 'item-doc',
+            'field': [field('item', 'item', 'repeated')]
+        }},
+        {'record': {
+            'name': 'empty',
+            'field': []
+        }},
+        {'variant': {
+            'name': 'value',
+            'option': [
+                option('i', 'int'),
+                option('s', 'string'),
+                {'type': 'item'},
+                option('none'),
+            ]
+        }},
+    ]
+}
+
+
+class GeneratedModuleTest(unittest.TestCase):
+    def setUp(self):
+        code = ''.join(flatten_iolist(piqic.gen_module(piqic.Piqi(PIQI_JSON)), []))
+        m = types.ModuleType(MODULE_NAME)
+        sys.modules[MODULE_NAME] = m
+        self.addCleanup(sys.modules.pop, MODULE_NAME, None)
+        exec code in m.__dict__
+        self.m = m
+
+    def test_slots(self):
+        Item = self.m.Item
+        self.assertEqual(Item.__slots__, ('self', 'class', 'value_list'))
+        self.assertEqual(self.m.ItemDoc.__slots__, ('item_list',))
+        self.assertEqual(self.m.Empty.__slots__, ())
+        self.assertEqual((Item._piqi_type, Item._piqi_typedef['name']), ('item', 'item'))
+
+        obj = Item(1, 'a', [])
+        self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertRaises(AttributeError, setattr, obj, 'foo', 1)
+        self.assertTrue(isinstance(obj, piqi.SlottedRecord))
+        self.assertTrue(isinstance(obj, piqi.BaseRecord))
+        self.assertFalse(isinstance(obj, piqi.Record))
+
+    def test_init(self):
+        Item = self.m.Item
+        # arguments named after Python keywords and 'self' get '_' suffix
+        for obj in (Item(1, 'a', [2]), Item(self_=1, class_='a', value_list=[2])):
+            self.assertEqual((obj.self, getattr(obj, 'class'), obj.value_list), (1, 'a', [2]))
+            self.assertEqual(piqi.record_fields(obj), [('self', 1), ('class', 'a'), ('value_list', [2])])
+        self.assertEqual(repr(self.m.Empty()), '{}')
+
+    def test_record_classes(self):
+        self.assertEqual(self.m.record_classes, {
+            'item': self.m.Item,
+            'item-doc': self.m.ItemDoc,
+            'empty': self.m.Empty,
+        })
+
+        doc = {'item': [{'self': 1, 'class': 'a', 'value': [2, 3]}, {'self': 4}]}
+        obj = self.m.parse_item_doc(doc, format='json')
+        self.assertTrue(type(piqi.unwrap_object(obj)) is self.m.ItemDoc)
+        self.assertEqual([type(piqi.unwrap_object(x)) for x in obj.item_list], [self.m.Item, self.m.Item])
+        self.assertEqual(obj.item_list[0].value_list, [2, 3])
+        self.assertEqual(obj.item_list[1].value_list, [])
+        self.assertEqual(piqi.gen(obj), doc)
+
+    def test_parse_kwargs(self):
+        doc = {'item': [{'self': 1, 'value': [2, 3]}]}
+        obj = self.m.parse(doc, 'item-doc', 'json', numeric_arrays='array')
+        self.assertEqual(obj.item_list[0].value_list, array.array('l', [2, 3]))
+        obj = self.m.parse_item_doc(doc, format='json', numeric_arrays='array')
+        self.assertEqual(obj.item_list[0].value_list, array.array('l', [2, 3]))
+
+
+class AnalysisTest(unittest.TestCase):
+    def test_variant_attempts(self):
+        p = piqic.Piqi(PIQI_JSON)
+        factors, unbounded = piqic.compute_reparse_factors(p)
+        self.assertEqual(unbounded, set())
+
+        # named options with a type are tried against unlabeled values as well,
+        # each unlabeled element of an item is tried as its 3 positional fields
+        typedef = p.index['value'][1]
+        self.assertEqual(piqic.variant_attempts(p, factors, typedef), (3, 5))
+
+        report, warnings = piqic.analyze_piqi(p)
+        self.assertTrue('variant value: 4 options scanned, 5 attempts per value, reparse factor 5\n' in report)
+        self.assertEqual(warnings, [])
+
+    def test_records(self):
+        report, warnings = piqic.analyze_piqi(piqic.Piqi(PIQI_JSON))
+        self.assertEqual(report[:2], [
+            'record item: 3 positional fields, 3 overlapping, 3 attempts per element, reparse factor 3\n',
+            'record item-doc: 0 positional fields, 0 overlapping, 0 attempts per element, reparse factor 3\n',
+        ])
+
+    # positional fields of a record nested in a variant's nameless option are
+    # tried at every level of nesting
+    def test_recursive(self):
+        p = piqic.Piqi({'typedef': [
+            {'variant': {
+                'name': 'expr',
+                'option': [option('i', 'int'), {'type': 'pair'}]
+            }},
+            {'record': {
+                'name': 'pair',
+                'field': [
+                    field('left', 'expr', 'required', piq_positional=True),
+                    field('right', 'expr', 'required', piq_positional=True),
+                ]
+            }},
+        ]})
+        factors, unbounded = piqic.compute_reparse_factors(p)
+        self.assertEqual(unbounded, set(['expr', 'pair']))
+
+        report, warnings = piqic.analyze_piqi(p)
+        self.assertEqual(report[0], 'variant expr: 2 options scanned, unbounded attempts per value, reparse factor unbounded\n')
+        self.assertEqual(warnings, [
+            'warning: variant expr: worst-case number of try-parse attempts grows superlinearly with the depth of nesting\n',
+            'warning: record pair: worst-case number of try-parse attempts grows superlinearly with the depth of nesting\n',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()